@@ -363,7 +363,8 @@ if __name__ == '__main__':  # Are you running this file directly?  (VS importing
         mysql_connection_params = get_mysql_connection_parameters(moodle_mysql_db, site=site)
 
         moodle_enr_provider = MoodleMySQLEnrolmentProvider(**mysql_connection_params)
-        jbar_enr_provider = MoodleMSSQLEnrolmentProvider(mssql_connection_string, j1_enroll_view)
+        # bulk reads the enrollment view once for the whole run instead of once per course.
+        jbar_enr_provider = MoodleMSSQLEnrolmentProvider(mssql_connection_string, j1_enroll_view, bulk=True)
 
         enrol_syncer = EnrolmentSync(target=moodle_enr_provider, source=jbar_enr_provider)
 
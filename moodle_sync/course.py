@@ -1,9 +1,158 @@
 # file: moodle_sync/course.py
 
-from typing import List, Dict, Callable, Union
+import time
+import json
+import html
+import math
+import hashlib
+import decimal
+import inspect
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Callable, Union, Iterator, Iterable, Optional, Any
 
 from moodle_sync.config import config
 from moodle_sync.logger import logger
+from moodle_sync.state import SyncStateStore
+
+
+def _supported_kwargs(func: Callable, kwargs: Dict) -> Dict:
+    """
+    Providers written before create_course took known_absent and category_id override it as
+    create_course(self, course).  Only pass them what they take.
+    :return: the kwargs that func accepts.
+    """
+    try:
+        parameters = inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return kwargs
+    if any(parameter.kind == parameter.VAR_KEYWORD for parameter in parameters.values()):
+        return kwargs
+    return {key: value for key, value in kwargs.items() if key in parameters}
+
+
+class CourseSnapshot:
+    """
+    A set of courses, indexed so a course can be found by shortname, idnumber or id without searching the list.
+    Build it once per run:
+
+        snapshot = CourseSnapshot(provider.iter_courses())
+        course = snapshot.get('ENG101-F24')            # by shortname
+        course = snapshot.get('123456', 'idnumber')
+
+    Blank values (like an empty idnumber) are not indexed.  If two courses share a value, the first one wins.
+    """
+
+    default_keys = ('shortname', 'idnumber', 'id')
+
+    def __init__(self, courses: Iterable[Dict] = (), keys: Iterable[str] = default_keys):
+        """
+        :param courses: the courses to put in the snapshot.  Any iterable, it is only walked once.
+        :param keys: the course fields to index.
+        """
+        self.keys = tuple(dict.fromkeys(keys))  # drop duplicates, keep the order
+        self.courses: List[Dict] = []
+        self.index: Dict[str, Dict[Any, Dict]] = {key: {} for key in self.keys}
+        for course in courses:
+            self.add(course)
+
+    def add(self, course: Dict) -> None:
+        """
+        Add a course, or a course that was just created, to the snapshot.
+        """
+        self.courses.append(course)
+        for key, index in self.index.items():
+            value = course.get(key)
+            if value is not None and value != '':
+                index.setdefault(value, course)
+
+    def get(self, value: Any, key: str = 'shortname') -> Optional[Dict]:
+        """
+        :param value: the value to look for
+        :param key: the field to look in.  Must be one of the keys the snapshot was built with.
+        :return: the course, or None if it isn't in the snapshot.
+        """
+        return self.index[key].get(value)
+
+    def __contains__(self, shortname: str) -> bool:
+        return shortname in self.index.get('shortname', {})
+
+    def __iter__(self) -> Iterator[Dict]:
+        return iter(self.courses)
+
+    def __len__(self) -> int:
+        return len(self.courses)
+
+
+class CategoryIndex:
+    """
+    The Moodle category tree, indexed by id, by name, and by path.
+    A path is the category names from the top down joined with path_separator, like "2024 Fall / Undergraduate".
+
+        categories = CategoryIndex(provider_categories)   # dicts with id, name and parent
+        categories.get(12)
+        categories.get('Undergraduate')
+        categories.get('2024 Fall / Undergraduate')
+
+    If two categories share a name, a lookup by name finds the first one.  Use the path to tell them apart.
+    Moodle sends names HTML escaped ("Arts &amp; Sciences"), so names and paths are indexed unescaped,
+    the way a source would spell them.
+    """
+
+    path_separator = ' / '
+
+    def __init__(self, categories: Iterable[Dict] = ()):
+        """
+        :param categories: dicts with at least id, name and parent (0 for a top level category).
+        """
+        self.by_id: Dict[int, Dict] = {}
+        self.by_name: Dict[str, Dict] = {}
+        self._by_path: Optional[Dict[str, Dict]] = None  # built when first needed, since parents can come later.
+        for category in categories:
+            self.add(category)
+
+    def add(self, category: Dict) -> None:
+        """
+        Add a category, such as one that was just created.
+        """
+        self.by_id[category['id']] = category
+        self.by_name.setdefault(self.name(category), category)
+        self._by_path = None
+
+    @staticmethod
+    def name(category: Dict) -> str:
+        """
+        :return: the category name with HTML entities unescaped.
+        """
+        return html.unescape(category['name'])
+
+    def path(self, category: Dict) -> str:
+        """
+        :return: the names of the category and its parents, from the top down, joined with path_separator.
+        """
+        names, seen = [], set()
+        while category is not None and category['id'] not in seen:
+            seen.add(category['id'])
+            names.append(self.name(category))
+            category = self.by_id.get(category.get('parent') or 0)
+        return self.path_separator.join(reversed(names))
+
+    def get(self, name_path_or_id: Union[str, int]) -> Optional[Dict]:
+        """
+        :param name_path_or_id: a category id, name, or path.
+        :return: the category, or None if it isn't in the index.
+        """
+        if type(name_path_or_id) is int:
+            return self.by_id.get(name_path_or_id)
+        if name_path_or_id in self.by_name:
+            return self.by_name[name_path_or_id]
+        if self.path_separator in name_path_or_id:
+            if self._by_path is None:
+                self._by_path = {self.path(category): category for category in self.by_id.values()}
+            return self._by_path.get(name_path_or_id)
+        return None
+
+    def __len__(self) -> int:
+        return len(self.by_id)
 
 
 class MoodleCourseProvider:
@@ -85,6 +234,10 @@ class MoodleCourseProvider:
         'fullname', 'startdate', 'enddate', 'categoryid',
     ]
 
+    # the course field that says when a course last changed, as a unix timestamp.
+    # Providers that set this support get_courses_modified_since, so CourseSync can fetch just the changes.
+    change_column = None
+
     def __init__(self):
         self.courses = None
         self
@@ -93,6 +246,15 @@ class MoodleCourseProvider:
     def get_category(self, name_or_id: Union[str, int]) -> Union[int, None]:
         raise NotImplementedError("No category getter provided.")
 
+    def load_categories(self, refresh: bool = False) -> Optional[CategoryIndex]:
+        """
+        Load all the categories at once, so get_category doesn't have to look each one up.
+        Providers that can do that override this.  CourseSync calls it at the start of each run.
+        :param refresh: load them again even if they are already loaded.
+        :return: CategoryIndex, or None if the provider doesn't preload categories.
+        """
+        return None
+
     def create_category(self, category_name, category_parent_name: Union[str, None] = None) -> int:
         raise NotImplementedError("No category creator provided.")
 
@@ -122,22 +284,384 @@ class MoodleCourseProvider:
                 assert column in courses[0], f"retriever must return a list of dicts with the column: {column}"
         return courses
 
+    def get_courses_modified_since(self, since: int) -> List[Dict]:
+        """
+        Return the courses that changed at or after the given time.  Only for providers with a change_column.
+        :param since: unix timestamp
+        :return: List[dict]:  the changed courses, with the change_column in each.
+        """
+        raise NotImplementedError("No change tracking provided.")
+
+    def iter_courses(self, field: Union[str, None] = None, value: Union[str, None] = None) -> Iterator[Dict]:
+        """
+        Yield the courses one at a time.  Providers that can fetch courses lazily override this;
+        by default it just walks get_courses().
+        """
+        return iter(self.get_courses(field, value))
+
+    def get_course_snapshot(self, keys: Iterable[str] = CourseSnapshot.default_keys,
+                            keep: Optional[Callable[[Dict], bool]] = None,
+                            category_ids: Optional[Iterable[int]] = None) -> CourseSnapshot:
+        """
+        Get the courses as a CourseSnapshot.  Providers with a faster way to build one can override this.
+        :param keys: the course fields to index.
+        :param keep: optional function of a course.  Only the courses it returns True for are kept.
+        :param category_ids: optional.  Only get the courses in these categories, one iter_courses call each.
+        :return: CourseSnapshot
+        """
+        if category_ids is None:
+            courses = self.iter_courses()
+        else:
+            courses = (course for category_id in category_ids for course in self.iter_courses('category', category_id))
+        return CourseSnapshot(courses if keep is None else filter(keep, courses), keys)
+
     def get_course(self, shortname_or_id: Union[str, int]) -> Union[dict, None]:
         raise NotImplementedError("No course getter provided.")
 
-    def create_course(self, course: Dict):
+    def create_course(self, course: Dict, known_absent: bool = False, category_id: Optional[int] = None):
+        """
+        Create the course.
+        :param course: the course dict
+        :param known_absent: the caller already checked that the course doesn't exist, so don't check again.
+        :param category_id: the category id, if the caller already looked it up.
+        :return: the new course id
+        """
         raise NotImplementedError("No creator provided.")
 
     def update_course(self, course: Dict):
         raise NotImplementedError("No updater provided.")
 
+    def update_courses(self, courses: List[Dict], course_ids: Optional[List[Union[int, None]]] = None) -> List[Dict]:
+        """
+        Update many courses.  Providers that can send updates in bulk override this.
+        By default each course goes through update_course, and a failure doesn't stop the others.
+        :param courses: the course dicts
+        :param course_ids: the moodle course ids for the courses, if known.  Not used by the default.
+        :return: a result for each course, in order:  dict with course, ok (bool) and error.
+        """
+        results = []
+        for course in courses:
+            try:
+                self.update_course(course)
+                results.append({'course': course, 'ok': True, 'error': None})
+            except Exception as e:
+                logger.error(f"Error updating course {course.get('shortname')}: {type(e).__name__} {e}")
+                results.append({'course': course, 'ok': False, 'error': str(e)})
+        return results
+
+
+class CourseDiff:
+    """
+    The fields that differ between a moodle course and a source course.  True if there are any.
+    Each change is a tuple of (field, moodle value, source value).  The text is only built when it is printed.
+    """
+    __slots__ = ('changes',)
+
+    def __init__(self, changes: List[tuple]):
+        self.changes = changes
+
+    def __bool__(self) -> bool:
+        return bool(self.changes)
+
+    def __len__(self) -> int:
+        return len(self.changes)
+
+    @property
+    def fields(self) -> List[str]:
+        return [field for field, _, _ in self.changes]
+
+    def __str__(self) -> str:
+        return "".join(f"   moodle {field} was {moodle_value} now {source_value}\n"
+                       for field, moodle_value, source_value in self.changes)
+
+    def __repr__(self) -> str:
+        return f"CourseDiff({self.changes!r})"
+
+
+class CourseComparator:
+    """
+    Compares a moodle course with a source course on the fields_to_update.  Built once, used for every course.
+
+    Values are normalised before they are compared, so formatting differences don't count as changes:
+    HTML entities are unescaped (moodle sends &amp; for &), and numeric fields compare by value whether they come
+    as int, str, float or Decimal ("1730338814" and 1730338814 are the same).  Only fields in NUMERIC_FIELDS, or
+    where one side is already a number, are treated as numbers - an idnumber of '0123' is not the same as '123'.
+    The enddate is ignored when moodle sets it automatically and automaticenddate isn't being synced.
+    """
+
+    # course fields moodle stores as integers.  Sources often hand these over as strings.
+    NUMERIC_FIELDS = frozenset((
+        'id', 'category', 'categoryid', 'startdate', 'enddate', 'timecreated', 'timemodified', 'visible',
+        'automaticenddate', 'showgrades', 'newsitems', 'maxbytes', 'showreports', 'showactivitydates',
+        'showcompletionconditions', 'groupmode', 'groupmodeforce', 'defaultgroupingid', 'enablecompletion',
+        'completionnotify', 'numsections', 'hiddensections', 'coursedisplay', 'relativedatesmode',
+    ))
+
+    def __init__(self, fields_to_update: Iterable[str]):
+        self.fields = tuple(fields_to_update)
+        self.ignore_automatic_enddate = 'enddate' in self.fields and 'automaticenddate' not in self.fields
+
+    @staticmethod
+    def normalise(value: Any, numeric: bool = False) -> Any:
+        """
+        :param value: a field value from either side
+        :param numeric: bool: the field holds a number, so a string of digits is read as an int,
+            and other strings that are numbers (like '5.0' or '1e3') as the number.
+        :return: the value to compare.  NaN and infinity become 'nan', 'inf' and '-inf', since NaN never equals
+            itself and int() refuses them.
+        """
+        if type(value) is str:
+            if '&' in value:
+                value = html.unescape(value)
+            if not numeric:
+                return value
+            stripped = value.strip()
+            # isdecimal, not isdigit - isdigit takes things like '²' that int() refuses.
+            if stripped[1:].isdecimal() and stripped[0] in '-+' or stripped.isdecimal():
+                return int(stripped)
+            try:
+                return CourseComparator.normalise(float(stripped))
+            except ValueError:
+                return value
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, decimal.Decimal) and not value.is_finite():
+            return 'nan' if value.is_nan() else str(float(value))
+        if isinstance(value, float) and not math.isfinite(value):
+            return str(value)
+        if isinstance(value, (float, decimal.Decimal)) and value == int(value):
+            return int(value)
+        return value
+
+    @staticmethod
+    def _is_number(value: Any) -> bool:
+        return isinstance(value, (int, float, decimal.Decimal)) and not isinstance(value, bool)
+
+    def compare(self, moodle_course: Dict, source_course: Dict) -> CourseDiff:
+        """
+        :param moodle_course: dict: course from moodle
+        :param source_course: dict: course from source
+        :return: CourseDiff of the fields that differ.
+        """
+        normalise = self.normalise
+        changes = []
+        for field in self.fields:
+            if field not in moodle_course:
+                logger.debug(f"Field {field} not in moodle course.")
+                continue
+            if field not in source_course:
+                logger.debug(f"Field {field} not in source course.")
+                continue
+            moodle_value, source_value = moodle_course[field], source_course[field]
+            if moodle_value == source_value:
+                continue
+            numeric = field in self.NUMERIC_FIELDS or self._is_number(moodle_value) or self._is_number(source_value)
+            if normalise(moodle_value, numeric) == normalise(source_value, numeric):
+                continue
+            if field == 'enddate' and self.ignore_automatic_enddate and moodle_course.get('automaticenddate') == 1:
+                # skip updating enddate if automaticenddate is off and automaticenddate not in the fields to update.
+                continue
+            changes.append((field, moodle_value, source_value))
+        return CourseDiff(changes)
+
+
+class CourseCreateQueue:
+    """
+    Create courses on a few worker threads at once.
+
+    Duplicating a template course in Moodle is a full backup and restore on the server, which can take
+    a minute per course.  Running several at once gets a new term's courses in place much sooner.
+    Keep workers small - each one ties up a Moodle PHP worker for the whole duplication.
+
+    Usage:
+        queue = CourseCreateQueue(provider, workers=4, timeout=300, on_progress=print_progress)
+        for course in new_courses:
+            queue.add(course, known_absent=True)
+        results = queue.run()   # one result per course, in the order they were added
+
+    A course that fails or takes longer than timeout gets ok False in its result; the others carry on.
+    A timed out duplication can't be stopped and may still finish in Moodle, so check those courses.
+    Its thread keeps its worker until the call returns, so the whole run also has a deadline (batch_timeout,
+    by default enough for every course to take the full timeout).  Courses that haven't started by the deadline,
+    or while every worker is stuck on a timed out course, are not created.  To get the workers back sooner
+    give the call itself a timeout, e.g. MoodleAPI.function_timeouts['core_course_duplicate_course'].
+    """
+
+    def __init__(self, provider: 'MoodleCourseProvider', workers: int = 4, timeout: Optional[float] = None,
+                 on_progress: Optional[Callable[[int, int, Dict], None]] = None,
+                 batch_timeout: Optional[float] = None):
+        """
+        :param provider: the provider whose create_course makes the courses.
+        :param workers: the number of courses to create at once.
+        :param timeout: seconds.  Give up waiting for a course after this long.  None waits forever.
+        :param on_progress: optional function called as each course finishes with (done, total, result).
+        :param batch_timeout: seconds.  Give up on the whole run after this long.
+            None works it out from timeout, or waits forever if there is no timeout.
+        """
+        self.provider = provider
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.batch_timeout = batch_timeout
+        self.on_progress = on_progress
+        self.pending: List[tuple] = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, course: Dict, **create_kwargs) -> None:
+        """
+        Queue a course to be created.
+        :param course: the course dict for create_course
+        :param create_kwargs: more arguments for create_course, like known_absent or category_id.
+        """
+        self.pending.append((course, create_kwargs))
+
+    def run(self) -> List[Dict]:
+        """
+        Create all the queued courses.
+        :return: a result for each course, in the order they were added:
+            dict with course, id (the new course id), ok (bool), error, and seconds taken.
+        """
+        pending, self.pending = self.pending, []
+        results: List[Optional[Dict]] = [None] * len(pending)
+        started: Dict[int, float] = {}
+        done = 0
+
+        def create(i: int, course: Dict, create_kwargs: Dict) -> Any:
+            started[i] = time.monotonic()
+            return self.provider.create_course(course, **_supported_kwargs(self.provider.create_course, create_kwargs))
+
+        def finish(i: int, result: Dict) -> None:
+            nonlocal done
+            results[i] = result
+            done += 1
+            if not result['ok']:
+                logger.error(f"Course not created: {result['course'].get('shortname')} {result['error']}")
+            if self.on_progress:
+                self.on_progress(done, len(pending), result)
+
+        def give_up(future, i: int, now: float, error: str) -> None:
+            # the thread can't be stopped.  Stop waiting for it, and keep track of it while it holds a worker.
+            del futures[future]
+            if future.cancel():
+                error = f"not started: {error}"
+            else:
+                abandoned.append(future)
+            finish(i, {'course': pending[i][0], 'id': None, 'ok': False, 'error': error,
+                       'seconds': now - started.get(i, now)})
+
+        batch_timeout = self.batch_timeout
+        if batch_timeout is None and self.timeout is not None:
+            batch_timeout = self.timeout * -(-len(pending) // self.workers)
+        deadline = None if batch_timeout is None else time.monotonic() + batch_timeout
+        abandoned = []  # futures of courses we gave up on that are still running.
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(create, i, course, create_kwargs): i
+                   for i, (course, create_kwargs) in enumerate(pending)}
+        try:
+            while futures:
+                finished, _ = wait(futures, timeout=1.0, return_when=FIRST_COMPLETED)
+                now = time.monotonic()
+                for future in finished:
+                    i = futures.pop(future)
+                    seconds = now - started.get(i, now)
+                    try:
+                        new_course_id = future.result()
+                        finish(i, {'course': pending[i][0], 'id': new_course_id, 'ok': True, 'error': None,
+                                   'seconds': seconds})
+                    except Exception as e:
+                        finish(i, {'course': pending[i][0], 'id': None, 'ok': False,
+                                   'error': f"{type(e).__name__} {e}", 'seconds': seconds})
+                if self.timeout is not None:
+                    for future, i in list(futures.items()):
+                        if i in started and now - started[i] > self.timeout:
+                            give_up(future, i, now, f"timed out after {self.timeout} seconds")
+                abandoned = [future for future in abandoned if not future.done()]
+                if deadline is not None and now > deadline:
+                    for future, i in list(futures.items()):
+                        give_up(future, i, now, f"the batch timed out after {batch_timeout} seconds")
+                elif len(abandoned) >= self.workers:
+                    # every worker is stuck on a course that timed out, so nothing else is going to start.
+                    for future, i in list(futures.items()):
+                        give_up(future, i, now, "every worker is stuck on a timed out course")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return results
+
+
+class CoursePlan:
+    """
+    A course sync worked out ahead of time by CourseSync.plan:  the categories to create, the courses to create,
+    the courses to update with the fields that changed, and the courses skipped with the reason.
+    Save it with to_json, look it over, and run it later with CourseSync.apply_plan.
+
+    Each entry is a plain dict:
+        categories:  {'name', 'parent'}
+        creates:     {'key', 'course', 'categoryid'}
+        updates:     {'key', 'id', 'course', 'changes': [[field, moodle value, source value], ...]}
+        skips:       {'key', 'reason'}
+    creates and updates also have the 'fingerprint' of the source course when the sync keeps state.
+    A categoryid of None means the course goes in one of the categories the plan creates.
+    """
+
+    def __init__(self, course_key: str = 'shortname', categories: Optional[List[Dict]] = None,
+                 creates: Optional[List[Dict]] = None, updates: Optional[List[Dict]] = None,
+                 skips: Optional[List[Dict]] = None, planned_at: Optional[float] = None):
+        self.course_key = course_key
+        self.categories = categories if categories is not None else []
+        self.creates = creates if creates is not None else []
+        self.updates = updates if updates is not None else []
+        self.skips = skips if skips is not None else []
+        self.planned_at = planned_at if planned_at is not None else time.time()
+
+    def __len__(self) -> int:
+        # the number of changes the plan makes.
+        return len(self.categories) + len(self.creates) + len(self.updates)
+
+    def summary(self) -> str:
+        return (f"Create {len(self.categories)} categories and {len(self.creates)} courses, "
+                f"update {len(self.updates)} courses, skip {len(self.skips)}")
+
+    def __str__(self) -> str:
+        lines = [self.summary()]
+        lines += [f"  create category {category['name']}" +
+                  (f" in {category['parent']}" if category['parent'] else '') for category in self.categories]
+        lines += [f"  create {create['key']}" for create in self.creates]
+        for update in self.updates:
+            lines.append(f"  update {update['key']} ({update['id']})")
+            lines += [f"     moodle {field} was {moodle_value} now {source_value}"
+                      for field, moodle_value, source_value in update['changes']]
+        return "\n".join(lines)
+
+    def to_dict(self) -> Dict:
+        return {'course_key': self.course_key, 'planned_at': self.planned_at, 'categories': self.categories,
+                'creates': self.creates, 'updates': self.updates, 'skips': self.skips}
+
+    def to_json(self, **kwargs) -> str:
+        """
+        :param kwargs: passed to json.dumps, like indent=2.  Values that aren't JSON types are saved as strings.
+        """
+        return json.dumps(self.to_dict(), default=str, **kwargs)
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> 'CoursePlan':
+        return cls(course_key=data['course_key'], categories=data['categories'], creates=data['creates'],
+                   updates=data['updates'], skips=data['skips'], planned_at=data['planned_at'])
+
+    @classmethod
+    def from_json(cls, text: str) -> 'CoursePlan':
+        return cls.from_dict(json.loads(text))
+
 
 class CourseSync:
 
     def __init__(self, target: MoodleCourseProvider, source: MoodleCourseProvider,
                  course_key='shortname',
                  category_name_key='categoryname',
-                 category_parent_name_key=None):
+                 category_parent_name_key=None,
+                 state: Optional[SyncStateStore] = None,
+                 state_scope: Optional[str] = None,
+                 reconcile_interval: Optional[float] = None):
         """
         idnumber and shortname are common values for the course_key
         :param target:
@@ -145,6 +669,14 @@ class CourseSync:
         :param course_key: string to identify the field to be used as the course primary key.
         :param category_name_key: string to identify the field for the category name in the source course data.
         :param category_parent_name_key: string to identify the field for the category name in the source course data.
+        :param state: optional SyncStateStore.  If given, a fingerprint of each course is stored after it syncs,
+            and the next run skips the source courses whose fingerprint hasn't changed.
+        :param state_scope: the name this sync's state is stored under.  Defaults to "course:<course_key>".
+            Use a different one for each site if you keep several syncs in one store.
+        :param reconcile_interval: seconds.  If the last full sync was longer ago than this,
+            check every course anyway (a full reconcile), in case something was changed in Moodle.
+            None never does a full reconcile on its own.  See sync_to_moodle(reconcile=True).
+            A full reconcile also reloads the full course lists for fetch='incremental'.
 
         """
         self.target = target
@@ -152,6 +684,75 @@ class CourseSync:
         self.course_key = course_key
         self.category_name_key = category_name_key
         self.category_parent_name_key = category_parent_name_key
+        self.state = state
+        self.state_scope = state_scope if state_scope is not None else f"course:{course_key}"
+        self.reconcile_interval = reconcile_interval
+        self._comparator = None
+
+    def course_fingerprint(self, course: Dict) -> str:
+        """
+        A hash of the source course values that get pushed to moodle.  If it is the same as last time,
+        the course hasn't changed.  The category name is included since that is where categoryid comes from.
+        """
+        fields = sorted(set(self.target.fields_to_update) |
+                        {key for key in (self.category_name_key, self.category_parent_name_key) if key})
+        values = json.dumps([course.get(field) for field in fields], default=str)
+        return hashlib.sha1(values.encode()).hexdigest()
+
+    # seconds.  Incremental fetches go back this far before the watermark, for clock skew and late commits.
+    incremental_overlap = 300
+
+    def get_courses_incrementally(self, provider: MoodleCourseProvider, side: str, full: bool = False) -> List[Dict]:
+        """
+        Get the courses from a provider using the cached copy in the state store, updated with just the courses
+        that changed since the last run (see get_courses_modified_since).  The first run - or a full one - gets
+        all the courses and caches them.  Providers without a change_column always get all the courses,
+        so sync_to_moodle only uses this for a target that has one.
+        A course deleted from the provider stays in the cached copy until the next full run.
+        :param provider: the source or target provider
+        :param side: name for the cached copy, like source or moodle
+        :param full: get all the courses, and replace the cached copy.
+        :return: List[dict] of all the courses
+        """
+        if provider.change_column is None:
+            return provider.get_courses() if side == 'source' else list(provider.iter_courses())
+
+        watermark = self.state.get_value(self.state_scope, f'{side}_watermark')
+        if full or watermark is None:
+            courses = provider.get_courses() if side == 'source' else list(provider.iter_courses())
+            self.state.cache_courses(self.state_scope, side, courses, self.course_key, replace=True)
+            logger.info(f"Loaded all {len(courses)} {side} courses.")
+        else:
+            courses = provider.get_courses_modified_since(int(float(watermark)) - self.incremental_overlap)
+            self.state.cache_courses(self.state_scope, side, courses, self.course_key)
+            logger.info(f"{len(courses)} {side} courses changed since the last run.")
+            courses = self.state.get_cached_courses(self.state_scope, side)
+
+        changes = [course[provider.change_column] for course in courses if course.get(provider.change_column)]
+        if changes:
+            self.state.set_value(self.state_scope, f'{side}_watermark', str(max(int(change) for change in changes)))
+        return courses
+
+    def _reconcile_due(self) -> bool:
+        # has it been longer than reconcile_interval since the last full reconcile?
+        if self.reconcile_interval is None:
+            return False
+        last_reconcile = float(self.state.get_value(self.state_scope, 'last_reconcile', 0))
+        return time.time() - last_reconcile > self.reconcile_interval
+
+    @property
+    def comparator(self) -> CourseComparator:
+        # compiled from the target's fields_to_update, and again if those are changed.
+        if self._comparator is None or self._comparator.fields != tuple(self.target.fields_to_update):
+            self._comparator = CourseComparator(self.target.fields_to_update)
+        return self._comparator
+
+    def course_diff(self, moodle_course, source_course) -> CourseDiff:
+        """
+        Compare the source course and the moodle course.
+        :return: CourseDiff: the fields that differ.  True if the moodle course needs to be updated.
+        """
+        return self.comparator.compare(moodle_course, source_course)
 
     def course_update_needed(self, moodle_course, source_course) -> bool:
         """
@@ -160,32 +761,10 @@ class CourseSync:
         :param source_course: dict: course from source
         :return: bool: True if the moodle course needs to be updated.
         """
-        def htmldecode(s):
-            # hacky get it done fast replace HTML things.  Just used to detect changes.
-            if type(s) is str:
-                return s.replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"').replace(
-                '&#039;', "'")
-            return s
-
-        diffs = ""
-        for field in self.target.fields_to_update:
-            moodle_course_field_value = htmldecode(moodle_course.get(field, ''))
-            source_course_field_value = htmldecode(source_course.get(field, ''))
-            if field not in moodle_course:
-                logger.debug(f"Field {field} not in moodle course.")
-            elif field not in source_course:
-                logger.debug(f"Field {field} not in source course.")
-            elif moodle_course_field_value != source_course_field_value:
-                # if we don't care about the end date, don't update it if it changes.
-                if field == 'enddate' and 'automaticenddate' not in self.target.fields_to_update \
-                        and moodle_course.get('automaticenddate') == 1:
-                    # skip updating enddate if automaticenddate is off and automaticenddate not in the fields to update.
-                    pass
-                else:
-                    diffs = diffs + f"   moodle {field} was {moodle_course[field]} now {source_course[field]}\n"
-        if diffs:
-            logger.debug("Differences found: ", diffs)
-        return diffs != ""
+        diff = self.course_diff(moodle_course, source_course)
+        if diff:
+            logger.debug("Differences found: ", diff)
+        return bool(diff)
 
     def get_moodle_category_from_course(self, course, create=True):
         """
@@ -205,22 +784,99 @@ class CourseSync:
                                                       course.get(self.category_parent_name_key))
         return category_id
 
-    def sync_to_moodle(self, fetch='one'):
+    def get_moodle_snapshot(self, source_courses: List[Dict], fetch: str = 'scoped') -> CourseSnapshot:
         """
-        Sync courses from the source provider to Moodle.
-        :param fetch: one or all.  If all, then get all courses from moodle, otherwise each that matchs the source.
-        :return:
+        Prefetch the moodle courses that match the source courses.
+        :param source_courses: the courses from the source
+        :param fetch: all:  walk every course on the site, keeping the ones in the source.
+            scoped:  only get the courses in the categories the source courses go in.  A course that isn't found
+            there (say it was moved to another category) is looked up on its own by sync_to_moodle.
+            one:  don't prefetch.  The snapshot is empty.
+        :return: CourseSnapshot indexed on the course_key as well as the usual keys.
         """
-        source_courses = self.source.get_courses()
+        keys = (self.course_key,) + CourseSnapshot.default_keys
+        source_keys = {course[self.course_key] for course in source_courses}
         if fetch == 'all':
-            moodle_courses = self.target.get_courses()
+            # walk all the moodle courses as they arrive, and only keep the ones we have in the source.
+            return self.target.get_course_snapshot(keys=keys, keep=lambda c: c.get(self.course_key) in source_keys)
+        elif fetch == 'scoped':
+            category_ids = {self.get_moodle_category_from_course(course, create=False) for course in source_courses}
+            category_ids.discard(None)
+            logger.debug(f"Prefetching courses in {len(category_ids)} categories")
+            return self.target.get_course_snapshot(keys=keys, keep=lambda c: c.get(self.course_key) in source_keys,
+                                                   category_ids=sorted(category_ids))
         elif fetch == 'one':
-            moodle_courses = []  # evaluates to False
-        else:
-            raise ValueError("fetch must be one or all (lowercase).")
+            return CourseSnapshot(keys=keys)  # evaluates to False
+        raise ValueError("fetch must be one, scoped or all (lowercase).")
 
+    def sync_to_moodle(self, fetch='one', create_workers: int = 1, create_timeout: Optional[float] = None,
+                       on_create_progress: Optional[Callable[[int, int, Dict], None]] = None,
+                       reconcile: bool = False):
+        """
+        Sync courses from the source provider to Moodle.
+        :param fetch: one, scoped or all.  If all, then get all courses from moodle.
+            If scoped, get the moodle courses in the categories of the source courses.
+            If one, get each course that matches the source one at a time.  See get_moodle_snapshot.
+        :param create_workers: the number of new courses to create at once.  If more than 1, new courses are
+            created together after the other courses are checked.  See CourseCreateQueue.
+        :param create_timeout: seconds to wait for each new course when create_workers is more than 1.
+            See CourseCreateQueue.
+        :param on_create_progress: optional function called with (done, total, result) as each new course is made.
+        :param reconcile: with a state store, check every course even if its fingerprint hasn't changed.
+        :return: None.  The counts are logged.
+
+        fetch can also be incremental, which needs a state store.  Then the source and moodle courses come from
+        copies kept in the store, updated with just the courses that changed since the last run,
+        for the providers that have a change_column.  See get_courses_incrementally.  If moodle has no
+        change_column, the moodle courses for the changed source courses are fetched scoped instead.
+
+        With config.dryrun nothing is changed:  the sync is planned with the same fetch (see plan) and the plan
+        is logged.  Call plan yourself to get the CoursePlan.  fetch incremental can't be planned.
+        """
+        if fetch == 'incremental' and self.state is None:
+            raise ValueError("fetch incremental needs a state store.")
+        if config.dryrun:
+            logger.info("Dry run.  ", self.plan(fetch=fetch, reconcile=reconcile))
+            return
+        full_reconcile = self.state is None or reconcile or self._reconcile_due()
+
+        if fetch == 'incremental':
+            source_courses = self.get_courses_incrementally(self.source, 'source', full=full_reconcile)
+        else:
+            source_courses = self.source.get_courses()
         logger.info(f"Found  {len(source_courses)} courses in source.")
         cnt_created, cnt_updated, cnt_skipped, cnt_error = 0, 0, 0, 0
+
+        # fingerprints of the source courses, taken before the sync adds anything to the course dicts.
+        fingerprints = {course[self.course_key]: self.course_fingerprint(course) for course in source_courses} \
+            if self.state else {}
+        synced = []  # keys of the courses that synced without error.  Their fingerprints are stored at the end.
+        if not full_reconcile:
+            stored = self.state.get_fingerprints(self.state_scope)
+            changed = [course for course in source_courses
+                       if stored.get(str(course[self.course_key])) != fingerprints[course[self.course_key]]]
+            cnt_skipped += len(source_courses) - len(changed)
+            logger.info(f"{len(changed)} courses changed since the last sync.  Skipping the other "
+                        f"{len(source_courses) - len(changed)}.")
+            source_courses = changed
+
+        self.target.load_categories(refresh=True)  # one category fetch per run, if the target supports it.
+        if fetch == 'incremental' and self.target.change_column is None:
+            # no way to ask moodle what changed, so just get the moodle courses for the changed source courses.
+            moodle_courses = self.get_moodle_snapshot(source_courses, 'scoped')
+            fetch = 'scoped'
+        elif fetch == 'incremental':
+            source_keys = {course[self.course_key] for course in source_courses}
+            moodle_courses = CourseSnapshot(
+                (course for course in self.get_courses_incrementally(self.target, 'moodle', full=full_reconcile)
+                 if course.get(self.course_key) in source_keys),
+                keys=(self.course_key,) + CourseSnapshot.default_keys)
+            fetch = 'all'  # the snapshot has every moodle course we know of.
+        else:
+            moodle_courses = self.get_moodle_snapshot(source_courses, fetch)
+        to_update = []
+        create_queue = CourseCreateQueue(self.target, create_workers, create_timeout, on_create_progress) \
+            if create_workers > 1 else None
         for course in source_courses:
             action = 'what is it we are doing?'
             if True: #try:  # keep going after individual failures.
@@ -229,10 +885,8 @@ class CourseSync:
                 course['categoryid'] = category_id
 
                 # find moodle course
-                if fetch == 'all':
-                    moodle_course = next((c for c in moodle_courses if c[self.course_key] == course[self.course_key]),
-                                         None)
-                else:
+                moodle_course = moodle_courses.get(course[self.course_key], self.course_key)
+                if moodle_course is None and fetch != 'all':  # with all, a course not in the snapshot isn't in moodle.
                     logger.debug("Searching for ", course[self.course_key])
                     action = 'get course'
                     moodle_course = self.target.get_course(course[self.course_key])
@@ -241,23 +895,31 @@ class CourseSync:
                 if moodle_course is None:
                     logger.info("Creating ", course[self.course_key])
                     action = 'create course'
-                    self.target.create_course(course)
+                    # we just looked for it and resolved the category, so the provider doesn't need to.
+                    if create_queue is not None:
+                        create_queue.add(course, known_absent=True, category_id=category_id)
+                        continue
+                    new_course_id = self.target.create_course(course, **_supported_kwargs(
+                        self.target.create_course, {'known_absent': True, 'category_id': category_id}))
+                    if new_course_id:
+                        moodle_courses.add(dict(course, id=new_course_id))
                     cnt_created += 1
+                    synced.append(course[self.course_key])
                     #print("course.py sync_to_moodle BREAKING!  Created a course!  Check it out.")
                     #break
                 else:
                     action = 'determine update needed'
                     if self.course_update_needed(moodle_course, course):
                         logger.info("Updating ", course[self.course_key])
-                        action = 'update course'
-                        self.target.update_course(course)
-                        cnt_updated += 1
+                        # updates are sent together after the loop.
+                        to_update.append((course, moodle_course.get('id')))
                         #if course['enddate'] < 1730338814:
                         #    print("course.py sync_to_moodle BREAKING!  Updated a semester course  Check it out.", moodle_course['id'])
                         #    break
                     else:
                         logger.info("No update needed for ", course[self.course_key])
                         cnt_skipped += 1
+                        synced.append(course[self.course_key])
             try:
                 pass
             except Exception as e:
@@ -266,5 +928,149 @@ class CourseSync:
                 print("ERROR on something!  BREAK")
                 break
             pass  # end for course in source_courses
+
+        if create_queue:
+            logger.info(f"Creating {len(create_queue)} courses, {create_workers} at a time.")
+            for result in create_queue.run():
+                if result['ok']:
+                    cnt_created += 1
+                    synced.append(result['course'][self.course_key])
+                    if result['id']:
+                        moodle_courses.add(dict(result['course'], id=result['id']))
+                else:
+                    cnt_error += 1
+
+        if to_update:
+            results = self.target.update_courses([course for course, _ in to_update],
+                                                 course_ids=[course_id for _, course_id in to_update])
+            cnt_updated += sum(1 for result in results if result['ok'])
+            cnt_error += sum(1 for result in results if not result['ok'])
+            synced.extend(result['course'][self.course_key] for result in results if result['ok'])
+
+        if self.state and not config.dryrun:
+            self.state.set_fingerprints(self.state_scope, {key: fingerprints[key] for key in synced})
+            if full_reconcile and cnt_error == 0:
+                self.state.set_value(self.state_scope, 'last_reconcile', str(time.time()))
         logger.info(f"Created {cnt_created}, Updated {cnt_updated}, Skipped {cnt_skipped}, Errors {cnt_error}")
         return
+
+    def plan(self, fetch: str = 'all', reconcile: bool = False) -> CoursePlan:
+        """
+        Work out what sync_to_moodle would do, without changing anything.
+        The moodle courses and categories are read in bulk, so planning is quick even for a whole term.
+        :param fetch: all, scoped or one.  See get_moodle_snapshot.  With scoped or one, a course that wasn't
+            prefetched is looked up on its own.  incremental can't be planned:  reading the changes moves the
+            watermarks in the state store, so the real sync would miss them.
+        :param reconcile: with a state store, plan every course even if its fingerprint hasn't changed.
+        :return: CoursePlan.  Run it with apply_plan.
+        """
+        if fetch not in ('all', 'scoped', 'one'):
+            raise ValueError("fetch must be all, scoped or one (lowercase) to plan.")
+        plan = CoursePlan(course_key=self.course_key)
+        source_courses = self.source.get_courses()
+        logger.info(f"Found  {len(source_courses)} courses in source.")
+
+        fingerprints = {course[self.course_key]: self.course_fingerprint(course) for course in source_courses} \
+            if self.state else {}
+        if self.state and not (reconcile or self._reconcile_due()):
+            stored = self.state.get_fingerprints(self.state_scope)
+            changed = []
+            for course in source_courses:
+                if stored.get(str(course[self.course_key])) == fingerprints[course[self.course_key]]:
+                    plan.skips.append({'key': course[self.course_key], 'reason': 'unchanged since the last sync'})
+                else:
+                    changed.append(course)
+            source_courses = changed
+
+        self.target.load_categories(refresh=True)
+        moodle_courses = self.get_moodle_snapshot(source_courses, fetch)
+        new_categories = set()
+        for course in source_courses:
+            key = course[self.course_key]
+            category_id = self.get_moodle_category_from_course(course, create=False)
+            if category_id is None:
+                category = (course[self.category_name_key], course.get(self.category_parent_name_key))
+                if category not in new_categories:
+                    new_categories.add(category)
+                    plan.categories.append({'name': category[0], 'parent': category[1]})
+            course = dict(course, categoryid=category_id)  # don't change the source's course.
+
+            moodle_course = moodle_courses.get(key, self.course_key)
+            if moodle_course is None and fetch != 'all':
+                moodle_course = self.target.get_course(key)
+            entry = {'fingerprint': fingerprints[key]} if self.state else {}
+            if moodle_course is None:
+                plan.creates.append(dict(entry, key=key, course=course, categoryid=category_id))
+                continue
+            diff = self.course_diff(moodle_course, course)
+            if diff:
+                plan.updates.append(dict(entry, key=key, id=moodle_course.get('id'), course=course,
+                                         changes=[list(change) for change in diff.changes]))
+            else:
+                plan.skips.append({'key': key, 'reason': 'up to date'})
+                if self.state:
+                    # nothing to do, but it is in sync.  apply_plan stores its fingerprint.
+                    plan.skips[-1]['fingerprint'] = fingerprints[key]
+        logger.info(plan.summary())
+        return plan
+
+    def apply_plan(self, plan: CoursePlan, create_workers: int = 1, create_timeout: Optional[float] = None,
+                   on_create_progress: Optional[Callable[[int, int, Dict], None]] = None) -> Dict[str, int]:
+        """
+        Make the changes in a plan from plan():  create the categories, send the updates together
+        with update_courses, then create the courses with a CourseCreateQueue.
+        Moodle isn't checked again, so apply a plan soon after making it.
+        :param plan: CoursePlan
+        :param create_workers: the number of new courses to create at once.
+        :param create_timeout: seconds to wait for each new course.  See CourseCreateQueue.
+        :param on_create_progress: optional function called with (done, total, result) as each new course is made.
+        :return: dict with the number of courses created, updated, skipped, and errors.
+        """
+        if plan.course_key != self.course_key:
+            raise ValueError(f"The plan is keyed on {plan.course_key}, not {self.course_key}.")
+        cnt_created, cnt_updated, cnt_error = 0, 0, 0
+        synced = {skip['key']: skip['fingerprint'] for skip in plan.skips if 'fingerprint' in skip}
+
+        category_ids = {}
+        for category in plan.categories:
+            category_ids[(category['name'], category['parent'])] = \
+                self.target.create_category(category['name'], category['parent'])
+
+        def category_id(entry: Dict) -> Optional[int]:
+            # the planned category, or the one the plan created for the course.
+            if entry['course'].get('categoryid') is not None:
+                return entry['course']['categoryid']
+            return category_ids.get((entry['course'].get(self.category_name_key),
+                                     entry['course'].get(self.category_parent_name_key)))
+
+        if plan.updates:
+            courses = [dict(update['course'], categoryid=category_id(update)) for update in plan.updates]
+            results = self.target.update_courses(courses, course_ids=[update['id'] for update in plan.updates])
+            for update, result in zip(plan.updates, results):
+                if result['ok']:
+                    cnt_updated += 1
+                    if 'fingerprint' in update:
+                        synced[update['key']] = update['fingerprint']
+                else:
+                    cnt_error += 1
+
+        if plan.creates:
+            create_queue = CourseCreateQueue(self.target, create_workers, create_timeout, on_create_progress)
+            for create in plan.creates:
+                new_category_id = category_id(create)
+                create_queue.add(dict(create['course'], categoryid=new_category_id),
+                                 known_absent=True, category_id=new_category_id)
+            logger.info(f"Creating {len(create_queue)} courses, {create_workers} at a time.")
+            for create, result in zip(plan.creates, create_queue.run()):
+                if result['ok']:
+                    cnt_created += 1
+                    if 'fingerprint' in create:
+                        synced[create['key']] = create['fingerprint']
+                else:
+                    cnt_error += 1
+
+        if self.state and not config.dryrun:
+            self.state.set_fingerprints(self.state_scope, synced)
+        counts = {'created': cnt_created, 'updated': cnt_updated, 'skipped': len(plan.skips), 'errors': cnt_error}
+        logger.info(f"Created {cnt_created}, Updated {cnt_updated}, Skipped {len(plan.skips)}, Errors {cnt_error}")
+        return counts
@@ -1,5 +1,7 @@
 # file: moodle_sync/enrolment.py
-from typing import List, Dict, Callable, Union, Set
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable, Union, Set, Iterable, Optional
 
 from moodle_sync.config import config
 from moodle_sync.logger import logger
@@ -98,6 +100,22 @@ class MoodleEnrolmentProvider:
         raise RuntimeError('Not Implemented. Derived Class needs get_username.')
         pass
 
+    def prefetch_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> None:
+        """
+        Optional.  Look up all these users ahead of time so that get_user_id and get_username
+        can answer from a cache.  Providers that have nothing to gain can leave this alone.
+        :param emails_usernames_or_ids: usernames, emails, or user ids about to be used.
+        """
+        pass
+
+    def prefetch_rosters(self, courses: Iterable[Union[str, int]]) -> None:
+        """
+        Optional.  Load the enrolments for all these courses ahead of time so that get_enroled_users
+        can answer from memory.  Providers that have nothing to gain can leave this alone.
+        :param courses: course shortnames or ids about to be synced.
+        """
+        pass
+
     def get_role_id(self, role: str) -> Union[None, int]:
         """
         Return the role id for a role name.
@@ -181,6 +199,33 @@ class MoodleEnrolmentProvider:
         """
         pass
 
+    def course_unenrol_users(self, unenrolments: List[Dict]) -> List[Union[None, Dict]]:
+        """
+        Unenrol many users from roles.  This calls course_unenrol_user for each one;
+        override it if the provider can do it in bulk.
+        :param unenrolments: list of dicts with user, course, and role
+        :return: list of the course_unenrol_user results, in the same order.
+        """
+        return [self.course_unenrol_user(unenrolment['user'], unenrolment['course'], unenrolment['role'])
+                for unenrolment in unenrolments]
+
+    def course_delete_users(self, user_ids: List[int], course_id: int) -> List[Union[None, Dict]]:
+        """
+        Delete many users from a course.  This calls course_delete_user for each one;
+        override it if the provider can do it in bulk.
+        :param user_ids: list of user ids
+        :param course_id: int: The course id.
+        :return: list of the course_delete_user results, in the same order.
+        """
+        return [self.course_delete_user(user_id, course_id) for user_id in user_ids]
+
+    def flush(self) -> List[Dict]:
+        """
+        Send any writes the provider has queued up.  Providers that write immediately have nothing to send.
+        :return: list of dicts with item, ok (bool) and error (str or None) for each queued write.
+        """
+        return []
+
 
 class EnrolmentSync:
     def __init__(self, target: MoodleEnrolmentProvider, source: MoodleEnrolmentProvider):
@@ -188,6 +233,9 @@ class EnrolmentSync:
         self.source = source
         self.roles_to_add = ['student', 'editingteacher']
         self.roles_to_remove = ['student']  # don't by default remove teachers - they may be manually added.
+        # the count each write was added to, so a queued write that fails at flush() can be taken back out.
+        self._write_counts: Dict[tuple, str] = {}
+        self._write_counts_lock = threading.Lock()
 
     def sync_users(self):
         """
@@ -196,7 +244,7 @@ class EnrolmentSync:
         :return:
         """
 
-    def sync_to_moodle(self):
+    def sync_to_moodle(self, workers: int = 1):
         """
 
         Suggestion for sync:
@@ -208,103 +256,216 @@ class EnrolmentSync:
         The source enrollment provider provides the shortname (used as the course_id by default), username, and role.
         Those have to be mapped to the moodle course_id, user_id, and role_id.
 
+        Courses are independent of each other, so with workers > 1 they are synced in a thread pool.
+        The counts are added up from each course, so the totals match a serial run.
+
+        :param workers: int: number of courses to sync at the same time.
         """
         source_courses = self.source.get_course_shortnames_for_sync()
         logger.info(f"Found {len(source_courses)} courses to sync enrollments.")
+        # load the moodle rosters for every course at once, if the target can.
+        self.target.prefetch_rosters(source_courses)
 
-        cnt_added, cnt_deleted, cnt_updated, cnt_error, cnt_unenrolled = 0, 0, 0, 0, 0
+        counts = {'added': 0, 'deleted': 0, 'updated': 0, 'error': 0, 'unenrolled': 0}
+        self._write_counts = {}
         logger.info(f"Syncing enrollments for {len(source_courses)} courses.")
-        for source_shortname in source_courses:
-            if True: # try:
-                course_id = self.target.get_course_id(source_shortname)
-                logger.info(f"Syncing enrollments for course: {source_shortname} id {course_id}")
-
-                if course_id is None:
-                    logger.error(f"  Course not found in Moodle: {source_shortname}")
-                    continue
-
-                source_enrollments = self.source.get_enroled_users(source_shortname)
-                moodle_enrollments = self.target.get_enroled_users(course_id)
-                logger.info(f"  Found {len(source_enrollments)} source enrollments"
-                            f" and {len(moodle_enrollments)} Moodle enrollments for course: {source_shortname}")
-                if self.source.cancelled(source_shortname):
-                    # Remove all users from the cancelled course
-                    logger.info(f"  Removing all users from cancelled course: {source_shortname}")
-                    for enrollment in moodle_enrollments:
-                        logger.info(f"***  Removing user {enrollment['username']} from cancelled course {source_shortname}")
-                        self.target.course_delete_user(enrollment['user_id'], course_id)
-                    logger.info(f"Removed all users from cancelled course: {source_shortname}")
-                else:
-                    # push source to moodle:
-                    for source_enrollment in source_enrollments:
-                        user_id: int = self.target.get_user_id(source_enrollment['username'])
-                        role_id: int = self.target.get_role_id(source_enrollment['role'])
-                        if user_id is None:
-                            logger.info(f"*** User not found: {source_enrollment['username']}")
-                            continue
-                        if role_id is None:
-                            logger.info(f"*** role not found: {source_enrollment['role']}")
-                            continue
-
-                        # moodle_enrollment = next((e for e in moodle_enrollments if e['user_id'] == user_id), None)
-                        moodle_user_roles = [e['role_id'] for e in moodle_enrollments if e['user_id'] == user_id]
-                        if role_id not in moodle_user_roles:
-                            # Add new enrollment
-                            logger.info(f"-- Adding user {source_enrollment['username']} role {role_id} to course {source_shortname}. Existing roles: {moodle_user_roles}")
-                            self.target.course_enrol_user(user_id, course_id, role_id)
-                            if not moodle_user_roles:
-                                cnt_added += 1
-                            else:
-                                cnt_updated += 1
-                        else:
-                            # logger.debug(f"      ___ user  {source_enrollment['username']} already in role {role_id} to course {source_shortname}")
-                            pass
-                        # elif moodle_enrollment['role_id'] != role_id:
-                        #     # Update role
-                        #     # logger.info(f"Updating role for user {source_enrollment['username']} in course {source_shortname}")
-                        #     # if self.moodle.rolename_for_id(moodle_enrollment['role_id']) in self.roles_to_remove:
-                        #     #     logger.info(f"Removing user {source_enrollment['username']} from course {source_shortname}")
-                        #     #     self.moodle.course_unenrol_user(user_id, course_id, moodle_enrollment['role_id'])
-                        #     #
-                        #     # self.moodle.course_unenrol_user(user_id, course_id,  moodle_enrollment['role_id'])
-                        #     logger.info(
-                        #         f"-- Adding user {source_enrollment['username']} role {role_id} to course {source_shortname} -.")
-                        #
-                        #     self.moodle.course_enrol_user(user_id, course_id, role_id)
-                        #     cnt_updated += 1
-
-                    # Remove enrollments that are in Moodle but not in the source unless they're not in roles_to_remove
-                    for moodle_enrollment in moodle_enrollments:
-                        user_id = moodle_enrollment['user_id']
-                        course_id = moodle_enrollment['course_id']
-                        role_id = moodle_enrollment['role_id']
-                        if role_id > 0 and self.target.rolename_for_id(role_id) not in self.roles_to_remove:
-                            continue
-                        username = self.target.get_username(user_id)
-                        user_in_source_course = any(e['username'] == username for e in source_enrollments)
-                        if not user_in_source_course:
-                            # the user was never in the course at all.  Remove them.
-                            if self.target.delete_unenroled_users or not source_enrollment['started']:
-                                logger.info(f"-- Deleting user {username} from course {source_shortname} - not in source."
-                                            f"started? {'Yes' if source_enrollment['started'] else 'No'}")
-                                self.target.course_unenrol_user(user_id, course_id, role_id)
-                                self.target.course_delete_user(user_id, course_id)
-                                cnt_deleted += 1
-                            else:
-                                logger.info(f"-- Unenrolling user {username} from course {source_shortname} - not in source.")
-                                self.target.course_unenrol_user(moodle_enrollment['user_id'], course_id, moodle_enrollment['role_id'])
-                                cnt_unenrolled += 1
-                    # for step through enrollments for course
-
-
-            if False: #except Exception as e:
-                logger.info(f"Error syncing enrollments for course {course_shortname}: {str(e)}")
-                cnt_error += 1
+        if workers > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                course_counts = list(executor.map(self._sync_course, source_courses))
+        else:
+            course_counts = [self._sync_course(source_shortname) for source_shortname in source_courses]
+        for course_count in course_counts:
+            for key, value in course_count.items():
+                counts[key] += value
+
+        # send anything the target queued up.
+        failed_writes = [result for result in self.target.flush() if not result['ok']]
+        for result in failed_writes:
+            logger.error(f"  Write failed for {result['item']}: {result['error']}")
+            # it was counted as done when it was queued.  Count it as an error instead.
+            for count_key in self._uncount_write(result['item']):
+                counts[count_key] -= 1
+        counts['error'] += len(failed_writes)
 
         logger.info(
-            f"Enrollment sync complete. Added: {cnt_added}, Unenrolled: {cnt_unenrolled}, Deleted: {cnt_deleted}"
-            f" Updated: {cnt_updated}, Errors: {cnt_error}")
+            f"Enrollment sync complete. Added: {counts['added']}, Unenrolled: {counts['unenrolled']},"
+            f" Deleted: {counts['deleted']} Updated: {counts['updated']}, Errors: {counts['error']}")
+        return counts
+
+    def _count_write(self, key: tuple, count_key: str) -> None:
+        # remember which count a write went in to.  See _uncount_write.
+        with self._write_counts_lock:
+            self._write_counts[key] = count_key
 
+    def _uncount_write(self, item: Dict) -> List[str]:
+        """
+        Find the counts a failed write was added to, and forget them so they are only taken back once.
+        :param item: the item of a failed write from flush():  an enrolment (roleid, userid, courseid),
+            a role unassignment (roleid, userid, instanceid), or an unenrolment (userid, courseid).
+        :return: the count keys to take one off of each.
+        """
+        with self._write_counts_lock:
+            if 'instanceid' in item:
+                keys = [('unassign', item['userid'], item['instanceid'], item['roleid'])]
+            elif 'roleid' in item:
+                keys = [('enrol', item['userid'], item['courseid'], item['roleid'])]
+            else:
+                # the user is still in the course, so none of their roles there were deleted.
+                keys = [key for key, count_key in self._write_counts.items()
+                        if key[0] == 'unassign' and key[1:3] == (item['userid'], item['courseid'])
+                        and count_key == 'deleted']
+            return [count_key for count_key in (self._write_counts.pop(key, None) for key in keys) if count_key]
+
+    def _failed_removals(self, items: List[Dict], results: List[Optional[Dict]]) -> tuple:
+        """
+        Find the unenrolments or deletions the target didn't make, log them, and forget their counts.
+        :param items: the writes, as _uncount_write takes them
+        :param results: the course_unenrol_users or course_delete_users results, in the same order.
+            A result with an error, or that removed nothing, failed.  None means there was nothing to remove.
+            A deletion is judged by its participations, since the roles may already have been unassigned.
+        :return: tuple of the number that failed, and the count keys to take one off of each.
+        """
+        failed, count_keys = 0, []
+        for item, result in zip(items, results):
+            if result is None:
+                continue
+            removed = result.get('num_participations_deleted', result.get('num_roles_deleted', 1))
+            if removed and not result.get('error'):
+                continue
+            logger.error(f"  Removal failed for {item}: {result.get('error', 'nothing was removed')}")
+            failed += 1
+            count_keys += self._uncount_write(item)
+        return failed, count_keys
+
+    def _sync_course(self, source_shortname: str) -> Dict[str, int]:
+        """
+        Sync the enrolments for one course.
+        :param source_shortname: the shortname of the course in the source
+        :return: dict of the counts for this course: added, deleted, updated, error, unenrolled
+        """
+        cnt_added, cnt_deleted, cnt_updated, cnt_error, cnt_unenrolled = 0, 0, 0, 0, 0
+        if True: # try:
+            course_id = self.target.get_course_id(source_shortname)
+            logger.info(f"Syncing enrollments for course: {source_shortname} id {course_id}")
+
+            if course_id is None:
+                logger.error(f"  Course not found in Moodle: {source_shortname}")
+                return {}
+
+            source_enrollments = self.source.get_enroled_users(source_shortname)
+            moodle_enrollments = self.target.get_enroled_users(course_id)
+            # resolve everyone this course touches in bulk rather than one lookup per user.
+            self.target.prefetch_users([e['username'] for e in source_enrollments] +
+                                       [e['user_id'] for e in moodle_enrollments])
+            logger.info(f"  Found {len(source_enrollments)} source enrollments"
+                        f" and {len(moodle_enrollments)} Moodle enrollments for course: {source_shortname}")
+            if self.source.cancelled(source_shortname):
+                # Remove all users from the cancelled course
+                logger.info(f"  Removing all users from cancelled course: {source_shortname}")
+                for enrollment in moodle_enrollments:
+                    logger.info(f"***  Removing user {enrollment['username']} from cancelled course {source_shortname}")
+                # one row per role, so a user can show up more than once.
+                user_ids = list(dict.fromkeys(enrollment['user_id'] for enrollment in moodle_enrollments))
+                results = self.target.course_delete_users(user_ids, course_id)
+                failed, _ = self._failed_removals([{'userid': user_id, 'courseid': course_id} for user_id in user_ids],
+                                                  results)
+                cnt_error += failed
+                logger.info(f"Removed all users from cancelled course: {source_shortname}")
+            else:
+                # push source to moodle:
+                for source_enrollment in source_enrollments:
+                    user_id: int = self.target.get_user_id(source_enrollment['username'])
+                    role_id: int = self.target.get_role_id(source_enrollment['role'])
+                    if user_id is None:
+                        logger.info(f"*** User not found: {source_enrollment['username']}")
+                        continue
+                    if role_id is None:
+                        logger.info(f"*** role not found: {source_enrollment['role']}")
+                        continue
+
+                    # moodle_enrollment = next((e for e in moodle_enrollments if e['user_id'] == user_id), None)
+                    moodle_user_roles = [e['role_id'] for e in moodle_enrollments if e['user_id'] == user_id]
+                    if role_id not in moodle_user_roles:
+                        # Add new enrollment
+                        logger.info(f"-- Adding user {source_enrollment['username']} role {role_id} to course {source_shortname}. Existing roles: {moodle_user_roles}")
+                        self.target.course_enrol_user(user_id, course_id, role_id)
+                        if not moodle_user_roles:
+                            cnt_added += 1
+                        else:
+                            cnt_updated += 1
+                        self._count_write(('enrol', user_id, course_id, role_id),
+                                          'updated' if moodle_user_roles else 'added')
+                    else:
+                        # logger.debug(f"      ___ user  {source_enrollment['username']} already in role {role_id} to course {source_shortname}")
+                        pass
+                    # elif moodle_enrollment['role_id'] != role_id:
+                    #     # Update role
+                    #     # logger.info(f"Updating role for user {source_enrollment['username']} in course {source_shortname}")
+                    #     # if self.moodle.rolename_for_id(moodle_enrollment['role_id']) in self.roles_to_remove:
+                    #     #     logger.info(f"Removing user {source_enrollment['username']} from course {source_shortname}")
+                    #     #     self.moodle.course_unenrol_user(user_id, course_id, moodle_enrollment['role_id'])
+                    #     #
+                    #     # self.moodle.course_unenrol_user(user_id, course_id,  moodle_enrollment['role_id'])
+                    #     logger.info(
+                    #         f"-- Adding user {source_enrollment['username']} role {role_id} to course {source_shortname} -.")
+                    #
+                    #     self.moodle.course_enrol_user(user_id, course_id, role_id)
+                    #     cnt_updated += 1
+
+                # Remove enrollments that are in Moodle but not in the source unless they're not in roles_to_remove
+                # These are collected and removed in bulk: roles are unassigned first, then enrolments deleted.
+                to_unenrol, to_delete = [], []
+                source_usernames = {e['username'] for e in source_enrollments}
+                for moodle_enrollment in moodle_enrollments:
+                    user_id = moodle_enrollment['user_id']
+                    course_id = moodle_enrollment['course_id']
+                    role_id = moodle_enrollment['role_id']
+                    if role_id > 0 and self.target.rolename_for_id(role_id) not in self.roles_to_remove:
+                        continue
+                    username = self.target.get_username(user_id)
+                    user_in_source_course = username in source_usernames
+                    if not user_in_source_course:
+                        # the user was never in the course at all.  Remove them.
+                        if self.target.delete_unenroled_users or not source_enrollment['started']:
+                            logger.info(f"-- Deleting user {username} from course {source_shortname} - not in source."
+                                        f"started? {'Yes' if source_enrollment['started'] else 'No'}")
+                            to_unenrol.append({'user': user_id, 'course': course_id, 'role': role_id})
+                            to_delete.append(user_id)
+                            cnt_deleted += 1
+                            self._count_write(('unassign', user_id, course_id, role_id), 'deleted')
+                        else:
+                            logger.info(f"-- Unenrolling user {username} from course {source_shortname} - not in source.")
+                            to_unenrol.append({'user': moodle_enrollment['user_id'], 'course': course_id,
+                                               'role': moodle_enrollment['role_id']})
+                            cnt_unenrolled += 1
+                            self._count_write(('unassign', user_id, course_id, role_id), 'unenrolled')
+                # for step through enrollments for course
+                # take anything the target couldn't remove back out of the counts, and count it as an error.
+                failed_count_keys = []
+                if to_unenrol:
+                    results = self.target.course_unenrol_users(to_unenrol)
+                    failed, count_keys = self._failed_removals(
+                        [{'userid': unenrolment['user'], 'instanceid': unenrolment['course'],
+                          'roleid': unenrolment['role']} for unenrolment in to_unenrol], results)
+                    cnt_error += failed
+                    failed_count_keys += count_keys
+                if to_delete:
+                    user_ids = list(dict.fromkeys(to_delete))
+                    results = self.target.course_delete_users(user_ids, course_id)
+                    failed, count_keys = self._failed_removals(
+                        [{'userid': user_id, 'courseid': course_id} for user_id in user_ids], results)
+                    cnt_error += failed
+                    failed_count_keys += count_keys
+                cnt_deleted -= failed_count_keys.count('deleted')
+                cnt_unenrolled -= failed_count_keys.count('unenrolled')
+
+
+        if False: #except Exception as e:
+            logger.info(f"Error syncing enrollments for course {course_shortname}: {str(e)}")
+            cnt_error += 1
+
+        return {'added': cnt_added, 'deleted': cnt_deleted, 'updated': cnt_updated, 'error': cnt_error,
+                'unenrolled': cnt_unenrolled}
 
 
 
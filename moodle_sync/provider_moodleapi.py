@@ -1,11 +1,12 @@
 # file: moodle_sync/provider_moodleapi.py
 
-import requests, json, re
-from typing import Union, Any, Dict, List
+import requests, json, re, threading, time, random, copy, codecs
+from urllib.parse import urlencode
+from typing import Union, Any, Dict, List, Iterable, Iterator, Generator
 
 from moodle_sync.config import config
 from moodle_sync.logger import logger
-from moodle_sync.course import MoodleCourseProvider
+from moodle_sync.course import MoodleCourseProvider, CategoryIndex
 from moodle_sync.enrolment import MoodleEnrolmentProvider
 from moodle_sync.user import MoodleUserProvider
 
@@ -20,49 +21,71 @@ and this is not a standard Moodle API function.  You can redefine your roles man
 """
 
 from requests.adapters import HTTPAdapter
-import urllib3.util.connection
+import urllib3
 import urllib3.connection
 import requests
 from typing import Optional
 
 
+def _pinned_pool_classes(ip_address: str) -> dict:
+    """
+    Build connection pool classes whose connections open their socket to ip_address.
+
+    Only the socket address changes: the Host header, SNI and certificate checks all still use the hostname
+    from the URL.  The classes are built per adapter so two sites pinned to different addresses (or anyone
+    else using urllib3 in the same process) never see each other's override.
+
+    :param ip_address: the address to connect to
+    :return: a pool_classes_by_scheme mapping for a urllib3 PoolManager
+    """
+    def pinned(connection_class):
+        class PinnedConnection(connection_class):
+            def _new_conn(self):
+                dns_host = self._dns_host
+                try:
+                    # _new_conn resolves _dns_host; point it at the IP just for the socket and put the name back
+                    # so that everything after the connect sees the real hostname.
+                    self._dns_host = ip_address
+                    return super()._new_conn()
+                finally:
+                    self._dns_host = dns_host
+        return PinnedConnection
+
+    class PinnedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+        ConnectionCls = pinned(urllib3.connection.HTTPConnection)
+
+    class PinnedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+        ConnectionCls = pinned(urllib3.connection.HTTPSConnection)
+
+    return {'http': PinnedHTTPConnectionPool, 'https': PinnedHTTPSConnectionPool}
+
+
 class CustomDNSAdapter(HTTPAdapter):
     def __init__(self, ip_address: Optional[str] = None, *args, **kwargs):
         self.ip_address = ip_address
         super().__init__(*args, **kwargs)
 
     def init_poolmanager(self, *args, **kwargs):
-        # Save the original create_connection function
-        self._original_create_connection = urllib3.connection.HTTPConnection.create_connection
-
-        if self.ip_address is not None:
-            # Override the create_connection with our custom one only if ip_address is specified
-            def patched_create_connection(address, *args, **kwargs):
-                host, port = address
-                return urllib3.util.connection.create_connection((self.ip_address, port), *args, **kwargs)
-
-            urllib3.connection.HTTPConnection.create_connection = patched_create_connection
-
-        # Call parent's init_poolmanager
         super().init_poolmanager(*args, **kwargs)
-
-    def close(self):
-        # Restore the original create_connection when done
         if self.ip_address is not None:
-            urllib3.connection.HTTPConnection.create_connection = self._original_create_connection
-        super().close()
+            # connect to our IP only for the pools this adapter owns - urllib3's module-level create_connection is
+            # shared by the whole process, so it is left alone.
+            self.poolmanager.pool_classes_by_scheme = _pinned_pool_classes(self.ip_address)
 
 
 class CustomDNSSession:
-    def __init__(self, ip_address: Optional[str] = None):
+    def __init__(self, ip_address: Optional[str] = None, pool_size: int = 10):
         """
         Initialize a session with optional custom DNS resolution
 
         Args:
             ip_address (str, optional): The IP address to connect to. If None, uses regular DNS resolution.
+            pool_size (int, optional): The number of keep-alive connections to hold open per host.
         """
         self.session = requests.Session()
-        self.adapter = CustomDNSAdapter(ip_address)
+        # ask for compressed responses.  Moodle's JSON compresses very well, and gzip and deflate are always supported.
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        self.adapter = CustomDNSAdapter(ip_address, pool_connections=pool_size, pool_maxsize=pool_size)
         self.session.mount('http://', self.adapter)
         self.session.mount('https://', self.adapter)
 
@@ -100,8 +123,216 @@ class CustomDNSSession:
         """Convenience method for POST requests"""
         return self.request('post', url, **kwargs)
 
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Count the requests made and the connections opened by the pools in this session.
+        Every request beyond the first on a connection reused a kept-alive connection (no new TCP/TLS handshake).
+        :return: dict with requests, connections, and reused counts
+        """
+        pools = self.adapter.poolmanager.pools
+        num_requests, num_connections = 0, 0
+        for pool_key in pools.keys():  # the pool container does not allow iterating over it directly.
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            num_requests += pool.num_requests
+            num_connections += pool.num_connections
+        return {'requests': num_requests, 'connections': num_connections,
+                'reused': max(num_requests - num_connections, 0)}
+
+
+
+
+class MoodleAPIError(requests.exceptions.HTTPError):
+    """
+    Moodle answered, but with an exception - like invalidparameter or a missing capability - instead of the data.
+    The call reached the site and Moodle rejected what was sent, so sending it again won't help.
+    """
+    pass
+
+
+def iter_json_array(chunks: Iterable[bytes], key: Optional[str] = None) -> Generator[Any, None, Any]:
+    """
+    Decode a JSON list from chunks of UTF-8 bytes, yielding each item as soon as it has arrived.
+    Only the item being decoded is held in memory, never the whole document.
+
+    :param chunks: the bytes of a JSON document, in pieces of any size.
+    :param key: None if the document is a list.  Otherwise the document is a dict and this is the key of the list in it.
+        The other values in the dict are skipped.
+    :return: (the generator's return value) None if the list was found.  If the document turns out to be
+        something else - like a Moodle exception - nothing is yielded and the whole decoded document is returned.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer, pos, finished = '', 0, False
+    keep = None  # while looking for the key, keep the document from here in case it has to be decoded whole.
+
+    def more() -> bool:
+        # read the next chunk in to the buffer, dropping what has been used.
+        nonlocal buffer, pos, finished, keep
+        if finished:
+            return False
+        chunk = next(chunks, None)
+        cut = pos if keep is None else keep
+        if chunk is None:
+            finished = True
+            buffer = buffer[cut:] + utf8.decode(b'', final=True)
+        else:
+            buffer = buffer[cut:] + utf8.decode(chunk)
+        pos -= cut
+        keep = None if keep is None else 0
+        return True
+
+    def skip_whitespace() -> Optional[str]:
+        # move past whitespace and return the next character, or None at the end of the document.
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buffer):
+                return buffer[pos]
+            if not more():
+                return None
+
+    def value() -> Any:
+        # decode the next whole value, reading more chunks until it is complete.
+        nonlocal pos
+        skip_whitespace()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if more():
+                    continue
+                raise
+            if not isinstance(item, (dict, list, str)) and (end == len(buffer) or buffer[end] not in ',]} \t\r\n') \
+                    and more():
+                continue  # a number might continue in the next chunk.
+            pos = end
+            return item
+
+    def rest() -> Any:
+        # the document isn't what we wanted. Decode it whole and hand it back.
+        nonlocal pos
+        if keep is not None:
+            pos = keep
+        while more():
+            pass
+        return json.loads(buffer[pos:])
+
+    first = skip_whitespace()
+    if key is not None:
+        if first != '{':
+            return rest()
+        keep = pos
+        pos += 1
+        while True:
+            char = skip_whitespace()
+            if char == ',':
+                pos += 1
+                continue
+            if char != '"':
+                return rest()  # an empty dict, or no list under key
+            name = value()
+            if skip_whitespace() != ':':
+                raise json.JSONDecodeError("Expecting ':' delimiter", buffer, pos)
+            pos += 1
+            if name == key and skip_whitespace() == '[':
+                keep = None
+                break
+            if name == key:
+                return rest()
+            value()  # skip the values we don't want.  They're small next to the list.
+    elif first != '[':
+        return rest()
+
+    pos += 1  # past the [
+    while True:
+        char = skip_whitespace()
+        if char is None:
+            raise json.JSONDecodeError("Unterminated list", buffer, pos)
+        if char == ']':
+            break
+        if char == ',':
+            pos += 1
+            continue
+        yield value()
+    # the rest of the document (moodle warnings) is not needed.  Drain it so the connection can be reused.
+    for _ in chunks:
+        pass
+    return None
+
+
+class MoodleAPIRateLimiter:
+    """
+    A token bucket that paces the calls made to one Moodle site.
+
+    Each call takes a token.  Tokens come back at `rate` per second, and up to `burst` can be saved up.
+    The rate adapts to how the site is coping:  when a call takes longer than target_latency, or the site says it
+    is overloaded (429/502/503 or a timeout), the rate is cut in half.  Only record() calls that are normally quick -
+    MoodleAPI leaves out writes and the calls in its slow_functions.  Each quick call gives a little back
+    until max_rate is reached again.  So a busy site gets room to serve its interactive users,
+    and a quiet one gets the full rate.
+
+    reserve() takes a token and tells you how long to wait before using it, so the same limiter works for
+    blocking code (acquire()) and the asyncio client (await asyncio.sleep(limiter.reserve())).
+    """
+
+    def __init__(self, rate: float = 20.0, burst: int = 10, min_rate: float = 1.0, target_latency: float = 2.0):
+        """
+        :param rate: the most calls per second to make.
+        :param burst: the number of calls that can go out at once after a quiet spell.
+        :param min_rate: never slow down below this many calls per second.
+        :param target_latency: seconds.  Calls slower than this slow the rate down.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.target_latency = target_latency
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token.
+        :return: the number of seconds to wait before making the call.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        """
+        Wait until a call can be made.
+        """
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
 
+    def record(self, latency: float) -> None:
+        """
+        Adjust the rate from how long a call took.
+        :param latency: seconds the call took
+        """
+        if latency > self.target_latency:
+            self.slow_down()
+        else:
+            with self._lock:
+                self.rate = min(self.max_rate, self.rate + 0.1 * self.max_rate / max(self.rate, 1.0))
 
+    def slow_down(self) -> None:
+        """
+        The site is struggling.  Halve the rate.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        logger.debug(f"Moodle API rate limit lowered to {self.rate:.1f} calls per second.")
 
 
 class MoodleAPI:
@@ -118,10 +349,38 @@ class MoodleAPI:
     Also important:  You can pass either requests.post or requests.get to the execute function.
     If dryrun is true in config, requests.post won't do anything and no API call will be made
     The execute function has a dryrun_result variable to use for debugging purposes in that case.
+
+    Each site instance sends its calls through its own pooled keep-alive session, so the TCP connection
+    and TLS handshake are reused across calls.  See connection_stats() to confirm that.
+
+    Calls are paced by a MoodleAPIRateLimiter for the site (see rate_limit).  A read (requests.get) that times out
+    or gets a 429, 502 or 503 is retried up to max_retries times with exponential backoff and jitter.
+    Writes are not retried unless retry_writes is set, because Moodle may have done the work before it failed.
+    For the same reason writes don't time out by default (see write_timeout), and only reads feed their latency
+    back to the limiter.  Calls that are slow by nature, like duplicating a course, are listed in slow_functions
+    and can be given their own timeout in function_timeouts.
     """
 
     _instances = {}  # one singleton instance for each Moodle site.
 
+    pool_size = 10  # default number of keep-alive connections held open to a site.
+    user_batch_size = 100  # number of values sent in each core_user_get_users_by_field call by get_users.
+
+    rate_limit = 20.0  # most calls per second to a site.  The limiter lowers this when the site slows down.
+    timeout = 120  # seconds to wait for a response to a read.
+    write_timeout = None  # seconds to wait for a response to a write.  None waits for Moodle to finish.
+    connect_timeout = 30  # seconds to wait for the connection when there is no timeout for the response.
+    function_timeouts = {'core_course_duplicate_course': None}  # wsfunction: seconds, for calls that need their own.
+    # calls that are slow because of the work they do rather than a busy site.  They don't slow the rate limiter down.
+    slow_functions = ('core_course_duplicate_course', 'core_course_get_courses', 'core_course_get_courses_by_field',
+                      'core_course_get_categories')
+    max_retries = 4  # times to retry a call that failed because the site was busy.
+    retry_backoff = 0.5  # seconds before the first retry.  Doubles each time.
+    retry_max_backoff = 30  # seconds.  Never wait longer than this between retries.
+    retry_statuses = (429, 502, 503)
+    retry_writes = False  # posts are not idempotent, so they are not retried unless you say so.
+    max_url_length = 4000  # longer query strings are sent as a form-encoded POST body instead.  See _send.
+
     roles = [
         {"id": 0, "name": "None", "shortname": "none", "sortorder": 0, "archetype": "",
          "description": "No Role.",
@@ -153,7 +412,7 @@ class MoodleAPI:
     ]
 
     @staticmethod
-    def __new__(cls, site, api_key):
+    def __new__(cls, site, api_key, *args, **kwargs):
         """
         Implement a singleton pattern for the MoodleAPI class.
         :param site:
@@ -168,8 +427,16 @@ class MoodleAPI:
 
 
 
-    def __init__(self, site, api_key):
-        if hasattr(self, '__initialized'):
+    def __init__(self, site, api_key, pool_size: Optional[int] = None, ip_address: Optional[str] = None,
+                 rate_limit: Optional[float] = None):
+        """
+        :param site: the Moodle host name
+        :param api_key: the web service token
+        :param pool_size: number of keep-alive connections to keep open to the site.  Only used on first init.
+        :param ip_address: optionally connect to this IP address instead of resolving the site name.
+        :param rate_limit: most calls per second to make to the site.  Only used on first init.
+        """
+        if hasattr(self, '_MoodleAPI__initialized'):  # the attribute name is mangled, so check for that.
             # already initialized.  But allow updates to the api_key
             self.api_key = api_key
             return
@@ -178,13 +445,37 @@ class MoodleAPI:
         self.endpoint = f'https://{site}/webservice/rest/server.php'
         self.api_key = api_key
 
+        # one pooled keep-alive session per site.
+        self.pool_size = pool_size if pool_size is not None else self.pool_size
+        self.ip_address = ip_address
+        self.session = CustomDNSSession(ip_address, pool_size=self.pool_size)
+        self.rate_limit = rate_limit if rate_limit is not None else self.rate_limit
+        self.limiter = MoodleAPIRateLimiter(self.rate_limit, burst=self.pool_size)
+
         self.user_cache = {}  # cache user ids
         self.course_cache = {}  # cache course ids
         self.course_contexts = {} # which courses have which context IDs.
+        self.categories: Optional[CategoryIndex] = None  # all categories, once load_categories has run.
+        self._categories_lock = threading.Lock()
         self.webservice_get_roles_installed = False
 
-        # useful for some debugging action
-        self.last_api_details = {}
+        # useful for some debugging action.  Kept per thread so parallel syncs don't mix up their calls.
+        self._thread_local = threading.local()
+
+        # identical reads that are in flight at the same time share one call.  See execute.
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+
+        # bytes received for each wsfunction.  See transfer_stats.
+        self._transfer = {}
+        self._transfer_lock = threading.Lock()
+
+    @property
+    def last_api_details(self_api) -> dict:
+        # the details of the last call made by this thread.
+        if not hasattr(self_api._thread_local, 'last_api_details'):
+            self_api._thread_local.last_api_details = {}
+        return self_api._thread_local.last_api_details
 
     def execute(self_api, requests_func, params, dryrun_result=None) -> Any:
         """
@@ -195,10 +486,57 @@ class MoodleAPI:
         :param dryrun_result:  If provided, return this instead of invoking the actual result.
         :return: data or raises an exception if an error.
 
+        Reads (requests.get) are coalesced:  if another thread is already making the same call
+        (same wsfunction and params), this waits for that call and gets a copy of its result or its exception
+        instead of making the call again.
         """
         params['wstoken'] = self_api.api_key
         params['moodlewsrestformat'] = 'json'
 
+        if requests_func != requests.get:
+            return self_api._execute(requests_func, params, dryrun_result)
+
+        key = self_api._flight_key(params)
+        with self_api._in_flight_lock:
+            flight = self_api._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self_api._in_flight[key] = {'done': threading.Event(), 'data': None, 'error': None,
+                                                     'waiters': 0}
+            else:
+                flight['waiters'] += 1
+
+        if not leader:
+            flight['done'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            # flight['data'] is a snapshot nobody else holds, so it is safe to copy while other callers
+            # change their own copies.
+            return copy.deepcopy(flight['data'])
+
+        data = None
+        try:
+            data = self_api._execute(requests_func, params, dryrun_result)
+            return data
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self_api._in_flight_lock:
+                del self_api._in_flight[key]
+                waiters = flight['waiters']  # no one can join once the flight is removed.
+            if waiters and flight['error'] is None:
+                # snapshot before the waiters wake up and before our caller can change data.
+                flight['data'] = copy.deepcopy(data)
+            flight['done'].set()
+
+    @staticmethod
+    def _flight_key(params: Dict[str, Any]) -> tuple:
+        # the token is the same for every call to the site, so leave it out.
+        return tuple(sorted((key, str(value)) for key, value in params.items() if key != 'wstoken'))
+
+    def _execute(self_api, requests_func, params, dryrun_result=None) -> Any:
+        # make the call.  See execute.
         early_result = None
 
         if (requests_func != requests.get and config.dryrun):
@@ -212,27 +550,234 @@ class MoodleAPI:
         # store actual API details for debugging.
         self_api.last_api_details['params'] = params
         self_api.last_api_details['func'] = requests_func
-        response = requests_func(self_api.endpoint, params=params)
+        response = self_api._send_with_retry(requests_func, params)
         self_api.last_api_details['response'] = response
+        self_api.record_transfer(params.get('wsfunction'), self_api._wire_bytes(response), len(response.content))
 
-        if response.status_code != 200:
-            logger.error(f"API call failed: Status code {response.status_code}", 'Response:', response.text)
-            raise Exception(f"Error occurred: {response.status_code}, {response.text}")
+        data = self_api._decode(response.status_code, response.text, response.reason)
 
-        data = json.loads(response.text)
-        self_api.last_api_details['data'] = data
+        if config.debug:
+            logger.debug(f"API call successful: {requests_func.__name__} {params.get('wsfunction')}")
+        return data
 
-        if data is None and not response.ok:
-            logger.error(f"API call failed: Response Not OK: {response.reason}")
-            raise requests.exceptions.HTTPError(f"Error occurred: Response Not OK: {response.reason}")
-        elif type(data) is dict and 'exception' in data:
-            logger.error(f"API call failed: {data['exception']} {data.get('debuginfo', '')}")
-            raise requests.exceptions.HTTPError(f"Error occurred: {data['exception']} {data.get('debuginfo', '')}")
+    def execute_stream(self_api, requests_func, params, key: Optional[str] = None) -> Iterator[Any]:
+        """
+        Like execute, but for calls that return a big list.  The records are decoded from the response
+        a chunk at a time and yielded one by one, so the whole body and the whole list never sit in memory at once.
+        Nothing is sent until you start iterating.
+        Streamed calls are not coalesced with other calls, and dryrun writes yield nothing.
+        :param requests_func:  requests.get,  requests.post
+        :param params: the parameters to send.
+        :param key: if the response is a dict with the list in it, the key for the list.  e.g. 'courses'
+        :return: an iterator over the records.
+        :raises: the same exceptions as execute.  They are raised while iterating.
+        """
+        params['wstoken'] = self_api.api_key
+        params['moodlewsrestformat'] = 'json'
+        if requests_func != requests.get and config.dryrun:
+            logger.debug(f"DRYRUN mode: API call details: ", params)
+            return
+
+        self_api.last_api_details['params'] = params
+        self_api.last_api_details['func'] = requests_func
+        response = self_api._send_with_retry(requests_func, params, stream=True)
+        self_api.last_api_details['response'] = response
+        uncompressed = 0
+
+        def counted(chunks):
+            nonlocal uncompressed
+            for chunk in chunks:
+                uncompressed += len(chunk)
+                yield chunk
+
+        with response:
+            if response.status_code != 200:
+                self_api._decode(response.status_code, response.text, response.reason)  # raises
+            # anything that isn't the list we want (like an exception) comes back whole.
+            data = yield from iter_json_array(counted(response.iter_content(chunk_size=64 * 1024)), key)
+            self_api.record_transfer(params.get('wsfunction'), self_api._wire_bytes(response, uncompressed),
+                                     uncompressed)
+        if data is not None:
+            data = self_api._decode(response.status_code, json.dumps(data), response.reason)
+            yield from (data if isinstance(data, list) or key is None else data.get(key, []))
 
         if config.debug:
             logger.debug(f"API call successful: {requests_func.__name__} {params.get('wsfunction')}")
+
+    def _send_with_retry(self_api, requests_func, params, stream: bool = False) -> requests.Response:
+        """
+        Send the call when the rate limiter allows it.  Retry if the site was busy.  See _retry_delay.
+        :return: the response
+        """
+        attempt = 0
+        while True:
+            self_api.limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = self_api._send(requests_func, params, stream=stream)
+            except requests.exceptions.Timeout as e:
+                delay = self_api._retry_delay(requests_func, attempt)
+                if delay is None:
+                    raise
+                logger.info(f"API call {params.get('wsfunction')} timed out.  Retrying in {delay:.1f} seconds.")
+            else:
+                if self_api._records_latency(requests_func, params):
+                    self_api.limiter.record(time.monotonic() - started)
+                delay = self_api._retry_delay(requests_func, attempt, response.status_code,
+                                              response.headers.get('Retry-After'))
+                if delay is None:
+                    return response
+                logger.info(f"API call {params.get('wsfunction')} got status {response.status_code}.  "
+                            f"Retrying in {delay:.1f} seconds.")
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _timeout(self_api, requests_func, params) -> Optional[float]:
+        """
+        Shared with the asyncio client.
+        :return: seconds to wait for the response to this call, or None to wait as long as it takes.
+        """
+        default = self_api.timeout if requests_func == requests.get else self_api.write_timeout
+        return self_api.function_timeouts.get(params.get('wsfunction'), default)
+
+    def _records_latency(self_api, requests_func, params) -> bool:
+        """
+        Shared with the asyncio client.
+        :return: True if how long this call took says something about how busy the site is.
+        """
+        return requests_func == requests.get and params.get('wsfunction') not in self_api.slow_functions
+
+    def _retry_delay(self_api, requests_func, attempt: int, status_code: Optional[int] = None,
+                     retry_after: Optional[str] = None) -> Optional[float]:
+        """
+        Decide whether to retry a call that failed because the site was busy, and how long to wait first.
+        Shared with the asyncio client.
+        :param requests_func: requests.get or requests.post.  Only gets are retried unless retry_writes is set.
+        :param attempt: the number of retries already made.
+        :param status_code: the HTTP status, or None if the call timed out.
+        :param retry_after: the Retry-After header, if the site sent one.
+        :return: seconds to wait before retrying, or None to not retry.
+        """
+        if status_code is not None and status_code not in self_api.retry_statuses:
+            return None
+        if requests_func != requests.get and not self_api.retry_writes:
+            return None
+        if attempt >= self_api.max_retries:
+            return None
+        self_api.limiter.slow_down()
+        # full jitter, so parallel workers don't all come back at the same moment.
+        delay = random.uniform(0, min(self_api.retry_max_backoff, self_api.retry_backoff * 2 ** attempt))
+        if retry_after is not None and str(retry_after).isdigit():
+            delay = max(delay, min(float(retry_after), self_api.retry_max_backoff))
+        return delay
+
+    def _decode(self_api, status_code: int, text: str, reason: str = '') -> Any:
+        """
+        Turn a web service response into data.  Shared with the asyncio client so errors map the same way.
+        :param status_code: the HTTP status
+        :param text: the response body
+        :param reason: the HTTP reason phrase
+        :return: the decoded data
+        :raises Exception: if the status is not 200
+        :raises MoodleAPIError: if Moodle returned an exception
+        """
+        if status_code != 200:
+            logger.error(f"API call failed: Status code {status_code}", 'Response:', text)
+            raise Exception(f"Error occurred: {status_code}, {text}")
+
+        data = json.loads(text)
+        self_api.last_api_details['data'] = data
+
+        if data is None and status_code >= 400:
+            logger.error(f"API call failed: Response Not OK: {reason}")
+            raise requests.exceptions.HTTPError(f"Error occurred: Response Not OK: {reason}")
+        elif type(data) is dict and 'exception' in data:
+            logger.error(f"API call failed: {data['exception']} {data.get('debuginfo', '')}")
+            raise MoodleAPIError(f"Error occurred: {data['exception']} {data.get('debuginfo', '')}")
         return data
 
+    def _send(self_api, requests_func, params, stream: bool = False):
+        """
+        Send the call through the pooled session for this site.
+        requests.get and requests.post are mapped to the session; anything else is called as is.
+        :param requests_func: requests.get, requests.post
+        :param params: the parameters to send.
+        :param stream: if True, don't read the body yet.
+        :return: the response
+
+        Batched calls can have thousands of values[i] or courses[i][field] params, which makes the URL
+        longer than Apache or a load balancer will take.  So when the query string would be longer than
+        max_url_length the params go in a POST body instead.  Moodle reads them the same either way.
+        Whether the call counts as a read or a write (for dryrun and retries) is still up to requests_func.
+        """
+        timeout = self_api._timeout(requests_func, params)
+        if timeout is None:
+            timeout = (self_api.connect_timeout, None)
+        if requests_func in (requests.get, requests.post):
+            if self_api._use_post_body(params):
+                return self_api.session.request('post', self_api.endpoint, data=params,
+                                                timeout=timeout, stream=stream)
+            return self_api.session.request(requests_func.__name__, self_api.endpoint, params=params,
+                                            timeout=timeout, stream=stream)
+        return requests_func(self_api.endpoint, params=params, timeout=timeout, stream=stream)
+
+    def _use_post_body(self_api, params: Dict[str, Any]) -> bool:
+        # True if the params are too long for a query string.
+        return len(self_api.endpoint) + 1 + len(urlencode(params)) > self_api.max_url_length
+
+    @staticmethod
+    def _wire_bytes(response: requests.Response, default: Optional[int] = None) -> int:
+        # the bytes that came over the network, before they were decompressed.
+        try:
+            return response.raw.tell()
+        except (AttributeError, ValueError):
+            return len(response.content) if default is None else default
+
+    def record_transfer(self_api, wsfunction: str, compressed: int, uncompressed: int) -> None:
+        """
+        Count the bytes received for a call.
+        :param wsfunction: the web service function called
+        :param compressed: bytes received over the network
+        :param uncompressed: bytes after decompressing
+        """
+        with self_api._transfer_lock:
+            totals = self_api._transfer.setdefault(wsfunction, {'calls': 0, 'compressed': 0, 'uncompressed': 0})
+            totals['calls'] += 1
+            totals['compressed'] += compressed
+            totals['uncompressed'] += uncompressed
+
+    def transfer_stats(self_api) -> Dict[str, Dict[str, int]]:
+        """
+        The bytes received from the site for each wsfunction, biggest first.
+        :return: dict of wsfunction to a dict with calls, compressed, and uncompressed byte counts.
+        """
+        with self_api._transfer_lock:
+            stats = {wsfunction: dict(totals) for wsfunction, totals in self_api._transfer.items()}
+        return dict(sorted(stats.items(), key=lambda item: item[1]['compressed'], reverse=True))
+
+    def log_transfer_stats(self_api) -> None:
+        """
+        Log the bytes received for each wsfunction, so you can see which calls dominate the transfer volume.
+        """
+        for wsfunction, totals in self_api.transfer_stats().items():
+            ratio = totals['uncompressed'] / totals['compressed'] if totals['compressed'] else 0
+            logger.info(f"{wsfunction}: {totals['calls']} calls, {totals['compressed']:,} bytes received, "
+                        f"{totals['uncompressed']:,} uncompressed ({ratio:.1f}x)")
+
+    def connection_stats(self_api) -> Dict[str, int]:
+        """
+        :return: dict with the number of requests, connections opened, and connections reused for this site.
+        """
+        return self_api.session.connection_stats()
+
+    def close(self_api):
+        """
+        Close the pooled connections for this site.  A new session is opened so the instance stays usable.
+        """
+        self_api.session.close()
+        self_api.session = CustomDNSSession(self_api.ip_address, pool_size=self_api.pool_size)
+
 
     def  get_user_id(self, email_username_or_id: Union[str, int]) -> Union[int, None]:
         user = self.get_user(email_username_or_id)
@@ -249,16 +794,7 @@ class MoodleAPI:
         if email_username_or_id in self.user_cache:
             return self.user_cache[email_username_or_id]
 
-        # Determine whether we're dealing with a username or user ID
-        if isinstance(email_username_or_id, int) or email_username_or_id.isdigit():
-            key = 'id'
-            value = str(email_username_or_id)
-        elif '@' in email_username_or_id:
-            key = 'email'
-            value = email_username_or_id
-        else:
-            key = 'username'
-            value = email_username_or_id
+        key, value = self._user_field(email_username_or_id)
 
 
         """ Here is a user that the below params pulls:
@@ -283,16 +819,83 @@ class MoodleAPI:
 
         if data and len(data) > 0:
             user = data[0]
-            # Cache both the email/username and user ID
-            self.user_cache[data[0]['email']]  = user
-            self.user_cache[data[0]['username']] = user
-            self.user_cache[data[0]['id']] = user
+            self._cache_user(user)
             return user
 
         # If no user found, cache the negative result to avoid future API calls
         self.user_cache[email_username_or_id] = None
         return None
 
+    def get_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> Dict[Union[str, int], Union[dict, None]]:
+        """
+        Look up many users at once.  The keys are grouped by field (id, email, username) and sent
+        user_batch_size values at a time, so thousands of users cost tens of calls instead of thousands.
+        Every hit and every miss is cached so later get_user calls do not go to Moodle.
+        :param emails_usernames_or_ids: the email addresses, usernames, or user IDs to look up.
+        :return: dict of each key passed in to its user dict, or None if the user doesn't exist
+        """
+        keys = list(dict.fromkeys(emails_usernames_or_ids))  # drop duplicates but keep the order.
+        for params, wanted in self._user_batches(keys):
+            data = self.execute(requests.get, params)
+            self._cache_user_batch(params['field'], wanted, data)
+        return {key: self.user_cache.get(key) for key in keys}
+
+    def _user_batches(self, keys: List[Union[str, int]]) -> List[tuple]:
+        """
+        Group the uncached keys by field and split them into core_user_get_users_by_field calls.
+        :param keys: the emails, usernames or ids to look up
+        :return: list of (params, wanted) where wanted maps each normalized value sent to the keys asking for it.
+        """
+        # Moodle matches usernames and emails without regard to case, so do the same when matching results back.
+        by_field: Dict[str, Dict[str, List]] = {}
+        for key in keys:
+            if key in self.user_cache or key is None:
+                continue
+            field, value = self._user_field(key)
+            by_field.setdefault(field, {}).setdefault(value.lower(), []).append(key)
+
+        batches = []
+        for field, values in by_field.items():
+            value_list = list(values)
+            for start in range(0, len(value_list), self.user_batch_size):
+                wanted = {value: values[value] for value in value_list[start:start + self.user_batch_size]}
+                params = {
+                    'wsfunction': 'core_user_get_users_by_field',
+                    'field': field,
+                }
+                params.update({f'values[{i}]': str(asking[0]) for i, asking in enumerate(wanted.values())})
+                batches.append((params, wanted))
+            logger.debug(f"Resolving {len(value_list)} users by {field}")
+        return batches
+
+    def _cache_user_batch(self, field: str, wanted: Dict[str, List], data: Any) -> None:
+        # cache every user found, and None for every key that was not found.
+        found = {}
+        for user in data if type(data) is list else []:
+            self._cache_user(user)
+            found[str(user[field]).lower()] = user
+        for value, keys in wanted.items():
+            for key in keys:
+                self.user_cache[key] = found.get(value)  # None caches the miss.
+
+    def _user_field(self, email_username_or_id: Union[str, int]) -> tuple:
+        """
+        Determine whether we're dealing with an email, a username, or a user ID
+        :param email_username_or_id: str or int
+        :return: tuple of the core_user_get_users_by_field field name and the value to send
+        """
+        if isinstance(email_username_or_id, int) or email_username_or_id.isdigit():
+            return 'id', str(email_username_or_id)
+        elif '@' in email_username_or_id:
+            return 'email', email_username_or_id
+        return 'username', email_username_or_id
+
+    def _cache_user(self, user: dict):
+        # Cache the email, username and user ID
+        self.user_cache[user['email']] = user
+        self.user_cache[user['username']] = user
+        self.user_cache[user['id']] = user
+
     def create_user(self, username: str, email: str, firstname: str, lastname: str, auth: str, password: str):
 
         params = {
@@ -307,14 +910,44 @@ class MoodleAPI:
         result = self.execute(requests.post, params)
         return result[0].get('id') if type(result) is list and type(result[0] is dict) else None
 
+    def load_categories(self_api, refresh: bool = False) -> CategoryIndex:
+        """
+        Fetch every category in one call and index them.  After that get_category doesn't make any calls.
+        :param refresh: fetch them again even if they are already loaded.
+        :return: CategoryIndex
+        """
+        with self_api._categories_lock:
+            if self_api.categories is None or refresh:
+                data = self_api.execute(requests.get, params={'wsfunction': 'core_course_get_categories'})
+                self_api.categories = CategoryIndex(data)
+                logger.debug(f"Loaded {len(self_api.categories)} categories")
+            return self_api.categories
+
+    def add_category(self_api, category: Dict) -> None:
+        """
+        Put a category that was just created in to the loaded categories.
+        :param category: dict with id, name and parent
+        """
+        if self_api.categories is not None:
+            with self_api._categories_lock:
+                self_api.categories.add(category)
+
     def get_category(self_api, name_or_id: Union[str, int]) -> int:
         """
-        Look up the category by name or ID.
+        Look up the category by name or ID.  If the categories are loaded (see load_categories),
+        look in there instead of asking Moodle.  A path like "Parent / Child" works then too.
         :param name_or_id:
         :return:
         :raise Raises ValueError if ategory not found
         """
         assert type(name_or_id) is str or type(name_or_id) is int, "name_or_id must be category name (str) or id (int)"
+        if self_api.categories is not None:
+            category = self_api.categories.get(name_or_id)
+            if category is None:
+                logger.debug(f"Category not found: {name_or_id}")
+                raise ValueError(f"Category not found: {name_or_id}")
+            return category['id']
+
         params = {
             'wsfunction': 'core_course_get_categories',
             'criteria[0][key]': 'name' if type(name_or_id) is str else 'id',  # Adjusted format for criteria
@@ -474,6 +1107,226 @@ class MoodleAPI:
 
 
 
+class MoodleAPIWriteQueue:
+    """
+    Collect items for a Moodle write function that takes an array - enrol_manual_enrol_users takes
+    enrolments[i][roleid], enrolments[i][userid], ... - and send them chunk_size items per call.
+
+    Moodle runs each call in one transaction, so a single bad item fails the whole call.  When Moodle rejects
+    a call (a MoodleAPIError), the chunk is split in half and each half is sent again until the failing items are
+    isolated.  Only the items that failed are retried, and every item gets its own result.
+    If the call doesn't get through at all - a timeout, a dropped connection, a 5xx after the retries - splitting
+    won't help, so every item in the chunk fails with that error.
+
+    Items can hold lists and dicts, which are flattened the way Moodle wants:
+    {'id': 4, 'courseformatoptions': [{'name': 'coursedisplay', 'value': 1}]} is sent as courses[i][id] and
+    courses[i][courseformatoptions][0][name], courses[i][courseformatoptions][0][value].
+
+    If Moodle answers with warnings and item_id_key is set, each warning goes with the item whose
+    item_id_key value matches the warning's itemid.
+
+    Usage:
+        queue = MoodleAPIWriteQueue(api, 'enrol_manual_enrol_users', 'enrolments', chunk_size=100)
+        queue.add({'roleid': 5, 'userid': 123, 'courseid': 45})
+        results = queue.flush()   # [{'item': {...}, 'ok': True, 'error': None, 'warnings': []}, ...]
+    """
+
+    def __init__(self, api: 'MoodleAPI', wsfunction: str, array_name: str, chunk_size: int = 100,
+                 on_success: Union[callable, None] = None, item_id_key: Optional[str] = None):
+        """
+        :param api: the MoodleAPI for the site
+        :param wsfunction: the Moodle web service function
+        :param array_name: the name of the array parameter, like enrolments or unassignments
+        :param chunk_size: the number of items to send in each call.  The queue flushes itself when it gets this big.
+        :param on_success: optional function called with each item after Moodle accepted it.
+        :param item_id_key: optional item field that Moodle warnings refer to with their itemid, like id for courses.
+        """
+        self.api = api
+        self.wsfunction = wsfunction
+        self.array_name = array_name
+        self.chunk_size = chunk_size
+        self.on_success = on_success
+        self.item_id_key = item_id_key
+        self.items = []
+        self.results = []  # results of items sent when the queue filled up, held until the next flush()
+        self._lock = threading.Lock()  # several sync threads may share a queue.  Sending happens outside the lock.
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item: Dict[str, Any]) -> None:
+        """
+        Queue an item.  Sends the queue if it has reached chunk_size.  The results are returned by the next flush().
+        :param item: dict of the fields for one array entry.
+        """
+        with self._lock:
+            self.items.append(item)
+            if len(self.items) < self.chunk_size:
+                return
+            items, self.items = self.items, []
+        results = self._send_all(items)
+        with self._lock:
+            self.results.extend(results)
+
+    def flush(self) -> List[Dict]:
+        """
+        Send everything in the queue.
+        :return: list of dicts with item, ok (bool), and error (str or None) for every item sent since the last flush.
+        """
+        with self._lock:
+            items, self.items = self.items, []
+            results, self.results = self.results, []
+        return results + self._send_all(items)
+
+    def _send_all(self, items: List[Dict]) -> List[Dict]:
+        results = []
+        for start in range(0, len(items), self.chunk_size):
+            results.extend(self._send(items[start:start + self.chunk_size]))
+        failed = [result for result in results if not result['ok']]
+        if items:
+            logger.debug(f"{self.wsfunction}: sent {len(results)} items, {len(failed)} failed.")
+        return results
+
+    def _send(self, items: List[Dict]) -> List[Dict]:
+        """
+        Send the items in one call.  If Moodle rejects it, split the items and try each half.
+        :param items: the items to send.
+        :return: list of results, one per item.
+        """
+        try:
+            data = self.api.execute(requests.post, self._params(items), dryrun_result=True)
+        except MoodleAPIError as e:
+            if len(items) > 1:
+                middle = len(items) // 2
+                return self._send(items[:middle]) + self._send(items[middle:])
+            return self._failed(items, e)
+        except Exception as e:
+            return self._failed(items, e)
+        return self._succeeded(items, data)
+
+    def _params(self, items: List[Dict]) -> Dict[str, Any]:
+        # the params for one call with these items.
+        params = {'wsfunction': self.wsfunction}
+        for i, item in enumerate(items):
+            params.update(flatten_params(f'{self.array_name}[{i}]', item))
+        return params
+
+    def _failed(self, items: List[Dict], error: Exception) -> List[Dict]:
+        # the results for items that weren't written.
+        if len(items) == 1:
+            logger.error(f"{self.wsfunction} failed for {items[0]}: {error}")
+        else:
+            logger.error(f"{self.wsfunction} failed for {len(items)} items: {error}")
+        return [{'item': item, 'ok': False, 'error': str(error), 'warnings': []} for item in items]
+
+    def _succeeded(self, items: List[Dict], data: Any) -> List[Dict]:
+        # the results for items Moodle accepted, with any warnings that refer to them.
+        warnings = {}
+        if self.item_id_key and isinstance(data, dict):
+            for warning in data.get('warnings') or []:
+                warnings.setdefault(warning.get('itemid'), []).append(warning)
+        if self.on_success:
+            for item in items:
+                self.on_success(item)
+        return [{'item': item, 'ok': True, 'error': None,
+                 'warnings': warnings.get(item.get(self.item_id_key), []) if self.item_id_key else []}
+                for item in items]
+
+
+def flatten_params(prefix: str, value: Any) -> Dict[str, Any]:
+    """
+    Flatten a value in to Moodle's array params.
+    flatten_params('courses[0]', {'id': 4, 'courseformatoptions': [{'name': 'coursedisplay', 'value': 1}]}) is
+    {'courses[0][id]': 4, 'courses[0][courseformatoptions][0][name]': 'coursedisplay',
+     'courses[0][courseformatoptions][0][value]': 1}
+    """
+    if isinstance(value, dict):
+        items = value.items()
+    elif isinstance(value, (list, tuple)):
+        items = enumerate(value)
+    else:
+        return {prefix: value}
+    params = {}
+    for key, sub_value in items:
+        params.update(flatten_params(f'{prefix}[{key}]', sub_value))
+    return params
+
+
+class TemplateMatcher:
+    """
+    Picks the template for a course shortname from a templates list (see MoodleAPICourseProvider.templates).
+
+    The patterns are compiled once, into a single alternation where they allow it, so each shortname is matched in
+    one pass and the first pattern that matches wins.  If no pattern matches, the last template is used.
+    Template course ids looked up by shortname are remembered, and each template counts how many courses used it.
+    """
+
+    def __init__(self, templates: List[tuple]):
+        """
+        :param templates: list of (shortname regex, template course id or template course shortname)
+        """
+        if not templates:
+            raise ValueError("At least one template is required.")
+        self.entries = tuple(tuple(template) for template in templates)
+        self.patterns = [re.compile(pattern) for pattern, _ in self.entries]
+        self.combined = None
+        self._group_template = {}  # group number in combined: index in templates
+        # groups are renumbered inside one big pattern, so backreferences to them would break.  Don't combine those.
+        if not any(re.search(r'\\\d|\(\?P=', pattern.pattern) for pattern in self.patterns):
+            try:
+                self.combined = re.compile('|'.join(f'(?P<t{index}>{pattern.pattern})'
+                                                    for index, pattern in enumerate(self.patterns)))
+                self._group_template = {self.combined.groupindex[f't{index}']: index
+                                        for index in range(len(self.patterns))}
+            except re.error:
+                # like inline flags, which are only allowed at the start of a pattern, or repeated group names.
+                self.combined = None
+        self.hits = [0] * len(self.entries)
+        self.template_ids = {}  # template shortname: course id
+        self._lock = threading.Lock()
+
+    def match_index(self, shortname: str) -> int:
+        """
+        :return: the index in templates of the first pattern that matches the shortname, or the last template.
+        """
+        index = len(self.entries) - 1
+        if self.combined is not None:
+            match = self.combined.match(shortname)
+            if match:
+                # the outer group of the template that matched is the last one to close.
+                index = self._group_template[match.lastindex]
+        else:
+            for i, pattern in enumerate(self.patterns):
+                if pattern.match(shortname):
+                    index = i
+                    break
+        with self._lock:
+            self.hits[index] += 1
+        return index
+
+    def match(self, shortname: str) -> Union[int, str]:
+        """
+        :return: the template for the shortname as given in templates - a course ID or a course shortname.
+        """
+        return self.entries[self.match_index(shortname)][1]
+
+    def report(self) -> List[Dict]:
+        """
+        :return: list of dicts with the pattern, template and number of courses that used it, for each template.
+        """
+        with self._lock:
+            hits = list(self.hits)
+        return [{'pattern': pattern, 'template': template, 'hits': count}
+                for (pattern, template), count in zip(self.entries, hits)]
+
+    def log_report(self) -> None:
+        """
+        Log which templates were used, so you can spot patterns that never match.
+        """
+        for entry in self.report():
+            logger.info(f"Template {entry['template']} (pattern '{entry['pattern']}'): {entry['hits']} courses")
+
+
 class MoodleAPICourseProvider(MoodleCourseProvider):
     """
 
@@ -498,6 +1351,8 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
     # and then mapped back to a dict when updating a course.
     courseformatoptions_fields = ['hiddensections', 'coursedisplay', 'automaticenddate']
 
+    update_batch_size = 50  # number of courses sent in each core_course_update_courses call by update_courses.
+
     def __init__(self, site, api_key, templates=None):
         super().__init__()
         self.api = MoodleAPI(site, api_key)
@@ -506,44 +1361,69 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         if templates is None:
             templates = self.templates
         self.templates = templates
+        self._template_matcher = None
         self.get_all_courses = True  # preference to attempt to load all the courses with this provider.
 
+    @property
+    def template_matcher(self) -> TemplateMatcher:
+        # compiled from self.templates, and again if the templates are changed.
+        matcher = self._template_matcher
+        if matcher is None or matcher.entries != tuple(tuple(template) for template in self.templates):
+            matcher = self._template_matcher = TemplateMatcher(self.templates)
+        return matcher
+
     def _get_template(self, shortname: str) -> int:
         """
         Look for a template that matches the shortname.  If none found, return the last template.
         :param shortname:
         :return: int - the course ID of the template to use.
         """
-        result = None
-        for pattern, course_id in self.templates:
-            if re.match(pattern, shortname):
-                result = course_id
-        if not result:
-            result = self.templates[-1][1]
+        matcher = self.template_matcher
+        result = matcher.match(shortname)
         if type(result) is str:
-            result = self.api.get_course_id(result)
+            template_shortname = result
+            result = matcher.template_ids.get(template_shortname)
+            if result is None:
+                result = self.api.get_course_id(template_shortname)
+                if result is not None:
+                    matcher.template_ids[template_shortname] = result
         return result
 
-    def _extract_courseformatoptions(self, course: dict):
+    def _match_template(self, shortname: str) -> Union[int, str]:
+        """
+        :return: the template for the shortname as given in templates - a course ID or a course shortname.
+        """
+        return self.template_matcher.match(shortname)
+
+    def template_report(self) -> List[Dict]:
+        """
+        :return: the templates with the number of courses created from each.  See TemplateMatcher.report.
+        """
+        return self.template_matcher.report()
+
+    def _extract_courseformatoptions(self, course: dict, index: int = 0):
         """
         This function mutes the course dict.
         It returns a dict formatted for the courseformatoptions field for updating Moodle
         :param course:
+        :param index: the course's position in the courses array.
         :return: a dict of properly formatted params
         """
         # convert course format options to proper format
         # 'courseformatoptions': [{'name': 'hiddensections', 'value': 0}, {'name': 'coursedisplay', 'value': 0}, {'name': 'automaticenddate', 'value': 0}],
         #         params[f'courses[{i}][courseformatoptions][0][name]'] = 'hiddensections'
         #         params[f'courses[{i}][courseformatoptions][0][value]'] = hidden_sections_value
-        courseformatoptions, counter = {}, 0
+        return flatten_params(f'courses[{index}][courseformatoptions]', self._pop_courseformatoptions(course))
+
+    def _pop_courseformatoptions(self, course: dict) -> List[Dict]:
+        """
+        This function mutates the course dict.
+        Remove the course format option fields from the course.
+        :return: list of name / value dicts, the way Moodle's courseformatoptions wants them.
+        """
         # self.courseformatoptions_fields = ['hiddensections', 'coursedisplay', 'automaticenddate']
-        for field in self.courseformatoptions_fields:
-            if field in course:
-                courseformatoptions[f'courses[{counter}][courseformatoptions][0][name]'] = field
-                courseformatoptions[f'courses[{counter}][courseformatoptions][0][value]'] = course[field]
-                del course[field]
-                counter += 1
-        return courseformatoptions
+        return [{'name': field, 'value': course.pop(field)}
+                for field in self.courseformatoptions_fields if field in course]
 
     def _flatten_courseformatoptions(self, course: dict):
         """
@@ -570,7 +1450,6 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         field = 'shortname' if type(shortname_or_id) is str else 'id'
         courses_matching = self.get_courses(field=field, value=shortname_or_id)
         if courses_matching:
-            print(courses_matching[0])
             return courses_matching[0]
         return None
 
@@ -607,23 +1486,49 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         logger.debug(f"Retrieved {len(courses)} courses")
         return courses
 
-    def create_course(self, course: dict) -> Union[int, None]:
+    def iter_courses(self, field=None, value=None) -> Iterator[dict]:
+        """
+        Like get_courses, but the courses are decoded from the response as it arrives and yielded one at a time.
+        Use this for all the courses on a big site, where the full list takes a lot of memory.
+        """
+        params = {'wsfunction': 'core_course_get_courses'}
+        if field:
+            params.update({'wsfunction': 'core_course_get_courses_by_field', 'field': field, 'value': value})
+        logger.debug("Streaming courses: " + str(params))
+
+        count = 0
+        for course in self.api.execute_stream(requests.get, params, key='courses' if field else None):
+            self._flatten_courseformatoptions(course)
+            count += 1
+            yield course
+        logger.debug(f"Retrieved {count} courses")
+
+    def create_course(self, course: dict, known_absent: bool = False, category_id: Union[int, None] = None,
+                      template_id: Union[int, None] = None) -> Union[int, None]:
         """
         Create the course from a template. Use default template if not found.
+        Then set the rest of the course fields on the new course.
+
+        Anything the caller has already looked up can be passed in so it isn't looked up again.
+        With all of them, creating a course takes two calls:  duplicate and update.
 
         :param course: a dict of course values
+        :param known_absent: the caller already checked that the course isn't in Moodle.
+        :param category_id: the Moodle category id, if the caller already looked it up.
+        :param template_id: the Moodle course id of the template to copy, if the caller already knows it.
         :return: course ID if course was created else None
         :raises: ValueError if categoryid not found (from the course dict)
         """
 
         # make sure the course does not exist
-        existing_course = self.get_course(course['shortname'])
-        if existing_course:
-            logger.error(f"Course already exists with shortname: {course['shortname']}")
-            raise ValueError(f"Course already exists with shortname: {course['shortname']}")
+        if not known_absent:
+            existing_course = self.get_course(course['shortname'])
+            if existing_course:
+                logger.error(f"Course already exists with shortname: {course['shortname']}")
+                raise ValueError(f"Course already exists with shortname: {course['shortname']}")
 
         # check to make sure the category exists.  Would raise ValueError.
-        course['categoryid'] = self.api.get_category(course['categoryid'])
+        course['categoryid'] = category_id if category_id is not None else self.api.get_category(course['categoryid'])
 
         course_basics = {
             'fullname': course['fullname'],  # Required: The full name of the course
@@ -632,7 +1537,7 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         }
         params = {
             'wsfunction': 'core_course_duplicate_course',
-            'courseid': self._get_template(course['shortname']),
+            'courseid': template_id if template_id is not None else self._get_template(course['shortname']),
         }
         params.update(course_basics)
         # requests_func = requests.post, params=params
@@ -644,8 +1549,7 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
             return
 
         if new_course_id:
-            # filter the course values for just Moodle fields, and then update_course
-            course_update_values = {k: v for k, v in course.items() if k in self.fields_to_update}
+            # set the rest of the course fields on the new course.  update_course keeps just the Moodle fields.
             self.update_course(course, force_all_fields=True, course_id=new_course_id)
         else:
             logger.error(f"Course not created: {course['shortname']}")
@@ -663,30 +1567,18 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         :param course_id: int - the course id to update.  If None, it will be looked up by shortname
         :return: None.  Will raise exception if fail
         """
-        filtered_fields = {k: v for k, v in course.items()
-                           if k in self.fields_to_update or (force_all_fields and k in self.fields)}
-
-        if config.dryrun:
+        if course_id is not None:
+            existing_course = {'id': course_id}  # the caller knows it, so don't look it up again.
+        elif config.dryrun:
             existing_course = {'id': -999}
         else:
-            existing_course = self.get_course(course['shortname'] if course_id is None else course_id)
+            existing_course = self.get_course(course['shortname'])
         if not existing_course:
             logger.error(f"Existing Course not found: {course['shortname']}")
             raise ValueError(f"Existing Course not found: {course['shortname']}")
 
         # The update courses api requires the id, which is why look it up above. It's usually not in the course dict.
-        filtered_fields['id'] = existing_course['id']
-        course_format_options = self._extract_courseformatoptions(filtered_fields)
-
-        # Flatten the array for the params.  This is the way Moodle wants it.
-        # Note  course format options must be first removed, so after, update courses_param with course_format_options
-        courses_param = {f'courses[0][{key}]': value for key, value in filtered_fields.items()}
-        courses_param.update(course_format_options)
-
-        params = {
-            'wsfunction': 'core_course_update_courses',
-            **courses_param  # Note you could just do params.update(courses_param) as well.
-        }
+        params = self._update_course_params(course, existing_course['id'], force_all_fields)
 
         #logger.debug(f"Updating Course: {course['shortname']} with: \n    ", params)
         _data = self.api.execute(requests.post, params, dryrun_result=course if config.dryrun else None)
@@ -694,6 +1586,98 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         return
 
 
+    def update_courses(self, courses: List[dict], course_ids: Union[List[Union[int, None]], None] = None, *,
+                       force_all_fields=False) -> List[Dict]:
+        """
+        Update many courses, update_batch_size courses per core_course_update_courses call.
+        If Moodle rejects a call, the batch is split until the bad courses are found, so one bad course doesn't
+        stop the rest.
+
+        :param courses: course dicts ready for Moodle
+        :param course_ids: the Moodle course id for each course, in the same order.
+            Any that are None (or all of them, if this is None) are looked up by shortname.
+        :param force_all_fields: bool - Force all  fields to update else just the ones in fields_to_update
+        :return: a result for each course, in order:  dict with course, id, ok (bool), error, and the Moodle warnings.
+            A course with warnings was not updated, so ok is False.
+        """
+        if course_ids is None:
+            course_ids = [None] * len(courses)
+        course_ids = [course_id if course_id is not None else self._existing_course_id(course)
+                      for course, course_id in zip(courses, course_ids)]
+        items = self._course_update_items(courses, course_ids, force_all_fields)
+        queue = MoodleAPIWriteQueue(self.api, 'core_course_update_courses', 'courses', self.update_batch_size,
+                                    item_id_key='id')
+        for item in items:
+            if item is not None:
+                queue.add(item)
+        return self._course_update_results(courses, items, queue.flush())
+
+    def _existing_course_id(self, course: dict) -> Union[int, None]:
+        # the id of the moodle course to update, by shortname.
+        existing_course = {'id': -999} if config.dryrun else self.get_course(course['shortname'])
+        return existing_course['id'] if existing_course else None
+
+    def _course_update_items(self, courses: List[dict], course_ids: List[Union[int, None]],
+                             force_all_fields=False) -> List[Union[dict, None]]:
+        # the core_course_update_courses item for each course, or None if it isn't in Moodle.
+        items = []
+        for course, course_id in zip(courses, course_ids):
+            if course_id is None:
+                logger.error(f"Existing Course not found: {course['shortname']}")
+                items.append(None)
+            else:
+                items.append(self._course_update_item(course, course_id, force_all_fields))
+        return items
+
+    def _course_update_results(self, courses: List[dict], items: List[Union[dict, None]],
+                               sent_results: List[Dict]) -> List[Dict]:
+        # match the write queue results back up with the courses.  See update_courses.
+        sent = {id(result['item']): result for result in sent_results}
+        results = []
+        for course, item in zip(courses, items):
+            if item is None:
+                results.append({'course': course, 'id': None, 'ok': False,
+                                'error': f"Existing Course not found: {course['shortname']}", 'warnings': []})
+                continue
+            result = sent[id(item)]
+            for warning in result['warnings']:
+                logger.error(f"Course {item['id']} {course['shortname']} not updated: {warning.get('message')}")
+            results.append({'course': course, 'id': item['id'], 'ok': result['ok'] and not result['warnings'],
+                            'error': result['error'], 'warnings': result['warnings']})
+        logger.debug(f"Updated {sum(result['ok'] for result in results)} of {len(results)} courses")
+        return results
+
+    def _course_update_item(self, course: dict, course_id: int, force_all_fields=False) -> dict:
+        """
+        The fields to send to core_course_update_courses for one course.
+        :param course: course dict ready for Moodle
+        :param course_id: the Moodle course id
+        :param force_all_fields: bool - Force all  fields to update else just the ones in fields_to_update
+        :return: dict of the course fields, with id, and the course format options in courseformatoptions.
+        """
+        filtered_fields = {k: v for k, v in course.items()
+                           if k in self.fields_to_update or (force_all_fields and k in self.fields)}
+        filtered_fields['id'] = course_id
+        course_format_options = self._pop_courseformatoptions(filtered_fields)
+        if course_format_options:
+            filtered_fields['courseformatoptions'] = course_format_options
+        return filtered_fields
+
+    def _update_course_params(self, course: dict, course_id: int, force_all_fields=False) -> dict:
+        """
+        Build the core_course_update_courses params for one course.
+        :param course: course dict ready for Moodle
+        :param course_id: the Moodle course id
+        :param force_all_fields: bool - Force all  fields to update else just the ones in fields_to_update
+        :return: the params
+        """
+        # Flatten the array for the params.  This is the way Moodle wants it.
+        params = {
+            'wsfunction': 'core_course_update_courses',
+            **flatten_params('courses[0]', self._course_update_item(course, course_id, force_all_fields))
+        }
+        return params
+
     def get_category(self, name_or_id: Union[str, int]) -> int:
         """
         Look up the category by name or ID.
@@ -703,6 +1687,9 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         """
         return self.api.get_category(name_or_id)
 
+    def load_categories(self, refresh: bool = False) -> CategoryIndex:
+        return self.api.load_categories(refresh)
+
     def create_category(self, category_name, category_parent_name: Union[str, None] = None) -> int:
         """
         Create a category with the given name and parent name.
@@ -718,17 +1705,86 @@ class MoodleAPICourseProvider(MoodleCourseProvider):
         }
         if category_parent_name:
             params['categories[0][parent]'] = parent_id
-        data = self.api.execute(requests.post, params, dryrun_result={'id': -99} if config.dryrun else None)
+        data = self.api.execute(requests.post, params, dryrun_result=[{'id': -99}] if config.dryrun else None)
         logger.debug(f"Category Created: {category_name} id {data[0]['id']}")
+        if not config.dryrun:  # the dryrun id is made up, so keep it out of the category index.
+            self.api.add_category({'id': data[0]['id'], 'name': category_name, 'parent': parent_id or 0})
         return data[0]['id']
 
 
 class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
 
-    def __init__(self, site, api_key):
+    batch_size = 100  # number of enrolments sent in each write call when batch_writes is on.
+
+    def __init__(self, site, api_key, batch_writes=False):
+        """
+        :param site: the Moodle host name
+        :param api_key: the web service token
+        :param batch_writes: queue enrolments and send them batch_size at a time.  Call flush() when done.
+        """
         super().__init__()
         self.api = MoodleAPI(site, api_key)
         self.roles_to_sync = ['student', 'editingteacher']
+        self.batch_writes = batch_writes
+        self.enrol_queue = MoodleAPIWriteQueue(self.api, 'enrol_manual_enrol_users', 'enrolments', self.batch_size,
+                                               on_success=self._roster_enrolled)
+        self.unassign_queue = MoodleAPIWriteQueue(self.api, 'core_role_unassign_roles', 'unassignments',
+                                                  self.batch_size, on_success=self._roster_unassigned)
+        self.unenrol_queue = MoodleAPIWriteQueue(self.api, 'enrol_manual_unenrol_users', 'enrolments',
+                                                 self.batch_size, on_success=self._roster_deleted)
+
+        # course_id -> {(user_id, role_id): enrolment}.  Filled by get_enroled_users and kept up to date after
+        # each successful write, so membership checks do not have to download the roster again.
+        self.roster_cache: Dict[int, Dict[tuple, Dict]] = {}
+        self._roster_lock = threading.RLock()
+
+    def flush(self) -> List[Dict]:
+        """
+        Send any queued writes.  Enrolments go first, then role unassignments, then unenrolments.
+        :return: list of results with item, ok and error for each queued write.
+        """
+        return self.enrol_queue.flush() + self.unassign_queue.flush() + self.unenrol_queue.flush()
+
+    def _send_batch(self, queue: MoodleAPIWriteQueue, items: List[Dict]) -> List[Dict]:
+        """
+        Queue the items and send them now, unless batch_writes is holding writes for flush().
+        :return: a result per item, in order.  Items still waiting in the queue are reported as ok.
+        """
+        if self.batch_writes:
+            for item in items:
+                queue.add(item)
+            return [{'item': item, 'ok': True, 'error': None} for item in items]
+        # send through a queue of our own so the results are not mixed up with another thread's items.
+        own_queue = MoodleAPIWriteQueue(self.api, queue.wsfunction, queue.array_name, queue.chunk_size,
+                                        on_success=queue.on_success)
+        for item in items:
+            own_queue.add(item)
+        return own_queue.flush()
+
+    def _resolve_ids(self, user: Union[int, str], course: Union[int, str], role: Union[int, str, None] = None) \
+            -> tuple:
+        """
+        Look up the Moodle ids for a user, course, and (optionally) role.
+        :return: tuple of user_id, course_id, role_id.  role_id is None if no role was given.
+        :raises ValueError: if the user, course, or role does not exist
+        """
+        user_id = self.api.get_user_id(user)
+        if user_id is None:
+            logger.error(f"User does not exist: {user}")
+            raise ValueError(f"User does not exist: {user}")
+
+        course_id = self.api.get_course_id(course)
+        if course_id is None:
+            logger.error(f"Course does not exist: {course}")
+            raise ValueError(f"Course does not exist: {course}")
+
+        role_id = None
+        if role is not None:
+            role_id = self.api.get_role_id(role)
+            if role_id is None:
+                logger.error(f"Role does not exist: {role}")
+                raise ValueError(f"Role does not exist: {role}")
+        return user_id, course_id, role_id
 
     def get_role_id(self, role: str) -> Union[None, int]:
         """
@@ -756,6 +1812,13 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         user = self.api.get_user(user_id)
         return user['username'] if user else None
 
+    def prefetch_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> None:
+        """
+        Resolve all these users in a few bulk calls so later lookups come from the cache.
+        :param emails_usernames_or_ids: usernames, emails, or user ids
+        """
+        self.api.get_users(emails_usernames_or_ids)
+
     def get_course_id(self, shortname: str) -> Union[None, int]:
         """
         Return the course id for a shortname.
@@ -766,10 +1829,12 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
 
 
 
-    def get_enroled_users(self, course: Union[str, int]) -> List[Dict[str, int]]:
+    def get_enroled_users(self, course: Union[str, int], refresh: bool = False) -> List[Dict[str, int]]:
         """
         Return a list of users and roles for a course.
+        The roster is cached per course and kept current after writes.  See invalidate_roster.
         @param course: int or str: the course id or shortname
+        @param refresh: bool: fetch the roster from Moodle even if it is cached.
         @return: list: A list of Dicts with user_id, course_id, and role_id
         """
 
@@ -777,6 +1842,10 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         if course_id is None:
             raise ValueError(f"Course does not exist: {course}")
 
+        with self._roster_lock:
+            if course_id in self.roster_cache and not refresh:
+                return list(self.roster_cache[course_id].values())
+
         params = {
             'wsfunction': 'core_enrol_get_enrolled_users',
             'courseid': course_id
@@ -809,8 +1878,56 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
             num = len([enrol for enrol in enrolmnent_list if enrol['role'] == role])
             counts.append(f"{num} {role}s")
         logger.debug(f"Retrieved {len(enrolmnent_list)} enrolments for course {course_id}: {', '.join(counts)}")
+        with self._roster_lock:
+            self.roster_cache[course_id] = {(enrol['user_id'], enrol['role_id']): enrol for enrol in enrolmnent_list}
         return enrolmnent_list
 
+    def invalidate_roster(self, course: Union[str, int, None] = None) -> None:
+        """
+        Forget the cached roster for a course, or for all courses, so the next lookup fetches it from Moodle.
+        Use this if enrolments were changed outside this provider.
+        :param course: int or str: the course id or shortname.  None forgets every roster.
+        """
+        course_id = None if course is None else self.api.get_course_id(course)
+        with self._roster_lock:
+            if course is None:
+                self.roster_cache.clear()
+            else:
+                self.roster_cache.pop(course_id, None)
+
+    def prefetch_rosters(self, courses: Iterable[Union[str, int]]) -> None:
+        """
+        Called by EnrolmentSync at the start of each sync.  The rosters are fetched one course at a time as they
+        are needed, so this just forgets the cached ones:  enrolments may have changed in Moodle since the last
+        sync, and a provider that is kept around between syncs would otherwise compare against old rosters.
+        :param courses: the course shortnames or ids about to be synced.
+        """
+        self.invalidate_roster()
+
+    def _roster_enrolled(self, item: Dict) -> None:
+        # keep the cached roster current after an enrol_manual_enrol_users item succeeded.
+        role = self.rolename_for_id(item['roleid'])
+        with self._roster_lock:
+            roster = self.roster_cache.get(item['courseid'])
+            if roster is not None and role in self.roles_to_sync:
+                roster[(item['userid'], item['roleid'])] = {'user_id': item['userid'], 'course_id': item['courseid'],
+                                                            'role_id': item['roleid'], 'role': role}
+
+    def _roster_unassigned(self, item: Dict) -> None:
+        # keep the cached roster current after a core_role_unassign_roles item succeeded.
+        with self._roster_lock:
+            roster = self.roster_cache.get(item['instanceid'])
+            if roster is not None:
+                roster.pop((item['userid'], item['roleid']), None)
+
+    def _roster_deleted(self, item: Dict) -> None:
+        # keep the cached roster current after an enrol_manual_unenrol_users item succeeded.
+        with self._roster_lock:
+            roster = self.roster_cache.get(item['courseid'])
+            if roster is not None:
+                for key in [key for key in roster if key[0] == item['userid']]:
+                    del roster[key]
+
     def course_enrol_user(self, user: Union[int, str], course: Union[str, int], role: Union[str, int] = 'student') \
             -> Union[None, Dict[str, int]]:
         """
@@ -820,20 +1937,7 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         :param role: int,str: the role to add the user to the course
         :return: None or dict of the user with counts as 1
         """
-        user_id = self.api.get_user_id(user)
-        if user_id is None:
-            logger.error(f"User does not exist: {user}")
-            raise ValueError(f"User does not exist: {user}")
-
-        course_id = self.api.get_course_id(course)  # performs a lookup
-        if course_id is None:
-            logger.error(f"Course does not exist: {course}")
-            raise ValueError(f"Course does not exist: {course}")
-
-        role_id = self.api.get_role_id(role)
-        if role_id is None:
-            logger.error(f"Role does not exist: {role}")
-            raise ValueError(f"Role does not exist: {role}")
+        user_id, course_id, role_id = self._resolve_ids(user, course, role)
 
         params = {
             'wsfunction': 'enrol_manual_enrol_users',
@@ -845,8 +1949,15 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         if alreadythere:
             logger.debug(f"User {user} already enrolled in role {role} in course {course_id}")
             return None
+        if self.batch_writes:
+            # the write is sent when the queue fills up or on flush().  Failures are reported then.
+            self.enrol_queue.add({'roleid': role_id, 'userid': user_id, 'courseid': course_id})
+            logger.debug(f"User {user_id} queued for enrolment in role {role_id} in course {course_id}")
+            return {"user_id": user_id, "course_id": course_id, "role_id": role_id,
+                    "num_new_enrols": 1, "num_roles_added": 1}
         data = self.api.execute(requests.post, params, dryrun_result='yes!')
         if data is None or data == 'yes!':  # The API returns None on success.
+            self._roster_enrolled({'roleid': role_id, 'userid': user_id, 'courseid': course_id})
             logger.info(f"User {user_id} enrolled in role {role_id} in course {course_id}")
             return {"user_id": user_id, "course_id": course_id, "role_id": role_id,
                     "num_new_enrols": 1, "num_roles_added": 1}  # note the new_enrols is made up to indicate success.
@@ -869,20 +1980,7 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         :raises ValueError: if the user, course, or role does not exist
         :raises requests.exceptions.RequestException: if the API call fails
         """
-        user_id = self.api.get_user_id(user)
-        if user_id is None:
-            logger.error(f"User does not exist: {user}")
-            raise ValueError(f"User does not exist: {user}")
-
-        course_id = self.api.get_course_id(course)
-        if course_id is None:
-            logger.error(f"Course does not exist: {course}")
-            raise ValueError(f"Course does not exist: {course}")
-
-        role_id = self.api.get_role_id(role)
-        if role_id is None:
-            logger.error(f"Role does not exist: {role}")
-            raise ValueError(f"Role does not exist: {role}")
+        user_id, course_id, role_id = self._resolve_ids(user, course, role)
 
         params = {
             'wsfunction': 'core_role_unassign_roles',
@@ -898,9 +1996,14 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         if not alreadythere:
             logger.debug(f"User already {user} not enrolled in role {role} in course {course_id}")
             return None
+        if self.batch_writes:
+            self.unassign_queue.add(self._unassignment(user_id, course_id, role_id))
+            logger.debug(f"User {user_id} queued for unassignment from role {role_id} in course {course_id}")
+            return {"user_id": user_id, "course_id": course_id, "role_id": role_id, "num_roles_deleted": 1}
         data = self.api.execute(requests.post, params, dryrun_result=True)
 
         if data is None:
+            self._roster_unassigned(self._unassignment(user_id, course_id, role_id))
             logger.info(f"User {user_id} unenrolled from role {role_id} in course {course_id}")
             return {
                 "user_id": user_id,
@@ -911,6 +2014,44 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         logger.error(f"Failed to unenrol user {user} from course {course_id}. API response: {data}")
         return None
 
+    def course_unenrol_users(self, unenrolments: List[Dict[str, Union[int, str]]]) -> List[Union[None, Dict]]:
+        """
+        Unenrol many users from roles with batched core_role_unassign_roles calls.
+        :param unenrolments: list of dicts with user, course, and role - ids or names as for course_unenrol_user.
+        :return: list in the same order with the course_unenrol_user result for each,
+                 None if there was nothing to do, or num_roles_deleted 0 and the error if Moodle rejected it
+                 or the user, course or role doesn't exist.  The others are still sent.
+        """
+        results: List[Union[None, Dict]] = [None] * len(unenrolments)
+        positions, items = [], []
+        for i, unenrolment in enumerate(unenrolments):
+            try:
+                user_id, course_id, role_id = self._resolve_ids(unenrolment['user'], unenrolment['course'],
+                                                                unenrolment['role'])
+            except ValueError as e:
+                results[i] = {"user_id": unenrolment['user'], "course_id": unenrolment['course'],
+                              "role_id": unenrolment['role'], "num_roles_deleted": 0, 'error': str(e)}
+                continue
+            if not self._user_has_role_in_course(user_id, course_id, role_id):
+                continue
+            positions.append(i)
+            items.append(self._unassignment(user_id, course_id, role_id))
+
+        for i, result in zip(positions, self._send_batch(self.unassign_queue, items)):
+            item = result['item']
+            results[i] = {"user_id": item['userid'], "course_id": item['instanceid'], "role_id": item['roleid'],
+                          "num_roles_deleted": 1 if result['ok'] else 0}
+            if not result['ok']:
+                results[i]['error'] = result['error']
+        logger.info(f"Unenrolled {sum(r['num_roles_deleted'] for r in results if r)} of {len(unenrolments)} roles.")
+        return results
+
+    def _unassignment(self, user_id: int, course_id: int, role_id: int) -> Dict:
+        # one unassignments[i] entry for core_role_unassign_roles.
+        return {'roleid': role_id, 'userid': user_id,
+                'contextlevel': 'course',  # 50 is the context level for course.  A string.
+                'instanceid': course_id}
+
     def _user_has_role_in_course(self, user_id: int, course_id: int, role_id: int) -> bool:
         """
         Check if a user still has a specific role in a course
@@ -919,11 +2060,14 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         :param role_id: int: the role ID
         :return: bool: True if the user has the role, False otherwise
         """
-        enrolled_users = self.get_enroled_users(course_id)
-        result =  any(
-            user['user_id'] == user_id and user['role_id'] == role_id
-            for user in enrolled_users
-        )
+        with self._roster_lock:
+            roster = self.roster_cache.get(course_id)
+            if roster is not None:
+                result = (user_id, role_id) in roster
+        if roster is None:
+            # not cached, or forgotten by another thread.  Use the roster we fetch rather than looking it up again.
+            result = any(enrol['user_id'] == user_id and enrol['role_id'] == role_id
+                         for enrol in self.get_enroled_users(course_id))
         logger.debug(f"User {user_id} has role {role_id} in course {course_id}: {result}")
         return result
 
@@ -937,15 +2081,7 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
         :return: dict of user deleted with counts 1, or None if no change
         :raises ValueError: if the user or course does not exist
         """
-        user_id = self.api.get_user_id(user)
-        if user_id is None:
-            logger.error(f"User does not exist: {user}")
-            raise ValueError(f"User does not exist: {user}")
-
-        course_id = self.api.get_course_id(course)
-        if course_id is None:
-            logger.error(f"Course does not exist: {course_id}")
-            raise ValueError(f"Course does not exist: {course_id}")
+        user_id, course_id, _role_id = self._resolve_ids(user, course)
 
         params = {
             'wsfunction': 'enrol_manual_unenrol_users',
@@ -953,23 +2089,56 @@ class MoodleAPIEnrolmentProvider(MoodleEnrolmentProvider):
             'enrolments[0][courseid]': course_id
         }
 
+        if self.batch_writes:
+            self.unenrol_queue.add({'userid': user_id, 'courseid': course_id})
+            logger.debug(f"User {user_id} queued for deletion from course {course_id}")
+            return {"user_id": user_id, "course_id": course_id,
+                    "num_roles_deleted": 1, "num_participations_deleted": 1}
+
         data = self.api.execute(requests.post, params)
 
         if data is None:  # The API returns None on success
-            # logging.info(f"User {user_id} deleted from  course {course_id}")
-            # check to make sure this happened.
-            if not any([enrol['user_id'] == user_id for enrol in self.get_enroled_users(course_id)]):
-                logger.info(f"User {user_id} deleted from course {course_id}")
-                return {"user_id": user_id, "course_id": course_id,
-                        "num_roles_deleted": 1, "num_participations_deleted": 1}
-            else:
-                logger.debug(f"User {user_id} not in course {course_id} to delete.")
-                return None
+            self._roster_deleted({'userid': user_id, 'courseid': course_id})
+            logger.info(f"User {user_id} deleted from course {course_id}")
+            return {"user_id": user_id, "course_id": course_id,
+                    "num_roles_deleted": 1, "num_participations_deleted": 1}
         else:
             logger.error(f"Failed to delete user {user} from course {course_id}. API response: {data}")
             raise Exception(f"Failed to delete user {user} from course {course_id}. API response: {data}")
         pass
 
+    def course_delete_users(self, users: List[Union[int, str]], course: Union[str, int]) \
+            -> List[Union[None, Dict[str, int]]]:
+        """
+        Delete many users from a course with batched enrol_manual_unenrol_users calls.
+        :param users: list of user ids or usernames
+        :param course: int or str: the course id or shortname
+        :return: list in the same order with the course_delete_user result for each user,
+                 with counts of 0 and the error if Moodle rejected that user or the user or course doesn't exist.
+                 The others are still sent.
+        """
+        results: List[Optional[Dict]] = [None] * len(users)
+        positions, items = [], []
+        for i, user in enumerate(users):
+            try:
+                user_id, course_id, _role_id = self._resolve_ids(user, course)
+            except ValueError as e:
+                results[i] = {"user_id": user, "course_id": course,
+                              "num_roles_deleted": 0, "num_participations_deleted": 0, 'error': str(e)}
+                continue
+            positions.append(i)
+            items.append({'userid': user_id, 'courseid': course_id})
+
+        for i, result in zip(positions, self._send_batch(self.unenrol_queue, items)):
+            deleted = 1 if result['ok'] else 0
+            results[i] = {"user_id": result['item']['userid'], "course_id": result['item']['courseid'],
+                          "num_roles_deleted": deleted, "num_participations_deleted": deleted}
+            if not result['ok']:
+                results[i]['error'] = result['error']
+        logger.info(f"Deleted {sum(r['num_participations_deleted'] for r in results)} of {len(users)} users"
+                    f" from course {course}")
+        return results
+
     def __xxx_get_course_context_id(self, course_id: int) -> Union[int, None]:
         """
         Get the context ID for a given course.  removed because it requires a plugin.
@@ -1025,3 +2194,9 @@ class MoodleAPIUserProvider(MoodleUserProvider):
         user = self.api.get_user(email_username_or_id)
         return user
 
+    def prefetch_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> None:
+        """
+        Resolve all these users in a few bulk calls so later lookups come from the cache.
+        :param emails_usernames_or_ids: usernames, emails, or user ids
+        """
+        self.api.get_users(emails_usernames_or_ids)
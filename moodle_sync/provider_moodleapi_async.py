@@ -0,0 +1,910 @@
+# file: moodle_sync/provider_moodleapi_async.py
+
+import asyncio
+import contextlib
+import copy
+import json
+import queue
+import time
+import zlib
+import aiohttp
+import requests
+from typing import Union, Any, Dict, List, Iterable, Optional, AsyncIterator, Callable
+
+from moodle_sync.config import config
+from moodle_sync.logger import logger
+from moodle_sync.course import CategoryIndex, CourseSnapshot
+from moodle_sync.provider_moodleapi import MoodleAPI, MoodleAPICourseProvider, MoodleAPIEnrolmentProvider, \
+    MoodleAPIUserProvider, MoodleAPIWriteQueue, MoodleAPIError, iter_json_array
+
+"""
+Asyncio versions of the Moodle API client and the Moodle API providers.
+
+Moodle answers one web service call at a time per PHP request, so a sync that looks up hundreds of courses
+and rosters spends nearly all of its time waiting.  With these classes those lookups can all be in flight at once,
+up to max_concurrency per site.
+
+The async classes share the caches and roles of the regular MoodleAPI instance for the same site.
+Every provider method that talks to Moodle is a coroutine (iter_courses is an async generator), including the ones
+the base classes implement on top of them, like get_course_snapshot and update_courses.  The rest behave just like
+the regular providers.  CourseSync and EnrolmentSync are blocking, so use the regular providers with them.
+
+Usage:
+    async def main():
+        provider = AsyncMoodleAPICourseProvider(site, api_key)
+        courses = await asyncio.gather(*(provider.get_course(shortname) for shortname in shortnames))
+        await provider.api.close()
+
+    asyncio.run(main())
+"""
+
+
+class AsyncMoodleAPI:
+    """
+    The asyncio counterpart to MoodleAPI.  One instance for each Moodle site.
+
+    execute has the same semantics as MoodleAPI.execute:  pass requests.get or requests.post to say whether the
+    call reads or writes, dryrun skips the writes and returns dryrun_result, and errors raise the same exceptions.
+    At most max_concurrency calls are in flight to the site at once.
+    Calls share the rate limiter and retry rules of the MoodleAPI instance for the site.
+    """
+
+    _instances = {}  # one singleton instance for each Moodle site.
+
+    max_concurrency = 8  # default number of calls allowed in flight to a site at once.
+
+    def __new__(cls, site, api_key, *args, **kwargs):
+        if site not in cls._instances:
+            cls._instances[site] = super(AsyncMoodleAPI, cls).__new__(cls)
+        return cls._instances[site]
+
+    def __init__(self, site, api_key, max_concurrency: Optional[int] = None):
+        """
+        :param site: the Moodle host name
+        :param api_key: the web service token
+        :param max_concurrency: the number of calls allowed in flight at once.  Only used on first init.
+        """
+        if hasattr(self, '_AsyncMoodleAPI__initialized'):
+            # already initialized.  But allow updates to the api_key
+            self.api_key = api_key
+            self.sync_api.api_key = api_key
+            return
+        self.__initialized = True
+        self.site = site
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency if max_concurrency is not None else self.max_concurrency
+
+        # share the caches with the blocking client so both see the same lookups.
+        self.sync_api = MoodleAPI(site, api_key)
+        self.user_cache = self.sync_api.user_cache
+        self.course_cache = self.sync_api.course_cache
+
+        # the session and semaphore belong to an event loop, so they are made when first used in a loop.
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+        self._in_flight = {}  # identical reads in flight share one call.  See execute.
+
+        # useful for some debugging action
+        self.last_api_details = {}
+
+    @property
+    def endpoint(self):
+        return self.sync_api.endpoint
+
+    @property
+    def roles(self):
+        return self.sync_api.roles
+
+    def _session_for_loop(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._session is None or self._session.closed:
+            self._loop = loop
+            # decompress ourselves so the bytes on the wire can be counted.  See MoodleAPI.record_transfer.
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                                                  auto_decompress=False,
+                                                  headers={'Accept-Encoding': 'gzip, deflate'})
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._in_flight = {}
+        return self._session
+
+    async def close(self):
+        """
+        Close the connections for this site.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def execute(self_api, requests_func, params, dryrun_result=None) -> Any:
+        """
+        Execute a web service call.
+        Convention is that post makes changes.  If dryrun, then that will be logged but not executed.
+        :param requests_func:  requests.get,  requests.post
+        :param params: the parameters to post.
+        :param dryrun_result:  If provided, return this instead of invoking the actual result.
+        :return: data or raises an exception if an error.
+
+        Like MoodleAPI.execute, identical reads that are in flight at the same time share one call.
+        """
+        params['wstoken'] = self_api.api_key
+        params['moodlewsrestformat'] = 'json'
+
+        if requests_func != requests.get:
+            return await self_api._execute(requests_func, params, dryrun_result)
+
+        self_api._session_for_loop()  # resets the in flight calls if this is a new loop.
+        key = self_api.sync_api._flight_key(params)
+        in_flight = self_api._in_flight.get(key)
+        if in_flight is not None:
+            in_flight['waiters'] += 1
+            # the result is a snapshot nobody else holds, so copying it is safe.
+            return copy.deepcopy(await asyncio.shield(in_flight['future']))
+
+        flight = asyncio.get_running_loop().create_future()
+        in_flight = self_api._in_flight[key] = {'future': flight, 'waiters': 0}
+        # mark the exception as seen, in case nobody else was waiting for it.
+        flight.add_done_callback(lambda future: future.cancelled() or future.exception())
+        try:
+            data = await self_api._execute(requests_func, params, dryrun_result)
+            # the waiters run after our caller has had the data, and it may change it.  Give them a snapshot.
+            flight.set_result(copy.deepcopy(data) if in_flight['waiters'] else None)
+            return data
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                flight.cancel()
+            else:
+                flight.set_exception(e)
+            raise
+        finally:
+            del self_api._in_flight[key]
+
+    async def _execute(self_api, requests_func, params, dryrun_result=None) -> Any:
+        # make the call.  See execute.
+        if requests_func != requests.get and config.dryrun:
+            logger.debug(f"DRYRUN mode: API call details: ", params)
+            if dryrun_result is not None:
+                return dryrun_result
+
+        # store actual API details for debugging.
+        self_api.last_api_details['params'] = params
+        self_api.last_api_details['func'] = requests_func
+
+        async with self_api._open(requests_func, params) as response:
+            body = await response.read()
+        content = self_api._decompress(body, response.headers.get('Content-Encoding', ''))
+        sync_api = self_api.sync_api
+        sync_api.record_transfer(params.get('wsfunction'), len(body), len(content))
+        text = content.decode(response.charset or 'utf-8')
+        data = sync_api._decode(response.status, text, response.reason)
+        self_api.last_api_details['data'] = data
+
+        if config.debug:
+            logger.debug(f"API call successful: {requests_func.__name__} {params.get('wsfunction')}")
+        return data
+
+    @contextlib.asynccontextmanager
+    async def _open(self_api, requests_func, params) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Send the call when the rate limiter allows it, retrying if the site was busy like MoodleAPI._send_with_retry.
+        The response is open until the with block ends, and it holds one of the max_concurrency slots till then.
+        """
+        # aiohttp only takes str, int and float values.  requests leaves out None, so do the same.
+        query = {key: value if type(value) in (str, int, float) else str(value)
+                 for key, value in params.items() if value is not None}
+        session = self_api._session_for_loop()
+        sync_api = self_api.sync_api
+        timeout = aiohttp.ClientTimeout(total=sync_api._timeout(requests_func, params),
+                                        sock_connect=sync_api.connect_timeout)
+        if sync_api._use_post_body(query):
+            # too long for a query string.  See MoodleAPI._send.
+            method, data = 'post', {'data': query}
+        else:
+            method, data = requests_func.__name__, {'params': query}
+        attempt = 0
+        while True:
+            await asyncio.sleep(sync_api.limiter.reserve())
+            started = time.monotonic()
+            async with self_api._semaphore:
+                try:
+                    response = await session.request(method, self_api.endpoint, timeout=timeout, **data)
+                except asyncio.TimeoutError:
+                    delay = sync_api._retry_delay(requests_func, attempt)
+                    if delay is None:
+                        raise
+                    logger.info(f"API call {params.get('wsfunction')} timed out.  Retrying in {delay:.1f} seconds.")
+                else:
+                    self_api.last_api_details['response'] = response
+                    if sync_api._records_latency(requests_func, params):
+                        sync_api.limiter.record(time.monotonic() - started)
+                    delay = sync_api._retry_delay(requests_func, attempt, response.status,
+                                                  response.headers.get('Retry-After'))
+                    if delay is None:
+                        try:
+                            yield response
+                        finally:
+                            response.release()
+                        return
+                    logger.info(f"API call {params.get('wsfunction')} got status {response.status}.  "
+                                f"Retrying in {delay:.1f} seconds.")
+                    response.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def execute_stream(self_api, requests_func, params, key: Optional[str] = None) -> AsyncIterator[Any]:
+        """
+        The asyncio counterpart to MoodleAPI.execute_stream:  the records of a big list are decoded as the response
+        arrives and yielded one at a time.  The decoding runs in a worker thread, fed with the chunks as they come in.
+        :param requests_func:  requests.get,  requests.post
+        :param params: the parameters to send.
+        :param key: if the response is a dict with the list in it, the key for the list.  e.g. 'courses'
+        """
+        params['wstoken'] = self_api.api_key
+        params['moodlewsrestformat'] = 'json'
+        if requests_func != requests.get and config.dryrun:
+            logger.debug(f"DRYRUN mode: API call details: ", params)
+            return
+
+        self_api.last_api_details['params'] = params
+        self_api.last_api_details['func'] = requests_func
+        sync_api = self_api.sync_api
+        loop = asyncio.get_running_loop()
+        async with self_api._open(requests_func, params) as response:
+            if response.status != 200:
+                body = self_api._decompress(await response.read(), response.headers.get('Content-Encoding', ''))
+                sync_api._decode(response.status, body.decode(response.charset or 'utf-8'), response.reason)  # raises
+
+            chunks = queue.Queue()  # bytes for the decoder thread.  None when there are no more.
+            records = asyncio.Queue()  # ('record', value), then ('done', returned document) or ('error', exception)
+
+            def decode():
+                parser = iter_json_array(iter(chunks.get, None), key)
+                try:
+                    while True:
+                        loop.call_soon_threadsafe(records.put_nowait, ('record', next(parser)))
+                except StopIteration as stop:
+                    loop.call_soon_threadsafe(records.put_nowait, ('done', stop.value))
+                except Exception as e:
+                    loop.call_soon_threadsafe(records.put_nowait, ('error', e))
+
+            async def feed():
+                wire, uncompressed = 0, 0
+                decompressor = self_api._decompressor(response.headers.get('Content-Encoding', ''))
+                try:
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        wire += len(chunk)
+                        chunk = decompressor(chunk)
+                        uncompressed += len(chunk)
+                        chunks.put(chunk)
+                    chunk = decompressor(None)
+                    uncompressed += len(chunk)
+                    chunks.put(chunk)
+                    sync_api.record_transfer(params.get('wsfunction'), wire, uncompressed)
+                except Exception as e:
+                    loop.call_soon_threadsafe(records.put_nowait, ('error', e))
+                finally:
+                    chunks.put(None)
+
+            decoding = loop.run_in_executor(None, decode)
+            feeding = asyncio.ensure_future(feed())
+            try:
+                while True:
+                    kind, value = await records.get()
+                    if kind == 'record':
+                        yield value
+                    elif kind == 'error':
+                        raise value
+                    else:
+                        break
+            finally:
+                feeding.cancel()
+                chunks.put(None)  # lets the decoder finish if we stopped early.
+                await asyncio.gather(feeding, decoding, return_exceptions=True)
+
+        if value is not None:
+            # not the list we wanted - like a Moodle exception.  It came back whole.
+            data = sync_api._decode(response.status, json.dumps(value), response.reason)
+            for record in (data if isinstance(data, list) or key is None else data.get(key, [])):
+                yield record
+
+        if config.debug:
+            logger.debug(f"API call successful: {requests_func.__name__} {params.get('wsfunction')}")
+
+    @staticmethod
+    def _decompressor(content_encoding: str) -> Callable[[Optional[bytes]], bytes]:
+        # a function that undoes the Content-Encoding a chunk at a time.  Call it with None at the end.
+        content_encoding = content_encoding.strip().lower()
+        if content_encoding not in ('gzip', 'deflate'):
+            return lambda chunk: chunk or b''
+        state = {'decompressor': zlib.decompressobj(16 + zlib.MAX_WBITS if content_encoding == 'gzip'
+                                                    else zlib.MAX_WBITS), 'started': False}
+
+        def decompress(chunk: Optional[bytes]) -> bytes:
+            if chunk is None:
+                return state['decompressor'].flush()
+            try:
+                data = state['decompressor'].decompress(chunk)
+            except zlib.error:
+                if state['started'] or content_encoding != 'deflate':
+                    raise
+                # some servers send raw deflate.  See _decompress.
+                state['decompressor'] = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = state['decompressor'].decompress(chunk)
+            state['started'] = True
+            return data
+        return decompress
+
+    @staticmethod
+    def _decompress(body: bytes, content_encoding: str) -> bytes:
+        # undo the Content-Encoding of a response.
+        content_encoding = content_encoding.strip().lower()
+        if content_encoding == 'gzip':
+            return zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        if content_encoding == 'deflate':
+            try:
+                return zlib.decompress(body)
+            except zlib.error:
+                return zlib.decompress(body, -zlib.MAX_WBITS)  # some servers send raw deflate
+        return body
+
+    async def get_user_id(self, email_username_or_id: Union[str, int]) -> Union[int, None]:
+        user = await self.get_user(email_username_or_id)
+        return user['id'] if user else None
+
+    async def get_user(self, email_username_or_id: Union[str, int]) -> Union[dict, None]:
+        """
+        Get the user for the given email, username or user ID.  Return None if not found.  Cache the result.
+        """
+        if email_username_or_id in self.user_cache:
+            return self.user_cache[email_username_or_id]
+
+        key, value = self.sync_api._user_field(email_username_or_id)
+        params = {
+            'wsfunction': 'core_user_get_users_by_field',
+            'field': key,
+            'values[0]': value
+        }
+        data = await self.execute(requests.get, params)
+
+        if data and len(data) > 0:
+            user = data[0]
+            self.sync_api._cache_user(user)
+            return user
+
+        # If no user found, cache the negative result to avoid future API calls
+        self.user_cache[email_username_or_id] = None
+        return None
+
+    async def get_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) \
+            -> Dict[Union[str, int], Union[dict, None]]:
+        """
+        Look up many users at once.  The batches are the same as MoodleAPI.get_users, but sent concurrently.
+        :return: dict of each key passed in to its user dict, or None if the user doesn't exist
+        """
+        keys = list(dict.fromkeys(emails_usernames_or_ids))
+        batches = self.sync_api._user_batches(keys)
+        results = await asyncio.gather(*(self.execute(requests.get, params) for params, _wanted in batches))
+        for (params, wanted), data in zip(batches, results):
+            self.sync_api._cache_user_batch(params['field'], wanted, data)
+        return {key: self.user_cache.get(key) for key in keys}
+
+    async def create_user(self, username: str, email: str, firstname: str, lastname: str, auth: str, password: str):
+        params = {
+            'wsfunction': 'core_user_create_users',
+            'users[0][username]': username,
+            'users[0][auth]': auth,
+            'users[0][email]': email,
+            'users[0][firstname]': firstname,
+            'users[0][lastname]': lastname,
+            'users[0][password]': password
+        }
+        result = await self.execute(requests.post, params)
+        return result[0].get('id') if type(result) is list and type(result[0]) is dict else None
+
+    async def load_categories(self_api, refresh: bool = False) -> CategoryIndex:
+        """
+        Fetch every category in one call and index them.  Shared with the blocking client.
+        """
+        if self_api.sync_api.categories is None or refresh:
+            data = await self_api.execute(requests.get, params={'wsfunction': 'core_course_get_categories'})
+            self_api.sync_api.categories = CategoryIndex(data)
+        return self_api.sync_api.categories
+
+    async def get_category(self_api, name_or_id: Union[str, int]) -> int:
+        """
+        Look up the category by name or ID.  Uses the loaded categories if there are any.
+        :raise Raises ValueError if category not found
+        """
+        assert type(name_or_id) is str or type(name_or_id) is int, "name_or_id must be category name (str) or id (int)"
+        if self_api.sync_api.categories is not None:
+            return self_api.sync_api.get_category(name_or_id)
+        params = {
+            'wsfunction': 'core_course_get_categories',
+            'criteria[0][key]': 'name' if type(name_or_id) is str else 'id',
+            'criteria[0][value]': name_or_id
+        }
+        data = await self_api.execute(requests.get, params=params)
+        if len(data) > 0:
+            return data[0]["id"]
+        logger.debug(f"Category not found: {name_or_id}")
+        raise ValueError(f"Category not found: {name_or_id}")
+
+    async def get_role_id(self, rolename_or_id: Union[str, int]) -> Union[int, None]:
+        """
+        Get the role id for the given role name or role ID.
+        Roles are defined locally unless the webservice get roles plugin is installed.  That lookup is rare,
+        so it runs the blocking client in a thread.
+        """
+        if not self.sync_api.webservice_get_roles_installed:
+            return self.sync_api.get_role_id(rolename_or_id)
+        return await asyncio.to_thread(self.sync_api.get_role_id, rolename_or_id)
+
+    async def get_course_id(self, shortname_or_id: Union[str, int]) -> Union[int, None]:
+        """
+        Get the course id for the given course shortname or course ID.
+        :return: int: the course id, or None if the course doesn't exist
+        """
+        if shortname_or_id in self.course_cache:
+            return self.course_cache[shortname_or_id]
+
+        if isinstance(shortname_or_id, int) or shortname_or_id.isdigit():
+            field, value = 'id', str(shortname_or_id)
+        else:
+            field, value = 'shortname', shortname_or_id
+
+        params = {
+            'wsfunction': 'core_course_get_courses_by_field',
+            'field': field,
+            'value': value
+        }
+        data = await self.execute(requests.get, params)
+
+        if data and 'courses' in data and len(data['courses']) > 0:
+            course = data['courses'][0]
+            course_id = course['id']
+            # Cache both the shortname and course ID
+            self.course_cache[course['shortname']] = course_id
+            self.course_cache[course_id] = course_id
+            return course_id
+
+        # If no course found, cache the negative result to avoid future API calls
+        self.course_cache[shortname_or_id] = None
+        return None
+
+
+class AsyncMoodleAPIWriteQueue(MoodleAPIWriteQueue):
+    """
+    MoodleAPIWriteQueue for an AsyncMoodleAPI.  add and flush are coroutines, and the chunks are sent concurrently.
+    Failed chunks are split and results are reported the same way.
+    """
+
+    async def add(self, item: Dict[str, Any]) -> None:
+        self.items.append(item)
+        if len(self.items) >= self.chunk_size:
+            items, self.items = self.items, []
+            self.results.extend(await self._send_all(items))
+
+    async def flush(self) -> List[Dict]:
+        items, self.items = self.items, []
+        results, self.results = self.results, []
+        return results + await self._send_all(items)
+
+    async def _send_all(self, items: List[Dict]) -> List[Dict]:
+        chunks = await asyncio.gather(*(self._send(items[start:start + self.chunk_size])
+                                        for start in range(0, len(items), self.chunk_size)))
+        results = [result for chunk in chunks for result in chunk]
+        failed = [result for result in results if not result['ok']]
+        if items:
+            logger.debug(f"{self.wsfunction}: sent {len(results)} items, {len(failed)} failed.")
+        return results
+
+    async def _send(self, items: List[Dict]) -> List[Dict]:
+        try:
+            data = await self.api.execute(requests.post, self._params(items), dryrun_result=True)
+        except MoodleAPIError as e:
+            if len(items) > 1:
+                middle = len(items) // 2
+                halves = await asyncio.gather(self._send(items[:middle]), self._send(items[middle:]))
+                return halves[0] + halves[1]
+            return self._failed(items, e)
+        except Exception as e:
+            return self._failed(items, e)
+        return self._succeeded(items, data)
+
+
+class AsyncMoodleAPICourseProvider(MoodleAPICourseProvider):
+    """
+    MoodleAPICourseProvider where every method that talks to Moodle is a coroutine.
+    """
+
+    def __init__(self, site, api_key, templates=None):
+        super().__init__(site, api_key, templates=templates)
+        self.api = AsyncMoodleAPI(site, api_key)
+
+    async def _get_template(self, shortname: str) -> int:
+        matcher = self.template_matcher
+        result = matcher.match(shortname)
+        if type(result) is str:
+            template_shortname = result
+            result = matcher.template_ids.get(template_shortname)
+            if result is None:
+                result = await self.api.get_course_id(template_shortname)
+                if result is not None:
+                    matcher.template_ids[template_shortname] = result
+        return result
+
+    async def get_course(self, shortname_or_id: Union[str, int]) -> Union[dict, None]:
+        """
+        Return the course  for the  given shortname or course id
+        """
+        field = 'shortname' if type(shortname_or_id) is str else 'id'
+        courses_matching = await self.get_courses(field=field, value=shortname_or_id)
+        return courses_matching[0] if courses_matching else None
+
+    async def get_courses(self, field=None, value=None):
+        params = {
+            'wsfunction': 'core_course_get_courses',
+        }
+        if field:
+            params['field'] = field
+            params['value'] = value
+            params['wsfunction'] = 'core_course_get_courses_by_field'
+
+        data = await self.api.execute(requests.get, params=params)
+        courses = data if isinstance(data, list) else data.get('courses', [])
+        for course in courses:
+            self._flatten_courseformatoptions(course)
+        logger.debug(f"Retrieved {len(courses)} courses")
+        return courses
+
+    async def iter_courses(self, field=None, value=None) -> AsyncIterator[dict]:
+        """
+        An async generator over the courses, decoded as the response arrives.  See MoodleAPICourseProvider.iter_courses.
+        """
+        params = {'wsfunction': 'core_course_get_courses'}
+        if field:
+            params.update({'wsfunction': 'core_course_get_courses_by_field', 'field': field, 'value': value})
+        logger.debug("Streaming courses: " + str(params))
+
+        count = 0
+        async for course in self.api.execute_stream(requests.get, params, key='courses' if field else None):
+            self._flatten_courseformatoptions(course)
+            count += 1
+            yield course
+        logger.debug(f"Retrieved {count} courses")
+
+    async def get_course_snapshot(self, keys: Iterable[str] = CourseSnapshot.default_keys,
+                                  keep: Optional[Callable[[Dict], bool]] = None,
+                                  category_ids: Optional[Iterable[int]] = None) -> CourseSnapshot:
+        """
+        Get the courses as a CourseSnapshot.  See MoodleCourseProvider.get_course_snapshot.
+        With category_ids, the categories are fetched concurrently.
+        """
+        snapshot = CourseSnapshot(keys=keys)
+
+        async def add_courses(field=None, value=None):
+            async for course in self.iter_courses(field, value):
+                if keep is None or keep(course):
+                    snapshot.add(course)
+
+        if category_ids is None:
+            await add_courses()
+        else:
+            await asyncio.gather(*(add_courses('category', category_id) for category_id in category_ids))
+        return snapshot
+
+    async def create_course(self, course: dict, known_absent: bool = False, category_id: Union[int, None] = None,
+                            template_id: Union[int, None] = None) -> Union[int, None]:
+        """
+        Create the course from a template. Use default template if not found.
+        See MoodleAPICourseProvider.create_course for the parameters.
+        :return: course ID if course was created else None
+        :raises: ValueError if categoryid not found (from the course dict)
+        """
+        if not known_absent:
+            existing_course = await self.get_course(course['shortname'])
+            if existing_course:
+                logger.error(f"Course already exists with shortname: {course['shortname']}")
+                raise ValueError(f"Course already exists with shortname: {course['shortname']}")
+
+        course['categoryid'] = category_id if category_id is not None \
+            else await self.api.get_category(course['categoryid'])
+
+        course_basics = {
+            'fullname': course['fullname'],
+            'shortname': course['shortname'],
+            'categoryid': course['categoryid'],
+        }
+        params = {
+            'wsfunction': 'core_course_duplicate_course',
+            'courseid': template_id if template_id is not None else await self._get_template(course['shortname']),
+        }
+        params.update(course_basics)
+        data = await self.api.execute(requests.post, params, dryrun_result={'id': -999} if config.dryrun else None)
+
+        new_course_id = data['id'] if data else None
+        if config.dryrun:
+            logger.info(f"Dryrun Mode - Skip Update id {new_course_id}: {course_basics} ")
+            return
+
+        if new_course_id:
+            await self.update_course(course, force_all_fields=True, course_id=new_course_id)
+        else:
+            logger.error(f"Course not created: {course['shortname']}")
+        return new_course_id
+
+    async def update_course(self, course: dict, force_all_fields=False, course_id: Union[int, None] = None):
+        """
+        Update the course with the dict values.  See MoodleAPICourseProvider.update_course.
+        """
+        if course_id is not None:
+            existing_course = {'id': course_id}
+        elif config.dryrun:
+            existing_course = {'id': -999}
+        else:
+            existing_course = await self.get_course(course['shortname'])
+        if not existing_course:
+            logger.error(f"Existing Course not found: {course['shortname']}")
+            raise ValueError(f"Existing Course not found: {course['shortname']}")
+
+        params = self._update_course_params(course, existing_course['id'], force_all_fields)
+        await self.api.execute(requests.post, params, dryrun_result=course if config.dryrun else None)
+        logger.debug(f"Course {existing_course['id']} Updated: {course['shortname']} with:  \n   ", params)
+
+    async def update_courses(self, courses: List[dict], course_ids: Union[List[Union[int, None]], None] = None, *,
+                             force_all_fields=False) -> List[Dict]:
+        """
+        Update many courses.  See MoodleAPICourseProvider.update_courses.
+        The courses without an id are looked up concurrently, and the batches are sent concurrently.
+        """
+        if course_ids is None:
+            course_ids = [None] * len(courses)
+        missing = [i for i, course_id in enumerate(course_ids) if course_id is None]
+        found = await asyncio.gather(*(self._existing_course_id(courses[i]) for i in missing))
+        course_ids = list(course_ids)
+        for i, course_id in zip(missing, found):
+            course_ids[i] = course_id
+        items = self._course_update_items(courses, course_ids, force_all_fields)
+        queue = AsyncMoodleAPIWriteQueue(self.api, 'core_course_update_courses', 'courses', self.update_batch_size,
+                                         item_id_key='id')
+        for item in items:
+            if item is not None:
+                await queue.add(item)
+        return self._course_update_results(courses, items, await queue.flush())
+
+    async def _existing_course_id(self, course: dict) -> Union[int, None]:
+        existing_course = {'id': -999} if config.dryrun else await self.get_course(course['shortname'])
+        return existing_course['id'] if existing_course else None
+
+    async def get_category(self, name_or_id: Union[str, int]) -> int:
+        return await self.api.get_category(name_or_id)
+
+    async def load_categories(self, refresh: bool = False) -> CategoryIndex:
+        return await self.api.load_categories(refresh)
+
+    async def create_category(self, category_name, category_parent_name: Union[str, None] = None) -> int:
+        """
+        Create a category with the given name and parent name.
+        :return: int: the category id
+        """
+        parent_id = await self.get_category(category_parent_name) if category_parent_name else None
+
+        params = {
+            'wsfunction': 'core_course_create_categories',
+            'categories[0][name]': category_name,
+        }
+        if category_parent_name:
+            params['categories[0][parent]'] = parent_id
+        data = await self.api.execute(requests.post, params, dryrun_result=[{'id': -99}] if config.dryrun else None)
+        logger.debug(f"Category Created: {category_name} id {data[0]['id']}")
+        if not config.dryrun:  # the dryrun id is made up, so keep it out of the category index.
+            self.api.sync_api.add_category({'id': data[0]['id'], 'name': category_name, 'parent': parent_id or 0})
+        return data[0]['id']
+
+
+class AsyncMoodleAPIEnrolmentProvider(MoodleAPIEnrolmentProvider):
+    """
+    MoodleAPIEnrolmentProvider where every method that talks to Moodle is a coroutine.
+    Writes are sent right away; run them concurrently with asyncio.gather instead of queueing them.
+    The roster cache works the same way as in MoodleAPIEnrolmentProvider.
+    """
+
+    def __init__(self, site, api_key):
+        super().__init__(site, api_key)
+        self.api = AsyncMoodleAPI(site, api_key)
+
+    async def get_role_id(self, role: str) -> Union[None, int]:
+        return await self.api.get_role_id(role)
+
+    async def get_user_id(self, email_username_or_id: Union[str, int]) -> Union[int, None]:
+        return await self.api.get_user_id(email_username_or_id)
+
+    async def get_username(self, user_id: int) -> Union[None, str]:
+        user = await self.api.get_user(user_id)
+        return user['username'] if user else None
+
+    async def prefetch_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> None:
+        await self.api.get_users(emails_usernames_or_ids)
+
+    async def get_course_id(self, shortname: str) -> Union[None, int]:
+        return await self.api.get_course_id(shortname)
+
+    async def get_enroled_users(self, course: Union[str, int], refresh: bool = False) -> List[Dict[str, int]]:
+        """
+        Return a list of users and roles for a course.  See MoodleAPIEnrolmentProvider.get_enroled_users.
+        """
+        course_id = await self.api.get_course_id(course)
+        if course_id is None:
+            raise ValueError(f"Course does not exist: {course}")
+
+        if course_id in self.roster_cache and not refresh:
+            return list(self.roster_cache[course_id].values())
+
+        params = {
+            'wsfunction': 'core_enrol_get_enrolled_users',
+            'courseid': course_id
+        }
+        data = await self.api.execute(requests.get, params)
+        if type(data) is list:
+            enrolment_list = [
+                {'user_id': user['id'], 'course_id': course_id, 'role_id': role['roleid'], 'role': role['shortname']}
+                for user in data
+                for role in user['roles'] if role['shortname'] in self.roles_to_sync
+            ]
+        else:
+            enrolment_list = []
+        logger.debug(f"Retrieved {len(enrolment_list)} enrolments for course {course_id}")
+        self.roster_cache[course_id] = {(enrol['user_id'], enrol['role_id']): enrol for enrol in enrolment_list}
+        return enrolment_list
+
+    async def invalidate_roster(self, course: Union[str, int, None] = None) -> None:
+        if course is None:
+            self.roster_cache.clear()
+        else:
+            self.roster_cache.pop(await self.api.get_course_id(course), None)
+
+    async def prefetch_rosters(self, courses: Iterable[Union[str, int]]) -> None:
+        # see MoodleAPIEnrolmentProvider.prefetch_rosters.
+        await self.invalidate_roster()
+
+    async def _resolve_ids(self, user: Union[int, str], course: Union[int, str], role: Union[int, str, None] = None) \
+            -> tuple:
+        user_id, course_id, role_id = await asyncio.gather(
+            self.api.get_user_id(user), self.api.get_course_id(course),
+            self.api.get_role_id(role) if role is not None else asyncio.sleep(0))
+        if user_id is None:
+            logger.error(f"User does not exist: {user}")
+            raise ValueError(f"User does not exist: {user}")
+        if course_id is None:
+            logger.error(f"Course does not exist: {course}")
+            raise ValueError(f"Course does not exist: {course}")
+        if role is not None and role_id is None:
+            logger.error(f"Role does not exist: {role}")
+            raise ValueError(f"Role does not exist: {role}")
+        return user_id, course_id, role_id
+
+    async def _user_has_role_in_course(self, user_id: int, course_id: int, role_id: int) -> bool:
+        roster = self.roster_cache.get(course_id)
+        if roster is not None:
+            return (user_id, role_id) in roster
+        # another task may forget the roster while this one waits for it, so use the one fetched.
+        return any(enrol['user_id'] == user_id and enrol['role_id'] == role_id
+                   for enrol in await self.get_enroled_users(course_id))
+
+    async def course_enrol_user(self, user: Union[int, str], course: Union[str, int],
+                                role: Union[str, int] = 'student') -> Union[None, Dict[str, int]]:
+        """
+        Add a user to a course with a role.
+        :return: None if the user already had the role, or dict of the user with counts as 1
+        """
+        user_id, course_id, role_id = await self._resolve_ids(user, course, role)
+        if await self._user_has_role_in_course(user_id, course_id, role_id):
+            logger.debug(f"User {user} already enrolled in role {role} in course {course_id}")
+            return None
+        item = {'roleid': role_id, 'userid': user_id, 'courseid': course_id}
+        params = {'wsfunction': 'enrol_manual_enrol_users',
+                  **{f'enrolments[0][{key}]': value for key, value in item.items()}}
+        data = await self.api.execute(requests.post, params, dryrun_result='yes!')
+        if data is None or data == 'yes!':  # The API returns None on success.
+            self._roster_enrolled(item)
+            logger.info(f"User {user_id} enrolled in role {role_id} in course {course_id}")
+            return {"user_id": user_id, "course_id": course_id, "role_id": role_id,
+                    "num_new_enrols": 1, "num_roles_added": 1}
+        logger.error(f"Failed to add user {user} to course {course_id}. API response: {data}")
+        raise Exception(f"Failed to add user {user} to course {course_id}. API response: {data}")
+
+    async def course_unenrol_user(self, user: Union[int, str], course: Union[int, str], role: Union[int, str]) \
+            -> Union[None, Dict[str, int]]:
+        """
+        Unenrol a user from the given role in a course.
+        :return: Dict with user_id, course_id, role_id, and num_roles_deleted, or None if no change.
+        """
+        user_id, course_id, role_id = await self._resolve_ids(user, course, role)
+        if not await self._user_has_role_in_course(user_id, course_id, role_id):
+            logger.debug(f"User already {user} not enrolled in role {role} in course {course_id}")
+            return None
+        item = self._unassignment(user_id, course_id, role_id)
+        params = {'wsfunction': 'core_role_unassign_roles',
+                  **{f'unassignments[0][{key}]': value for key, value in item.items()}}
+        data = await self.api.execute(requests.post, params, dryrun_result=True)
+        if data is None:
+            self._roster_unassigned(item)
+            logger.info(f"User {user_id} unenrolled from role {role_id} in course {course_id}")
+            return {"user_id": user_id, "course_id": course_id, "role_id": role_id, "num_roles_deleted": 1}
+        logger.error(f"Failed to unenrol user {user} from course {course_id}. API response: {data}")
+        return None
+
+    async def course_delete_user(self, user: Union[int, str], course: Union[str, int]) \
+            -> Union[None, Dict[str, int]]:
+        """
+        Delete a user from a course.
+        :return: dict of user deleted with counts 1
+        """
+        user_id, course_id, _role_id = await self._resolve_ids(user, course)
+        item = {'userid': user_id, 'courseid': course_id}
+        params = {'wsfunction': 'enrol_manual_unenrol_users',
+                  **{f'enrolments[0][{key}]': value for key, value in item.items()}}
+        data = await self.api.execute(requests.post, params)
+        if data is None:  # The API returns None on success
+            self._roster_deleted(item)
+            logger.info(f"User {user_id} deleted from course {course_id}")
+            return {"user_id": user_id, "course_id": course_id,
+                    "num_roles_deleted": 1, "num_participations_deleted": 1}
+        logger.error(f"Failed to delete user {user} from course {course_id}. API response: {data}")
+        raise Exception(f"Failed to delete user {user} from course {course_id}. API response: {data}")
+
+    async def course_unenrol_users(self, unenrolments: List[Dict[str, Union[int, str]]]) -> List[Union[None, Dict]]:
+        """
+        Unenrol many users from roles concurrently.
+        :return: list of the course_unenrol_user results, in the same order.
+        """
+        return list(await asyncio.gather(*(self.course_unenrol_user(u['user'], u['course'], u['role'])
+                                           for u in unenrolments)))
+
+    async def course_delete_users(self, users: List[Union[int, str]], course: Union[str, int]) \
+            -> List[Union[None, Dict[str, int]]]:
+        """
+        Delete many users from a course concurrently.
+        :return: list of the course_delete_user results, in the same order.
+        """
+        return list(await asyncio.gather(*(self.course_delete_user(user, course) for user in users)))
+
+    async def flush(self) -> List[Dict]:
+        # writes are never queued by this provider.
+        return []
+
+    def _send_batch(self, queue, items: List[Dict]) -> List[Dict]:
+        # the blocking write queues can't send through the async client.  The bulk methods here don't use them.
+        raise NotImplementedError("AsyncMoodleAPIEnrolmentProvider sends each write on its own.  See flush.")
+
+
+class AsyncMoodleAPIUserProvider(MoodleAPIUserProvider):
+    """
+    MoodleAPIUserProvider where every method that talks to Moodle is a coroutine.
+    """
+
+    def __init__(self, site, api_key):
+        super().__init__(site, api_key)
+        self.api = AsyncMoodleAPI(site, api_key)
+
+    async def create_user(self, username: str, email: str, firstname: str, lastname: str,
+                          auth: str = None, password: str = None, **kwargs) -> Union[None, int]:
+        if password is None:
+            import random
+            # generate a random 8 digit password of numbers
+            password = str(random.randint(10000000, 99999999))
+        if auth is None:
+            auth = self.default_auth_method
+        return await self.api.create_user(username, email, firstname, lastname, auth, password)
+
+    async def get_user(self, email_username_or_id: Union[str, int]) -> Union[None, dict]:
+        return await self.api.get_user(email_username_or_id)
+
+    async def prefetch_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> None:
+        await self.api.get_users(emails_usernames_or_ids)
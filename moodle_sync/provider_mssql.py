@@ -1,5 +1,6 @@
 import pyodbc
 import datetime
+import threading
 
 from typing import Union, Dict, List, Set
 
@@ -8,6 +9,7 @@ from moodle_sync.enrolment import MoodleEnrolmentProvider
 from moodle_sync.user import MoodleUserProvider
 
 from moodle_sync.config import config
+from moodle_sync.logger import logger
 
 class MoodleMSSQLCourseProvider(MoodleCourseProvider):
 
@@ -19,16 +21,20 @@ class MoodleMSSQLCourseProvider(MoodleCourseProvider):
     Extra fields are okay.
 
     Field types and values should be Moodle ready.
+
+    If the course table has a column with the date and time each row last changed, pass it as change_column
+    and CourseSync can fetch just the changed rows.  See get_courses_modified_since.
     """
-    def __init__(self, connection_string:str, course_table:str=None):
+    def __init__(self, connection_string:str, course_table:str=None, change_column: str = None):
 
         super().__init__()
         self.connection_string = connection_string
         self.course_table = course_table
         self.convert_dates = True  # do this by default, but it is an option.
+        self.change_column = change_column  # a datetime column.  It is returned as a unix timestamp.
         pass
 
-    def get_courses(self):
+    def get_courses(self, field: Union[str, None] = None, value: Union[str, None] = None) -> List[Dict]:
         """
         Return a list of dictionaries of courses from a MSSQL course as specified in course_table.
 
@@ -36,11 +42,34 @@ class MoodleMSSQLCourseProvider(MoodleCourseProvider):
         You can call this function at the END of your derived class if you want some sanity checks
         after setting the self.courses in your own get_courses implementation.
 
+        :param field: str:  optional column to filter on.
+        :param value: the value the column must have.
         :return: List[dict]:  list of courses with fields and values.
         """
+        if field:
+            return self._select_courses(f"WHERE [{field}] = ?", (value,))
+        self.courses = self._select_courses()
+        return self.courses
+
+    def get_courses_modified_since(self, since: int) -> List[Dict]:
+        """
+        Get the courses whose change_column is at or after since.
+        :param since: unix timestamp
+        """
+        if not self.change_column:
+            raise NotImplementedError("No change_column given for the course table.")
+        return self._select_courses(f"WHERE [{self.change_column}] >= ?", (datetime.datetime.fromtimestamp(since),))
+
+    def _select_courses(self, where: str = '', params: tuple = ()) -> List[Dict]:
+        """
+        Read courses from the course table.
+        :param where: optional SQL to filter the rows, like "WHERE term = ?"
+        :param params: the values for the ? placeholders in where.
+        :return: List[dict]:  the courses, with dates as unix timestamps if convert_dates is on.
+        """
         with pyodbc.connect(self.connection_string) as conn:
             cursor = conn.cursor()
-            cursor.execute(f"SELECT * FROM {self.course_table}")
+            cursor.execute(f"SELECT * FROM {self.course_table} {where}", *params)
             columns = [column[0] for column in cursor.description]
             types   = [column[1] for column in cursor.description]   # might be kinda interesting!
             data = cursor.fetchall()
@@ -48,9 +77,11 @@ class MoodleMSSQLCourseProvider(MoodleCourseProvider):
         courses = [dict(zip(columns, row)) for row in data]
         if self.convert_dates:
             courses = [self.convert_dates_timezone_unaware(course) for course in courses]
-        self.courses = courses
-        return self.courses
-
+        if self.change_column:
+            for course in courses:
+                if isinstance(course.get(self.change_column), datetime.datetime):
+                    course[self.change_column] = int(course[self.change_column].timestamp())
+        return courses
 
     def convert_dates_timezone_unaware(self, course):
         """
@@ -75,19 +106,77 @@ class MoodleMSSQLCourseProvider(MoodleCourseProvider):
 
 
 class MoodleMSSQLEnrolmentProvider(MoodleEnrolmentProvider):
+    """
+    Enrolments from a SQL Server table or view, with one row per user per course.
+
+    With bulk=True the enrollment table is read once per sync, ordered by shortname, and the rows are grouped by
+    course as they stream in.  get_course_shortnames_for_sync and every get_enroled_users call are answered from
+    that, instead of running the query once per course.  Use it when the enrollment table is an expensive view.
+    """
+
+    # Convert role names to Moodle standard names if necessary
+    role_mapping = {
+        'student': 'student',
+        'instructor': 'editingteacher',
+        # Add more mappings as needed
+    }
+
+    fetch_size = 5000  # rows fetched at a time in bulk mode.
 
-    def __init__(self, connection_string: str, enrollment_table: str):
+    def __init__(self, connection_string: str, enrollment_table: str, bulk: bool = False):
         """
 
         :param connection_string: The PYODBC connection string for the database
         :param enrollment_table: The table from which to pull enrollments
-        :param user_table: the table from which to pull users.  None if no sync users.
+        :param bulk: read all the enrollments at once and answer from memory.  See load_enrolments.
         """
         super().__init__()
         self.connection_string = connection_string
         self.enrollment_table = enrollment_table
+        self.bulk = bulk
+        self.enrolments_by_course = None  # shortname: list of enrollments, once loaded in bulk mode.
+        self._load_lock = threading.Lock()
 
+    def _map_role(self, enrollment: Dict) -> Dict:
+        if 'role' in enrollment:
+            enrollment['role'] = self.role_mapping.get(enrollment['role'].lower(), enrollment['role'])
+        return enrollment
 
+    def load_enrolments(self, refresh: bool = False) -> Dict[str, List[Dict]]:
+        """
+        Read the whole enrollment table in one query, ordered by shortname, and group the rows by course.
+        The rows are fetched fetch_size at a time, so the grouping happens as they arrive.
+        :param refresh: read them again even if they are already loaded.
+        :return: dict of shortname to the list of enrollments for that course.
+        """
+        with self._load_lock:
+            if self.enrolments_by_course is not None and not refresh:
+                return self.enrolments_by_course
+            query = f"SELECT {', '.join(self.fields)} FROM {self.enrollment_table} ORDER BY shortname"
+            if config.debug:
+                print(f"Query: {query}")
+            enrolments_by_course = {}
+            count = 0
+            with pyodbc.connect(self.connection_string) as conn:
+                cursor = conn.cursor()
+                cursor.execute(query)
+                columns = [column[0] for column in cursor.description]
+                shortname_index = columns.index('shortname')
+                shortname, course_enrolments = None, None
+                while True:
+                    rows = cursor.fetchmany(self.fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        # rows come ordered by shortname, so a new shortname starts a new course.
+                        if course_enrolments is None or row[shortname_index] != shortname:
+                            shortname = row[shortname_index]
+                            course_enrolments = enrolments_by_course.setdefault(shortname, [])
+                        course_enrolments.append(self._map_role(dict(zip(columns, row))))
+                    count += len(rows)
+            logger.info(f"Loaded {count} enrollments for {len(enrolments_by_course)} courses.")
+            self.enrolments_by_course = enrolments_by_course
+            return enrolments_by_course
 
     def get_enroled_users(self, course: Union[str, int] = None) -> List[Dict[str, Union[int, str]]]:
         """
@@ -96,6 +185,12 @@ class MoodleMSSQLEnrolmentProvider(MoodleEnrolmentProvider):
         :param course: Optional. If provided, fetch enrollments for this specific course.
         :return: List of dictionaries containing enrollment data.
         """
+        if self.bulk:
+            enrolments_by_course = self.load_enrolments()
+            if course:
+                return list(enrolments_by_course.get(course, []))
+            return [enrollment for enrollments in enrolments_by_course.values() for enrollment in enrollments]
+
         query = f"SELECT {', '.join(self.fields)} FROM {self.enrollment_table}"
         if config.debug:
             print(f"Query: {query}")
@@ -111,26 +206,18 @@ class MoodleMSSQLEnrolmentProvider(MoodleEnrolmentProvider):
             columns = [column[0] for column in cursor.description]
             data = cursor.fetchall()
 
-        enrollments = [dict(zip(columns, row)) for row in data]
-
-        # Convert role names to Moodle standard names if necessary
-        role_mapping = {
-            'student': 'student',
-            'instructor': 'editingteacher',
-            # Add more mappings as needed
-        }
-
-        for enrollment in enrollments:
-            if 'role' in enrollment:
-                enrollment['role'] = role_mapping.get(enrollment['role'].lower(), enrollment['role'])
-
+        enrollments = [self._map_role(dict(zip(columns, row))) for row in data]
         return enrollments
 
     def get_course_shortnames_for_sync(self) -> Set:
         """
         Return a set of course shortnames that should be synchronized.
+        In bulk mode this reloads the enrollments, since it is called at the start of each sync.
         :return: Set of course shortnames.
         """
+        if self.bulk:
+            return set(self.load_enrolments(refresh=True))
+
         query = f"SELECT distinct shortname FROM {self.enrollment_table}"
 
         with pyodbc.connect(self.connection_string) as conn:
@@ -141,7 +228,6 @@ class MoodleMSSQLEnrolmentProvider(MoodleEnrolmentProvider):
         return {row[0] for row in data}
 
 
-
 class MoodleMSSQLUserProvider(MoodleUserProvider):
 
     def __init__(self, connection_string: str, user_table: str = None):
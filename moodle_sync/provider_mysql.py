@@ -1,6 +1,7 @@
 # file: moodle_sync/provider_mysql.py
 
 from functools import partial, lru_cache
+import threading
 
 
 import cryptography # this is a non-included dependency package of pymysql
@@ -59,16 +60,32 @@ class Mysql:
 
         return cls._instances[instance_id]
     def __init__(self,  host:str, database:str, user:str, password:str):
-        if hasattr(self, '__initialized'):
+        if hasattr(self, '_Mysql__initialized'):
             # already initialized.
             return
         self.connection_parameters = {'host': host, 'user': user, 'password': password, 'database': database}
-        self.__connection = None
-        self.columns = None
+        # pymysql connections can't be shared between threads, so each thread gets its own connection and columns.
+        self.__local = threading.local()
         self.__initialized = True
         self.last_query = None
         self.last_params = None
 
+    @property
+    def __connection(self):
+        return getattr(self.__local, 'connection', None)
+
+    @__connection.setter
+    def __connection(self, connection):
+        self.__local.connection = connection
+
+    @property
+    def columns(self) -> Union[List[str], None]:
+        return getattr(self.__local, 'columns', None)
+
+    @columns.setter
+    def columns(self, columns: Union[List[str], None]):
+        self.__local.columns = columns
+
     def connect(self, **connection_parameters):
         """
         Optinally updates any of the connectoin parameters on a new connection.
@@ -209,6 +226,8 @@ class MoodleMySQLCourseProvider(MoodleCourseProvider):
     """
     Based on Moodle 4.1 Schema
     """
+    change_column = 'timemodified'  # mdl_course.timemodified is a unix timestamp.  See get_courses_modified_since.
+
     def __init__(self, host, user, password, database):
         super().__init__()
         self.mysql = Mysql(host=host, database=database, user=user, password=password)
@@ -225,7 +244,7 @@ class MoodleMySQLCourseProvider(MoodleCourseProvider):
         SELECT
             c.id, c.shortname, c.fullname, c.idnumber, c.category as categoryid,
                c.summary, c.startdate, c.enddate, c.format, c.showgrades,
-               c.newsitems,  c.visible,
+               c.newsitems,  c.visible, c.timemodified,
                cfo_n.value as numsections,
                cfo_a.value as automaticenddate
         FROM mdl_course c
@@ -234,7 +253,11 @@ class MoodleMySQLCourseProvider(MoodleCourseProvider):
         """
 
         params = []
-        if field and value:
+        if field == 'timemodified':
+            # courses changed since the value.  See get_courses_modified_since
+            query += " WHERE c.timemodified >= %s"
+            params.append(int(value))
+        elif field and value:
             valid_fields = {'id', 'shortname', 'fullname', 'idnumber', 'category', 'format', 'visible'}
             if field not in valid_fields:
                 raise ValueError(f"Invalid field name: {field}")
@@ -257,6 +280,13 @@ class MoodleMySQLCourseProvider(MoodleCourseProvider):
         self.courses = courses
         return self.courses
 
+    def get_courses_modified_since(self, since: int) -> List[Dict]:
+        """
+        Get the courses with a timemodified at or after since.
+        :param since: unix timestamp
+        """
+        return self.get_courses('timemodified', since)
+
     def get_course(self, shortname_or_id: Union[str, int]) -> Union[dict, None]:
         if isinstance(shortname_or_id, int) or shortname_or_id.isdigit():
             field = 'id'
@@ -277,16 +307,22 @@ class MoodleMySQLCourseProvider(MoodleCourseProvider):
 
         return course
 
-    def create_course(self, course: Dict) -> Union[int, None]:
+    def create_course(self, course: Dict, known_absent: bool = False,
+                      category_id: Union[int, None] = None) -> Union[int, None]:
         """
         Note that the mysql provider does not duplicate a course from a template.
         It just creates a blank course.  This may or may not work.
         :param course:
+        :param known_absent: the caller already checked that the course isn't in Moodle.
+        :param category_id: the Moodle category id, if the caller already looked it up.
         :return:
         """
-        existing_course = self.get_course(course['shortname'])
-        if existing_course:
-            raise ValueError(f"Course already exists with shortname: {course['shortname']}")
+        if not known_absent:
+            existing_course = self.get_course(course['shortname'])
+            if existing_course:
+                raise ValueError(f"Course already exists with shortname: {course['shortname']}")
+        if category_id is not None:
+            course['categoryid'] = category_id
 
         query = """
         INSERT INTO mdl_course (
@@ -382,10 +418,39 @@ from moodle_sync.provider_mysql import Mysql
 
 
 class MoodleMySQLEnrolmentProvider(MoodleEnrolmentProvider):
+
+    # Get all the users even if they are "suspended" (have no role)
+    roster_query = """
+        SELECT DISTINCT
+            u.id as user_id,
+            u.username,
+            c.id as course_id,
+            c.shortname as course_shortname,
+            COALESCE(r.id, 0) as role_id,
+            r.shortname,
+            ue.status as enrolment_status,
+            e.enrol as enrolment_method
+        FROM mdl_user u
+        JOIN mdl_user_enrolments ue ON u.id = ue.userid
+        JOIN mdl_enrol e ON ue.enrolid = e.id
+        JOIN mdl_course c ON e.courseid = c.id
+        LEFT JOIN mdl_context ctx ON ctx.instanceid = c.id AND ctx.contextlevel = 50
+        LEFT JOIN mdl_role_assignments ra ON u.id = ra.userid AND ctx.id = ra.contextid
+        LEFT JOIN mdl_role r ON ra.roleid = r.id
+        {join}
+        WHERE {where} AND (r.shortname IN %s or r.shortname is NULL)
+        """
+
+    # get_enroled_users_for_courses puts more course ids than this in a temporary table instead of an IN list.
+    roster_temp_table_threshold = 1000
+
     def __init__(self, host, user, password, database):
         super().__init__()
         self.mysql = Mysql(host=host, database=database, user=user, password=password)
         self.roles_to_sync = ['student', 'editingteacher']
+        self._course_ids = {}  # shortname: course id, from prefetch_rosters
+        self._rosters = {}  # course id: enrolments, from prefetch_rosters.  Each is handed out once.
+        self._roster_lock = threading.Lock()
 
     @lru_cache(maxsize=None)
     def get_user_id(self, username: str) -> Union[None, int]:
@@ -411,6 +476,8 @@ class MoodleMySQLEnrolmentProvider(MoodleEnrolmentProvider):
 
     @lru_cache(maxsize=None)
     def get_course_id(self, shortname: str) -> Union[None, int]:
+        if shortname in self._course_ids:
+            return self._course_ids[shortname]
         query = "SELECT id FROM mdl_course WHERE shortname = %s"
         with self.mysql as conn:
             result = conn.select(query, (shortname,))
@@ -426,31 +493,70 @@ class MoodleMySQLEnrolmentProvider(MoodleEnrolmentProvider):
         if course_id is None:
             raise ValueError(f"Course does not exist: {course}")
 
-        # Get all the users even if they are "suspended" (have no role)
-        query = """
-        SELECT DISTINCT
-            u.id as user_id,
-            u.username,
-            c.id as course_id,
-            c.shortname as course_shortname,
-            COALESCE(r.id, 0) as role_id,
-            r.shortname,
-            ue.status as enrolment_status,
-            e.enrol as enrolment_method
-        FROM mdl_user u
-        JOIN mdl_user_enrolments ue ON u.id = ue.userid
-        JOIN mdl_enrol e ON ue.enrolid = e.id
-        JOIN mdl_course c ON e.courseid = c.id
-        LEFT JOIN mdl_context ctx ON ctx.instanceid = c.id AND ctx.contextlevel = 50
-        LEFT JOIN mdl_role_assignments ra ON u.id = ra.userid AND ctx.id = ra.contextid
-        LEFT JOIN mdl_role r ON ra.roleid = r.id
-        -- WHERE c.id = 5612
-        WHERE c.id = %s AND (r.shortname IN %s or r.shortname is NULL)
-        """
+        with self._roster_lock:
+            roster = self._rosters.pop(course_id, None)
+        if roster is not None:
+            return roster
+
+        query = self.roster_query.format(join='', where='c.id = %s')
         with self.mysql as conn:
             result = conn.select(query, (course_id, self.roles_to_sync))
         return result
 
+    def get_enroled_users_for_courses(self, courses: Iterable[Union[str, int]]) -> Dict[int, List[Dict]]:
+        """
+        Get the enrolments for many courses in one query, grouped by course.
+        Up to roster_temp_table_threshold courses go in an IN list.  More than that are put in a temporary table
+        for the query to join on.
+        :param courses: shortnames or course ids.  Courses that don't exist are left out.
+        :return: dict of course id to the list of enrolments, like get_enroled_users.  Every course is in it,
+            with an empty list if nobody is enrolled.
+        """
+        courses = list(courses)
+        course_ids = [course for course in courses if not isinstance(course, str)]
+        shortnames = [course for course in courses if isinstance(course, str)]
+        for i in range(0, len(shortnames), self.roster_temp_table_threshold):
+            chunk = shortnames[i:i + self.roster_temp_table_threshold]
+            with self.mysql as conn:
+                result = conn.select("SELECT id, shortname FROM mdl_course WHERE shortname IN %s", (chunk,))
+            self._course_ids.update({row['shortname']: row['id'] for row in result})
+            course_ids.extend(row['id'] for row in result)
+        course_ids = sorted(set(course_ids))
+        rosters = {course_id: [] for course_id in course_ids}
+        if not course_ids:
+            return rosters
+
+        # a temporary table is only seen by this connection, so it is safe to make in a dryrun.  query() would skip
+        # creating it, though, so a dryrun always uses an IN list.
+        with self.mysql as conn:
+            if len(course_ids) > self.roster_temp_table_threshold and not config.dryrun:
+                conn.query("CREATE TEMPORARY TABLE IF NOT EXISTS moodle_sync_roster_courses (id BIGINT PRIMARY KEY)")
+                conn.query("DELETE FROM moodle_sync_roster_courses")
+                conn.query("INSERT INTO moodle_sync_roster_courses (id) VALUES (%s)",
+                           [(course_id,) for course_id in course_ids])
+                query = self.roster_query.format(join='JOIN moodle_sync_roster_courses rc ON rc.id = c.id',
+                                                 where='1 = 1')
+                result = conn.select(query, (self.roles_to_sync,))
+                conn.query("DROP TEMPORARY TABLE moodle_sync_roster_courses")
+            else:
+                query = self.roster_query.format(join='', where='c.id IN %s')
+                result = conn.select(query, (course_ids, self.roles_to_sync))
+
+        for enrolment in result:
+            rosters[enrolment['course_id']].append(enrolment)
+        logger.info(f"Loaded {len(result)} enrolments for {len(rosters)} courses.")
+        return rosters
+
+    def prefetch_rosters(self, courses: Iterable[Union[str, int]]) -> None:
+        """
+        Load the rosters for all these courses in one query.  get_enroled_users hands each one out once,
+        then goes back to the database, so a roster read after making changes is current.
+        :param courses: shortnames or course ids
+        """
+        rosters = self.get_enroled_users_for_courses(courses)
+        with self._roster_lock:
+            self._rosters.update(rosters)
+
     def course_enrol_user(self, user: Union[int, str], course: Union[str, int], role: Union[str, int] = 'student') -> \
     Dict[str, int]:
         user_id = self.get_user_id(user) if isinstance(user, str) else user
@@ -0,0 +1,141 @@
+# file: moodle_sync/state.py
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Iterable
+
+from moodle_sync.logger import logger
+
+"""
+Local state kept between sync runs, in a SQLite file.
+
+CourseSync uses it to remember a fingerprint of each course from the last time it was synced,
+so courses that haven't changed in the source can be skipped.  For incremental syncs it also keeps
+a copy of the source and moodle course lists and the watermark (latest change time) for each.
+"""
+
+
+class SyncStateStore:
+    """
+    A small SQLite store for sync state.  Everything is kept by scope - a name for the sync it belongs to,
+    so one file can hold the state for several syncs (different sites, or different course keys).
+
+    Usage:
+        state = SyncStateStore('/var/lib/moodle_sync/state.sqlite3')
+        CourseSync(target, source, state=state).sync_to_moodle()
+    """
+
+    def __init__(self, path: str = 'moodle_sync_state.sqlite3'):
+        """
+        :param path: the SQLite file.  Created if it doesn't exist.  ':memory:' works for testing.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS course_fingerprints (
+                    scope TEXT NOT NULL, course_key TEXT NOT NULL, fingerprint TEXT NOT NULL, synced_at REAL NOT NULL,
+                    PRIMARY KEY (scope, course_key))""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS sync_values (
+                    scope TEXT NOT NULL, name TEXT NOT NULL, value TEXT,
+                    PRIMARY KEY (scope, name))""")
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS cached_courses (
+                    scope TEXT NOT NULL, side TEXT NOT NULL, course_key TEXT NOT NULL, course TEXT NOT NULL,
+                    PRIMARY KEY (scope, side, course_key))""")
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_fingerprints(self, scope: str) -> Dict[str, str]:
+        """
+        :param scope: the name of the sync
+        :return: dict of course key to the fingerprint stored for it.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT course_key, fingerprint FROM course_fingerprints WHERE scope = ?", (scope,)).fetchall()
+        return dict(rows)
+
+    def set_fingerprints(self, scope: str, fingerprints: Dict[str, str]) -> None:
+        """
+        Store the fingerprints of courses that were just synced.  Other courses keep their fingerprints.
+        :param scope: the name of the sync
+        :param fingerprints: dict of course key to fingerprint
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO course_fingerprints (scope, course_key, fingerprint, synced_at) "
+                "VALUES (?, ?, ?, ?)",
+                [(scope, str(key), fingerprint, now) for key, fingerprint in fingerprints.items()])
+        logger.debug(f"Stored {len(fingerprints)} course fingerprints for {scope}")
+
+    def forget_fingerprints(self, scope: str, course_keys: Optional[Iterable[str]] = None) -> None:
+        """
+        Drop stored fingerprints so those courses are checked again next time.
+        :param scope: the name of the sync
+        :param course_keys: the courses to forget.  None forgets all of them.
+        """
+        with self._lock, self._connection:
+            if course_keys is None:
+                self._connection.execute("DELETE FROM course_fingerprints WHERE scope = ?", (scope,))
+            else:
+                self._connection.executemany("DELETE FROM course_fingerprints WHERE scope = ? AND course_key = ?",
+                                             [(scope, str(key)) for key in course_keys])
+
+    def get_value(self, scope: str, name: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        :return: a value stored with set_value, or default.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM sync_values WHERE scope = ? AND name = ?", (scope, name)).fetchone()
+        return row[0] if row else default
+
+    def set_value(self, scope: str, name: str, value: Optional[str]) -> None:
+        """
+        Store a value, like the time of the last full reconcile.
+        """
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO sync_values (scope, name, value) VALUES (?, ?, ?)",
+                                     (scope, name, value))
+
+    def get_cached_courses(self, scope: str, side: str) -> List[Dict]:
+        """
+        :param scope: the name of the sync
+        :param side: which course list - like source or moodle
+        :return: the courses stored with cache_courses.  Values that aren't JSON types come back as strings.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT course FROM cached_courses WHERE scope = ? AND side = ?", (scope, side)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def cache_courses(self, scope: str, side: str, courses: Iterable[Dict], course_key: str,
+                      replace: bool = False) -> None:
+        """
+        Store a copy of the courses.  Courses already stored with the same key are replaced.
+        :param scope: the name of the sync
+        :param side: which course list - like source or moodle
+        :param courses: the courses
+        :param course_key: the course field that identifies a course
+        :param replace: drop all the courses stored for this side first.
+        """
+        rows = [(scope, side, str(course[course_key]), json.dumps(course, default=str))
+                for course in courses if course.get(course_key) is not None]
+        with self._lock, self._connection:
+            if replace:
+                self._connection.execute("DELETE FROM cached_courses WHERE scope = ? AND side = ?", (scope, side))
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO cached_courses (scope, side, course_key, course) VALUES (?, ?, ?, ?)", rows)
@@ -1,5 +1,5 @@
 # file: moodle_sync/enrolment.py
-from typing import List, Dict, Callable, Union, Set
+from typing import List, Dict, Callable, Union, Set, Iterable
 
 from moodle_sync.config import config
 from moodle_sync.logger import logger
@@ -87,6 +87,13 @@ class MoodleUserProvider:
         raise RuntimeError('Not Implemented. Derived Class needs get_username.')
         pass
 
+    def prefetch_users(self, emails_usernames_or_ids: Iterable[Union[str, int]]) -> None:
+        """
+        Optional.  Look up all these users ahead of time so that get_user can answer from a cache.
+        :param emails_usernames_or_ids: usernames, emails, or user ids about to be used.
+        """
+        pass
+
 
 
 class UserSync:
@@ -105,6 +112,7 @@ class UserSync:
         """
 
         source_users = self.source.get_all_users()
+        self.target.prefetch_users([user['username'] for user in source_users])
         cnt_created, cnt_exists = 0, 0
         logger_line = ""
         for user in source_users:
@@ -0,0 +1,529 @@
+# file: tests/test_course.py
+
+"""
+Offline tests for course.py, with small in-memory providers standing in for Moodle and the source.
+python -m pytest tests/test_course.py
+"""
+
+import decimal
+import threading
+import time
+
+import pytest
+
+from moodle_sync.config import config
+from moodle_sync.course import (CategoryIndex, CourseComparator, CourseCreateQueue, CoursePlan, CourseSnapshot,
+                                CourseSync, MoodleCourseProvider)
+from moodle_sync.state import SyncStateStore
+
+
+class FakeMoodle(MoodleCourseProvider):
+    """
+    A Moodle site kept in a dict.  Each call that would go to Moodle is kept in calls.
+    """
+    fields_to_update = ['fullname', 'startdate', 'enddate', 'categoryid']
+
+    def __init__(self, courses=()):
+        super().__init__()
+        self.categories = {'Arts': 1}
+        self.moodle_courses = {course['shortname']: dict(course) for course in courses}
+        self.created, self.updated = [], []
+        self.calls = []
+
+    def get_category(self, name_or_id):
+        return self.categories.get(name_or_id)
+
+    def create_category(self, category_name, category_parent_name=None):
+        self.categories[category_name] = len(self.categories) + 1
+        return self.categories[category_name]
+
+    def iter_courses(self, field=None, value=None):
+        self.calls.append(('iter_courses', field, value))
+        return iter([dict(course) for course in self.moodle_courses.values()
+                     if field is None or course.get('categoryid' if field == 'category' else field) == value])
+
+    def get_course(self, shortname_or_id):
+        self.calls.append(('get_course', shortname_or_id))
+        course = self.moodle_courses.get(shortname_or_id)
+        return None if course is None else dict(course)
+
+    def create_course(self, course, known_absent=False, category_id=None):
+        self.created.append(course['shortname'])
+        new_course = dict(course, id=100 + len(self.moodle_courses), categoryid=category_id)
+        self.moodle_courses[course['shortname']] = new_course
+        return new_course['id']
+
+    def update_course(self, course):
+        self.updated.append(course['shortname'])
+        self.moodle_courses[course['shortname']].update(course)
+
+
+class FakeSource(MoodleCourseProvider):
+    def __init__(self, courses):
+        super().__init__()
+        self.source_courses = courses
+
+    def get_courses(self, field=None, value=None):
+        return [dict(course) for course in self.source_courses]
+
+
+def source_course(shortname, category='Arts', **values):
+    return dict({'shortname': shortname, 'fullname': shortname, 'startdate': 0, 'enddate': 0,
+                 'categoryname': category}, **values)
+
+
+def moodle_course(id, shortname, **values):
+    return dict({'id': id, 'shortname': shortname, 'fullname': shortname, 'startdate': 0, 'enddate': 0,
+                 'categoryid': 1}, **values)
+
+
+def test_course_snapshot_index():
+    snapshot = CourseSnapshot([{'id': 1, 'shortname': 'A', 'idnumber': ''},
+                               {'id': 2, 'shortname': 'B', 'idnumber': '200'},
+                               {'id': 3, 'shortname': 'A', 'idnumber': '300'}])
+    assert len(snapshot) == 3 and 'B' in snapshot and 'C' not in snapshot
+    assert snapshot.get('A')['id'] == 1  # the first one wins.
+    assert snapshot.get('300', 'idnumber')['id'] == 3
+    assert snapshot.get('', 'idnumber') is None  # blanks aren't indexed.
+    assert snapshot.get(2, 'id')['shortname'] == 'B'
+    snapshot.add({'id': 4, 'shortname': 'D'})
+    assert snapshot.get(4, 'id')['shortname'] == 'D'
+    with pytest.raises(KeyError):
+        snapshot.get('x', 'fullname')
+
+
+def many_courses():
+    # a site with 500 courses, and a source with one to update, one up to date, and one to create.
+    target = FakeMoodle([moodle_course(i, f'C{i}') for i in range(500)])
+    source = FakeSource([source_course('C7', fullname='Renamed'), source_course('C8'), source_course('NEW')])
+    return target, source
+
+
+def test_fetch_all_matches_every_course_from_one_walk():
+    target, source = many_courses()
+    sync = CourseSync(target, source)
+    snapshot = sync.get_moodle_snapshot(source.get_courses(), 'all')
+    assert sorted(course['shortname'] for course in snapshot) == ['C7', 'C8']  # only the ones in the source.
+
+    target.calls.clear()
+    sync.sync_to_moodle(fetch='all')
+    # a course not in the snapshot isn't in moodle, so nothing is looked up one at a time.
+    assert target.calls == [('iter_courses', None, None)]
+    assert target.updated == ['C7'] and target.created == ['NEW']
+    assert target.moodle_courses['C7']['fullname'] == 'Renamed'
+
+
+def test_fetch_one_looks_up_each_course():
+    target, source = many_courses()
+    sync = CourseSync(target, source)
+    snapshot = sync.get_moodle_snapshot(source.get_courses(), 'one')
+    assert len(snapshot) == 0 and not snapshot
+
+    sync.sync_to_moodle(fetch='one')
+    assert target.calls == [('get_course', 'C7'), ('get_course', 'C8'), ('get_course', 'NEW')]
+    assert target.updated == ['C7'] and target.created == ['NEW']
+
+
+def test_fetch_must_be_known():
+    target, source = many_courses()
+    with pytest.raises(ValueError):
+        CourseSync(target, source).get_moodle_snapshot(source.get_courses(), 'ALL')
+
+
+def test_category_index():
+    categories = CategoryIndex([
+        {'id': 3, 'name': 'Undergraduate', 'parent': 1},
+        {'id': 1, 'name': '2024 Fall', 'parent': 0},
+        {'id': 2, 'name': '2025 Spring', 'parent': 0},
+        {'id': 4, 'name': 'Undergraduate', 'parent': 2},
+        {'id': 5, 'name': 'Arts &amp; Sciences', 'parent': 4},
+    ])
+    assert len(categories) == 5
+    assert categories.get(2)['name'] == '2025 Spring'
+    assert categories.get('Undergraduate')['id'] == 3
+    assert categories.get('2025 Spring / Undergraduate')['id'] == 4
+    assert categories.get('Arts & Sciences')['id'] == 5
+    assert categories.get('2025 Spring / Undergraduate / Arts & Sciences')['id'] == 5
+    assert categories.get('Graduate') is None
+    assert categories.get(99) is None
+
+    categories.add({'id': 6, 'name': 'Graduate', 'parent': 1})
+    assert categories.get('2024 Fall / Graduate')['id'] == 6
+
+
+def test_fetch_scoped_only_reads_the_source_categories():
+    target = FakeMoodle([moodle_course(i, f'C{i}', categoryid=i % 5 + 1) for i in range(500)])
+    target.categories['Science'] = 2
+    # C5 and C6 are where the source has them.  C7 was moved to another category in moodle.
+    source = FakeSource([source_course('C5', fullname='Renamed'), source_course('C6', category='Science'),
+                         source_course('C7', category='Science'), source_course('NEW', category='Science'),
+                         source_course('NEWCAT', category='Music')])
+    sync = CourseSync(target, source)
+    snapshot = sync.get_moodle_snapshot(source.get_courses(), 'scoped')
+    assert sorted(course['shortname'] for course in snapshot) == ['C5', 'C6']
+    # Music doesn't exist yet, so there is nothing in it to fetch.
+    assert target.calls == [('iter_courses', 'category', 1), ('iter_courses', 'category', 2)]
+
+    target.calls.clear()
+    sync.sync_to_moodle(fetch='scoped')
+    assert target.calls == [('iter_courses', 'category', 1), ('iter_courses', 'category', 2),
+                            ('get_course', 'C7'), ('get_course', 'NEW'), ('get_course', 'NEWCAT')]
+    assert target.updated == ['C5', 'C7'] and target.created == ['NEW', 'NEWCAT']
+    assert target.moodle_courses['C7']['categoryid'] == 2
+
+
+def test_create_queue_results_in_order_and_old_providers():
+    class OldProvider:
+        # written before create_course took known_absent and category_id.
+        def create_course(self, course):
+            if course['shortname'] == 'BAD':
+                raise ValueError("no template")
+            return int(course['shortname'][1:])
+
+    progress = []
+    queue = CourseCreateQueue(OldProvider(), workers=3, on_progress=lambda done, total, result: progress.append(done))
+    for shortname in ['C1', 'BAD', 'C3', 'C4']:
+        queue.add({'shortname': shortname}, known_absent=True, category_id=1)
+    results = queue.run()
+    assert [(result['id'], result['ok']) for result in results] == [(1, True), (None, False), (3, True), (4, True)]
+    assert 'no template' in results[1]['error']
+    assert sorted(progress) == [1, 2, 3, 4]
+    assert len(queue) == 0
+
+
+def test_sync_passes_what_it_knows_to_create_course():
+    target = FakeMoodle()
+    created = []
+    create_course = target.create_course
+
+    def recording_create_course(course, known_absent=False, category_id=None):
+        created.append((course['shortname'], known_absent, category_id))
+        return create_course(course, known_absent, category_id)
+
+    target.create_course = recording_create_course
+    CourseSync(target, FakeSource([source_course('NEW'), source_course('SCI', category='Science')])).sync_to_moodle()
+    assert created == [('NEW', True, 1), ('SCI', True, 2)]
+
+
+class SlowProvider:
+    """
+    create_course takes delay seconds, or waits for release if the shortname starts with STUCK.
+    Keeps the most courses that were being created at once.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.active = self.most_active = 0
+
+    def create_course(self, course, known_absent=False, category_id=None):
+        with self.lock:
+            self.active += 1
+            self.most_active = max(self.most_active, self.active)
+        try:
+            if course['shortname'].startswith('STUCK'):
+                self.release.wait()
+            time.sleep(self.delay)
+            return int(course['shortname'][-1])
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+def run_queue(provider, shortnames, **queue_args):
+    queue = CourseCreateQueue(provider, **queue_args)
+    for shortname in shortnames:
+        queue.add({'shortname': shortname})
+    try:
+        return queue.run()
+    finally:
+        provider.release.set()  # let the stuck threads finish.
+
+
+def test_create_queue_runs_workers_at_once():
+    provider = SlowProvider(delay=0.05)
+    results = run_queue(provider, [f'C{i}' for i in range(9)], workers=3)
+    assert [result['id'] for result in results] == list(range(9))
+    assert provider.most_active == 3
+
+
+def test_create_queue_gives_up_on_slow_courses():
+    results = run_queue(SlowProvider(), ['STUCK1', 'C2', 'C3'], workers=2, timeout=0.2)
+    assert [result['ok'] for result in results] == [False, True, True]
+    assert 'timed out after 0.2 seconds' in results[0]['error']
+    assert results[0]['seconds'] >= 0.2
+
+
+def test_create_queue_stops_when_every_worker_is_stuck():
+    started = time.monotonic()
+    results = run_queue(SlowProvider(), ['STUCK1', 'STUCK2', 'C3', 'C4'], workers=2, timeout=0.2,
+                        batch_timeout=60)
+    assert time.monotonic() - started < 10
+    assert [result['ok'] for result in results] == [False] * 4
+    assert all('timed out' in result['error'] for result in results[:2])
+    assert all(result['error'].startswith('not started: every worker is stuck') for result in results[2:])
+
+
+def test_create_queue_batch_deadline():
+    results = run_queue(SlowProvider(), ['STUCK1', 'C2'], workers=1, batch_timeout=0.3)
+    assert [result['ok'] for result in results] == [False, False]
+    assert 'the batch timed out after 0.3 seconds' in results[0]['error']
+    assert results[1]['error'].startswith('not started: the batch timed out')
+
+
+def test_unchanged_courses_are_skipped_with_a_state_store():
+    state = SyncStateStore(':memory:')
+    target = FakeMoodle([moodle_course(1, 'A'), moodle_course(2, 'B')])
+    courses = [source_course('A'), source_course('B', fullname='Changed'), source_course('C')]
+    sync = CourseSync(target, FakeSource(courses), state=state)
+    sync.sync_to_moodle()
+    assert target.updated == ['B'] and target.created == ['C']
+    assert set(state.get_fingerprints(sync.state_scope)) == {'A', 'B', 'C'}
+
+    # nothing changed, so nothing is even looked up.
+    target.calls.clear()
+    sync.sync_to_moodle()
+    assert target.calls == []
+
+    courses[0]['startdate'] = 1725000000
+    sync.sync_to_moodle()
+    assert target.calls == [('get_course', 'A')] and target.updated == ['B', 'A']
+
+    # a reconcile checks them all, in case something was changed in moodle.
+    target.moodle_courses['C']['fullname'] = 'Changed in moodle'
+    target.calls.clear()
+    sync.sync_to_moodle(reconcile=True)
+    assert [call[1] for call in target.calls] == ['A', 'B', 'C'] and target.updated == ['B', 'A', 'C']
+
+
+def test_failed_courses_are_not_fingerprinted():
+    state = SyncStateStore(':memory:')
+    target = FakeMoodle([moodle_course(1, 'A'), moodle_course(2, 'BAD')])
+    update_course = target.update_course
+
+    def failing_update_course(course):
+        if course['shortname'] == 'BAD':
+            raise ValueError("rejected")
+        update_course(course)
+
+    target.update_course = failing_update_course
+    sync = CourseSync(target, FakeSource([source_course('A', fullname='a'), source_course('BAD', fullname='b')]),
+                      state=state)
+    sync.sync_to_moodle()
+    assert set(state.get_fingerprints(sync.state_scope)) == {'A'}
+    target.calls.clear()
+    sync.sync_to_moodle()
+    assert target.calls == [('get_course', 'BAD')]
+
+
+def test_reconcile_interval():
+    state = SyncStateStore(':memory:')
+    target = FakeMoodle([moodle_course(1, 'A')])
+    sync = CourseSync(target, FakeSource([source_course('A')]), state=state, reconcile_interval=3600)
+    sync.sync_to_moodle()
+    assert state.get_value(sync.state_scope, 'last_reconcile') is not None
+    target.calls.clear()
+    sync.sync_to_moodle()
+    assert target.calls == []
+
+    state.set_value(sync.state_scope, 'last_reconcile', str(time.time() - 7200))
+    sync.sync_to_moodle()
+    assert target.calls == [('get_course', 'A')]
+
+
+class ChangeTrackingSource(FakeSource):
+    """
+    A source whose courses have a timemodified.  Keeps the since of each get_courses_modified_since call.
+    """
+    change_column = 'timemodified'
+
+    def __init__(self, courses):
+        super().__init__(courses)
+        self.full_reads, self.since = 0, []
+
+    def get_courses(self, field=None, value=None):
+        self.full_reads += 1
+        return super().get_courses(field, value)
+
+    def get_courses_modified_since(self, since):
+        self.since.append(since)
+        return [dict(course) for course in self.source_courses if course['timemodified'] >= since]
+
+
+def test_incremental_watermark_and_overlap():
+    state = SyncStateStore(':memory:')
+    source = ChangeTrackingSource([source_course('A', timemodified=1000), source_course('B', timemodified=5000)])
+    sync = CourseSync(FakeMoodle(), source, state=state)
+
+    # the first run reads everything and sets the watermark to the newest change.
+    assert len(sync.get_courses_incrementally(source, 'source')) == 2
+    assert source.full_reads == 1
+    assert state.get_value(sync.state_scope, 'source_watermark') == '5000'
+
+    # a change committed late, with a time just before the watermark, is still picked up by the overlap.
+    source.source_courses.append(source_course('C', timemodified=5000 - sync.incremental_overlap + 1))
+    source.source_courses.append(source_course('D', timemodified=6000))
+    courses = sync.get_courses_incrementally(source, 'source')
+    assert source.since == [5000 - sync.incremental_overlap] and source.full_reads == 1
+    assert sorted(course['shortname'] for course in courses) == ['A', 'B', 'C', 'D']
+    assert state.get_value(sync.state_scope, 'source_watermark') == '6000'
+
+    # full reads everything again, and replaces the cached copy.
+    del source.source_courses[0]
+    assert sorted(course['shortname'] for course in sync.get_courses_incrementally(source, 'source', full=True)) == \
+        ['B', 'C', 'D']
+    assert source.full_reads == 2
+
+
+def test_incremental_merges_changed_courses_into_the_cached_set():
+    state = SyncStateStore(':memory:')
+    source = ChangeTrackingSource([source_course('A', timemodified=1000), source_course('B', timemodified=1000)])
+    sync = CourseSync(FakeMoodle(), source, state=state)
+    sync.get_courses_incrementally(source, 'source')
+
+    source.source_courses[1] = source_course('B', fullname='Changed', timemodified=2000)
+    courses = {course['shortname']: course for course in sync.get_courses_incrementally(source, 'source')}
+    assert courses['B']['fullname'] == 'Changed' and courses['A']['fullname'] == 'A'
+    assert len(courses) == 2
+
+
+def test_incremental_sync():
+    state = SyncStateStore(':memory:')
+    target = FakeMoodle([moodle_course(1, 'A'), moodle_course(2, 'B')])
+    source = ChangeTrackingSource([source_course('A', timemodified=1000), source_course('B', timemodified=1000)])
+    sync = CourseSync(target, source, state=state)
+    with pytest.raises(ValueError):
+        CourseSync(target, source).sync_to_moodle(fetch='incremental')
+
+    sync.sync_to_moodle(fetch='incremental')
+    source.source_courses[1] = source_course('B', fullname='Changed', timemodified=2000)
+    source.source_courses.append(source_course('C', timemodified=2000))
+    target.calls.clear()
+    sync.sync_to_moodle(fetch='incremental')
+    # moodle has no change_column, so just the changed courses' categories are read from it.
+    assert target.calls == [('iter_courses', 'category', 1), ('get_course', 'C')]
+    assert target.updated == ['B'] and target.created == ['C']
+    assert source.full_reads == 1
+
+
+def test_comparator_numeric_fields_compare_by_value():
+    comparator = CourseComparator(['startdate', 'category', 'visible'])
+    moodle = {'startdate': 1730338814, 'category': 5, 'visible': 1}
+    assert not comparator.compare(moodle, {'startdate': '1730338814', 'category': decimal.Decimal(5),
+                                           'visible': True})
+    assert not comparator.compare(moodle, {'startdate': ' 1730338814 ', 'category': 5.0, 'visible': '1'})
+    assert not comparator.compare(moodle, {'startdate': '1730338814.0', 'category': '5e0', 'visible': '1.00'})
+    diff = comparator.compare(moodle, {'startdate': '1730338815', 'category': 5, 'visible': 1})
+    assert diff.changes == [('startdate', 1730338814, '1730338815')]
+
+
+def test_comparator_text_fields_compare_as_text():
+    comparator = CourseComparator(['idnumber', 'fullname', 'summary'])
+    assert not comparator.compare({'idnumber': '0123', 'fullname': 'Arts &amp; Crafts', 'summary': '²'},
+                                  {'idnumber': '0123', 'fullname': 'Arts & Crafts', 'summary': '²'})
+    diff = comparator.compare({'idnumber': '0123', 'fullname': 'A', 'summary': '²'},
+                              {'idnumber': '123', 'fullname': 'A', 'summary': '³'})
+    assert [field for field, _, _ in diff.changes] == ['idnumber', 'summary']
+    # a number on either side still compares by value.
+    assert not comparator.compare({'idnumber': '42'}, {'idnumber': 42})
+    assert comparator.compare({'fullname': 'nan'}, {'fullname': 'NaN'})  # text is text.
+
+
+def test_comparator_handles_nan_and_infinity():
+    comparator = CourseComparator(['startdate', 'enddate', 'idnumber'])
+    nan, inf = float('nan'), float('inf')
+    # NaN never equals itself, so without normalising it would always look changed.
+    assert not comparator.compare({'startdate': nan, 'enddate': inf, 'idnumber': -inf},
+                                  {'startdate': decimal.Decimal('NaN'), 'enddate': 'Infinity', 'idnumber': '-inf'})
+    diff = comparator.compare({'startdate': nan, 'enddate': inf, 'idnumber': 7},
+                              {'startdate': 5, 'enddate': -inf, 'idnumber': nan})
+    assert [field for field, _, _ in diff.changes] == ['startdate', 'enddate', 'idnumber']
+    assert CourseComparator.normalise(decimal.Decimal('-Infinity')) == '-inf'
+    assert CourseComparator.normalise(' nan ', numeric=True) == 'nan'
+
+
+def test_comparator_skips_missing_fields_and_automatic_enddate():
+    comparator = CourseComparator(['fullname', 'enddate'])
+    assert not comparator.compare({'fullname': 'A'}, {'enddate': 5})
+    assert not comparator.compare({'fullname': 'A', 'enddate': 100, 'automaticenddate': 1},
+                                  {'fullname': 'A', 'enddate': 200})
+    assert comparator.compare({'fullname': 'A', 'enddate': 100, 'automaticenddate': 0},
+                              {'fullname': 'A', 'enddate': 200})
+    assert CourseComparator(['enddate', 'automaticenddate']).compare(
+        {'enddate': 100, 'automaticenddate': 1}, {'enddate': 200, 'automaticenddate': 1})
+
+
+def test_plan_round_trip_and_apply():
+    target = FakeMoodle([moodle_course(1, 'OLD'), moodle_course(2, 'SAME')])
+    source = FakeSource([source_course('OLD', fullname='Renamed'), source_course('SAME'),
+                         source_course('NEW'), source_course('SCI', category='Science')])
+    sync = CourseSync(target, source)
+
+    plan = sync.plan()
+    assert len(plan) == 4
+    assert plan.categories == [{'name': 'Science', 'parent': None}]
+    assert [create['key'] for create in plan.creates] == ['NEW', 'SCI']
+    assert [(update['key'], update['id'], update['changes']) for update in plan.updates] == \
+        [('OLD', 1, [['fullname', 'OLD', 'Renamed']])]
+    assert plan.skips == [{'key': 'SAME', 'reason': 'up to date'}]
+    assert target.created == target.updated == []
+
+    saved = CoursePlan.from_json(plan.to_json(indent=2))
+    assert saved.to_dict() == plan.to_dict()
+
+    counts = sync.apply_plan(saved)
+    assert counts == {'created': 2, 'updated': 1, 'skipped': 1, 'errors': 0}
+    assert target.updated == ['OLD']
+    assert target.moodle_courses['OLD']['fullname'] == 'Renamed'
+    assert target.created == ['NEW', 'SCI']
+    assert target.moodle_courses['SCI']['categoryid'] == target.categories['Science']
+
+    # now moodle matches the source, so there is nothing left to do.
+    assert len(sync.plan()) == 0
+
+
+def test_apply_plan_stores_fingerprints():
+    state = SyncStateStore(':memory:')
+    target = FakeMoodle([moodle_course(1, 'A'), moodle_course(2, 'B')])
+    source = FakeSource([source_course('A'), source_course('B', fullname='Changed'), source_course('C')])
+    sync = CourseSync(target, source, state=state)
+
+    counts = sync.apply_plan(CoursePlan.from_json(sync.plan().to_json()))
+    assert counts == {'created': 1, 'updated': 1, 'skipped': 1, 'errors': 0}
+    assert set(state.get_fingerprints(sync.state_scope)) == {'A', 'B', 'C'}
+
+    plan = sync.plan()
+    assert len(plan) == 0
+    assert [skip['reason'] for skip in plan.skips] == ['unchanged since the last sync'] * 3
+
+
+@pytest.mark.parametrize('fetch, calls', [
+    ('all', [('iter_courses', None, None)]),
+    ('scoped', [('iter_courses', 'category', 1), ('get_course', 'C7'), ('get_course', 'NEW')]),
+    ('one', [('get_course', 'C5'), ('get_course', 'C7'), ('get_course', 'NEW')]),
+])
+def test_dryrun_plans_with_the_same_fetch(monkeypatch, fetch, calls):
+    monkeypatch.setattr(config, 'dryrun', True)
+    target = FakeMoodle([moodle_course(5, 'C5'), moodle_course(7, 'C7', categoryid=2)])
+    source = FakeSource([source_course('C5', fullname='Renamed'), source_course('C7'), source_course('NEW')])
+    sync = CourseSync(target, source)
+    # the same as the normal path:  nothing is returned.
+    assert sync.sync_to_moodle(fetch=fetch) is None
+    assert target.calls == calls
+    assert target.created == target.updated == []
+
+    plan = sync.plan(fetch=fetch)
+    assert [update['key'] for update in plan.updates] == ['C5', 'C7'] and len(plan.creates) == 1
+
+
+def test_incremental_cant_be_planned(monkeypatch):
+    state = SyncStateStore(':memory:')
+    sync = CourseSync(FakeMoodle(), ChangeTrackingSource([source_course('A', timemodified=1000)]), state=state)
+    with pytest.raises(ValueError):
+        sync.plan(fetch='incremental')
+    monkeypatch.setattr(config, 'dryrun', True)
+    with pytest.raises(ValueError):
+        sync.sync_to_moodle(fetch='incremental')
+    # and nothing was read, so the watermark didn't move.
+    assert state.get_value(sync.state_scope, 'source_watermark') is None
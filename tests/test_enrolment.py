@@ -0,0 +1,137 @@
+# file: tests/test_enrolment.py
+
+"""
+Offline tests for EnrolmentSync, with an in-memory Moodle and source.   python -m pytest tests/test_enrolment.py
+"""
+
+import threading
+
+import pytest
+
+from moodle_sync.enrolment import MoodleEnrolmentProvider, EnrolmentSync
+
+
+class FakeMoodle(MoodleEnrolmentProvider):
+    """
+    Moodle rosters kept in memory.  Users are u1, u2, ... with ids 1, 2, ...
+    Unenrolling a user in fail_unenrol, or deleting a user in fail_delete, is rejected like Moodle would.
+    """
+
+    def __init__(self, rosters, fail_unenrol=(), fail_delete=()):
+        """
+        :param rosters: dict of course shortname to a dict of user id to role shortname
+        """
+        super().__init__()
+        self.course_ids = {shortname: course_id for course_id, shortname in enumerate(rosters, start=1)}
+        self.rosters = {self.course_ids[shortname]: {user_id: self.get_role_id(role) for user_id, role in users.items()}
+                        for shortname, users in rosters.items()}
+        self.fail_unenrol, self.fail_delete = set(fail_unenrol), set(fail_delete)
+        self.lock = threading.Lock()
+
+    def get_user_id(self, username):
+        return int(username[1:])
+
+    def get_username(self, user_id):
+        return f'u{user_id}'
+
+    def get_role_id(self, role):
+        return next((r['id'] for r in self.roles if r['shortname'] == role), None)
+
+    def get_course_id(self, shortname):
+        return self.course_ids.get(shortname)
+
+    def get_enroled_users(self, course_id):
+        with self.lock:
+            return [{'user_id': user_id, 'course_id': course_id, 'role_id': role_id, 'username': f'u{user_id}'}
+                    for user_id, role_id in self.rosters[course_id].items()]
+
+    def course_enrol_user(self, user_id, course_id, role_id):
+        with self.lock:
+            self.rosters[course_id][user_id] = role_id
+        return {'user_id': user_id, 'course_id': course_id, 'role_id': role_id,
+                'num_new_enrols': 1, 'num_roles_added': 1}
+
+    def course_unenrol_user(self, user_id, course_id, role_id):
+        if user_id in self.fail_unenrol:
+            return {'user_id': user_id, 'course_id': course_id, 'role_id': role_id, 'num_roles_deleted': 0,
+                    'error': 'Error occurred: invalid_parameter_exception'}
+        with self.lock:
+            self.rosters[course_id].pop(user_id, None)
+        return {'user_id': user_id, 'course_id': course_id, 'role_id': role_id, 'num_roles_deleted': 1}
+
+    def course_delete_user(self, user_id, course_id):
+        if user_id in self.fail_delete:
+            return {'user_id': user_id, 'course_id': course_id, 'num_roles_deleted': 0,
+                    'num_participations_deleted': 0, 'error': 'Error occurred: invalid_parameter_exception'}
+        with self.lock:
+            deleted = 1 if self.rosters[course_id].pop(user_id, None) is not None else 0
+        return {'user_id': user_id, 'course_id': course_id, 'num_roles_deleted': deleted,
+                'num_participations_deleted': 1}
+
+
+class FakeSource(MoodleEnrolmentProvider):
+    def __init__(self, enrolments, cancelled=()):
+        """
+        :param enrolments: dict of course shortname to a dict of username to role shortname
+        """
+        super().__init__()
+        self.enrolments = enrolments
+        self.cancelled_courses = set(cancelled)
+
+    def get_course_shortnames_for_sync(self, course=None):
+        return list(self.enrolments)
+
+    def get_enroled_users(self, course):
+        return [{'username': username, 'role': role, 'started': 1}
+                for username, role in self.enrolments[course].items()]
+
+    def cancelled(self, course):
+        return course in self.cancelled_courses
+
+
+def test_failed_unenrolment_is_an_error_not_a_removal():
+    target = FakeMoodle({'ENG101': {1: 'student', 2: 'student', 3: 'student', 4: 'student'}}, fail_unenrol={3})
+    source = FakeSource({'ENG101': {'u1': 'student', 'u2': 'student', 'u5': 'student'}})
+    counts = EnrolmentSync(target, source).sync_to_moodle()
+    assert counts == {'added': 1, 'deleted': 0, 'updated': 0, 'error': 1, 'unenrolled': 1}
+    assert set(target.rosters[1]) == {1, 2, 3, 5}
+
+
+def test_failed_deletion_is_an_error_not_a_removal():
+    target = FakeMoodle({'ENG101': {1: 'student', 2: 'student', 3: 'student'}}, fail_delete={2})
+    target.delete_unenroled_users = True
+    source = FakeSource({'ENG101': {'u1': 'student'}})
+    counts = EnrolmentSync(target, source).sync_to_moodle()
+    assert counts == {'added': 0, 'deleted': 1, 'updated': 0, 'error': 1, 'unenrolled': 0}
+
+
+def test_failed_deletion_from_cancelled_course_is_an_error():
+    target = FakeMoodle({'ENG101': {1: 'student', 2: 'editingteacher', 3: 'student'}}, fail_delete={2})
+    source = FakeSource({'ENG101': {'u1': 'student'}}, cancelled={'ENG101'})
+    counts = EnrolmentSync(target, source).sync_to_moodle()
+    assert counts['error'] == 1
+    assert target.rosters[1] == {2: target.get_role_id('editingteacher')}
+
+
+def many_courses():
+    # 30 courses with some of everything:  adds, removals, role changes, rejected writes, and cancelled courses.
+    moodle = {f'C{c}': {u: 'editingteacher' if u % 7 == 0 else 'student' for u in range(c % 5, c % 5 + 12)}
+              for c in range(30)}
+    source = {f'C{c}': {f'u{u}': 'editingteacher' if u % 5 == 0 else 'student' for u in range(c % 3, c % 3 + 10)}
+              for c in range(30)}
+    return moodle, source, {f'C{c}' for c in range(0, 30, 9)}
+
+
+@pytest.mark.parametrize('delete_unenroled_users', [False, True])
+def test_parallel_sync_counts_match_serial(delete_unenroled_users):
+    results = []
+    for workers in (1, 8):
+        moodle, source, cancelled = many_courses()
+        target = FakeMoodle(moodle, fail_unenrol={3, 11}, fail_delete={4})
+        target.delete_unenroled_users = delete_unenroled_users
+        counts = EnrolmentSync(target, FakeSource(source, cancelled)).sync_to_moodle(workers=workers)
+        results.append((counts, target.rosters))
+    assert results[0] == results[1]
+    counts = results[0][0]
+    assert counts['added'] and counts['updated'] and counts['error']
+    assert counts['deleted' if delete_unenroled_users else 'unenrolled']
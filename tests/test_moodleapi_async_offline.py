@@ -0,0 +1,206 @@
+# file: tests/test_moodleapi_async_offline.py
+
+"""
+Offline tests for provider_moodleapi_async.  The AsyncMoodleAPI talks to a small aiohttp server on localhost
+instead of a Moodle site, so these run anywhere:   python -m pytest tests/test_moodleapi_async_offline.py
+"""
+
+import asyncio
+import contextlib
+import itertools
+
+import requests
+from aiohttp import web
+
+from moodle_sync.provider_moodleapi import MoodleAPIError, MoodleAPIRateLimiter
+from moodle_sync.provider_moodleapi_async import AsyncMoodleAPI, AsyncMoodleAPIWriteQueue, \
+    AsyncMoodleAPIEnrolmentProvider
+
+_sites = itertools.count()
+
+
+class StubSite:
+    """
+    Answers web service calls with handler(params), where params has the query and form values as strings.
+    Keeps every call's params, and the most calls that were being answered at once.
+    """
+
+    def __init__(self, handler, delay: float = 0):
+        self.handler = handler
+        self.delay = delay
+        self.calls = []
+        self.active = 0
+        self.most_active = 0
+
+    async def answer(self, request: web.Request) -> web.Response:
+        params = dict(request.query)
+        params.update(await request.post())
+        self.calls.append(params)
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            return web.json_response(self.handler(params))
+        finally:
+            self.active -= 1
+
+
+@contextlib.asynccontextmanager
+async def stub_site(handler, delay: float = 0, max_concurrency: int = 8):
+    # an AsyncMoodleAPI of its own (they are one per site) pointed at a StubSite, without pacing or backoff.
+    site = StubSite(handler, delay)
+    app = web.Application()
+    app.router.add_route('*', '/webservice/rest/server.php', site.answer)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    server = web.TCPSite(runner, '127.0.0.1', 0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+
+    name = f'asyncstub{next(_sites)}.example.com'
+    api = AsyncMoodleAPI(name, 'token', max_concurrency=max_concurrency)
+    api.sync_api.endpoint = f'http://127.0.0.1:{port}/webservice/rest/server.php'
+    api.sync_api.limiter = MoodleAPIRateLimiter(rate=10000, burst=10000)
+    api.sync_api.retry_backoff = 0
+    try:
+        yield api, site
+    finally:
+        await api.close()
+        await runner.cleanup()
+
+
+def course_directory(params):
+    # core_course_get_courses_by_field for any course id.
+    assert params['wsfunction'] == 'core_course_get_courses_by_field'
+    return {'courses': [{'id': int(params['value']), 'shortname': f"C{params['value']}"}], 'warnings': []}
+
+
+def test_identical_reads_share_a_call_and_the_rest_are_limited():
+    async def run():
+        async with stub_site(course_directory, delay=0.05, max_concurrency=3) as (api, site):
+            params = {'wsfunction': 'core_course_get_courses_by_field', 'field': 'id', 'value': '7'}
+            shared = await asyncio.gather(*(api.execute(requests.get, dict(params)) for _ in range(5)))
+            assert len(site.calls) == 1
+            assert all(data == shared[0] for data in shared)
+            shared[0]['courses'].clear()  # each caller has a copy of its own.
+            assert shared[1]['courses'][0]['id'] == 7
+
+            course_ids = await asyncio.gather(*(api.get_course_id(i) for i in range(1, 13)))
+            assert course_ids == list(range(1, 13))
+            assert len(site.calls) == 13
+            assert site.most_active == 3
+    asyncio.run(run())
+
+
+def test_waiters_get_the_same_error():
+    def refuse(params):
+        return {'exception': 'required_capability_exception', 'errorcode': 'nopermissions', 'message': 'No'}
+
+    async def run():
+        async with stub_site(refuse, delay=0.05) as (api, site):
+            params = {'wsfunction': 'core_course_get_courses'}
+            results = await asyncio.gather(*(api.execute(requests.get, dict(params)) for _ in range(3)),
+                                           return_exceptions=True)
+            assert len(site.calls) == 1
+            assert all(isinstance(result, MoodleAPIError) for result in results)
+            assert results[1] is results[0] and results[2] is results[0]
+    asyncio.run(run())
+
+
+class FakeAPI:
+    """
+    Stands in for AsyncMoodleAPI.execute.  Rejects any call with a bad item in it, like Moodle does.
+    """
+
+    def __init__(self):
+        self.calls = []
+
+    async def execute(self, requests_func, params, dryrun_result=None):
+        self.calls.append(params)
+        await asyncio.sleep(0)
+        if any(value == 'bad' for value in params.values()):
+            raise MoodleAPIError("Error occurred: invalid_parameter_exception")
+        return None
+
+
+def test_async_write_queue_isolates_bad_items():
+    api = FakeAPI()
+    accepted = []
+    queue = AsyncMoodleAPIWriteQueue(api, 'enrol_manual_enrol_users', 'enrolments', chunk_size=8,
+                                     on_success=accepted.append)
+    items = [{'userid': 'bad' if i in (2, 13) else i, 'courseid': 1, 'roleid': 5} for i in range(20)]
+
+    async def run():
+        for item in items[:16]:
+            await queue.add(item)  # two full chunks are sent as they fill up.
+        assert len(api.calls) > 0
+        for item in items[16:]:
+            await queue.add(item)
+        return await queue.flush()
+
+    results = asyncio.run(run())
+    assert [result['item'] for result in results] == items
+    assert [result['ok'] for result in results] == [i not in (2, 13) for i in range(20)]
+    assert 'invalid_parameter_exception' in results[13]['error']
+    assert len(accepted) == 18
+    # each chunk of 8 with a bad item is split down to it:  1 + 2 + 2 + 2 calls, twice, and 1 for the last 4.
+    assert len(api.calls) == 15
+
+
+def enrolment_site(rosters):
+    """
+    A handler for the enrolment calls, over rosters: course id -> {user id: set of role ids}.  Writes change rosters.
+    """
+    role_names = {3: 'editingteacher', 5: 'student'}
+
+    def item(params, array_name):
+        return {key[len(array_name) + 4:-1]: int(value) for key, value in params.items()
+                if key.startswith(array_name + '[0][') and value.isdigit()}
+
+    def handler(params):
+        wsfunction = params['wsfunction']
+        if wsfunction == 'core_course_get_courses_by_field':
+            return course_directory(params)
+        if wsfunction == 'core_user_get_users_by_field':
+            user_id = int(params['values[0]'])
+            return [{'id': user_id, 'username': f'user{user_id}', 'email': f'user{user_id}@example.edu'}]
+        if wsfunction == 'core_enrol_get_enrolled_users':
+            return [{'id': user_id, 'roles': [{'roleid': role_id, 'shortname': role_names[role_id]}
+                                              for role_id in role_ids]}
+                    for user_id, role_ids in rosters[int(params['courseid'])].items()]
+        if wsfunction == 'enrol_manual_enrol_users':
+            enrolment = item(params, 'enrolments')
+            rosters[enrolment['courseid']].setdefault(enrolment['userid'], set()).add(enrolment['roleid'])
+        elif wsfunction == 'core_role_unassign_roles':
+            unassignment = item(params, 'unassignments')
+            rosters[unassignment['instanceid']][unassignment['userid']].discard(unassignment['roleid'])
+        elif wsfunction == 'enrol_manual_unenrol_users':
+            enrolment = item(params, 'enrolments')
+            rosters[enrolment['courseid']].pop(enrolment['userid'], None)
+        return None
+    return handler
+
+
+def test_async_enrolment_provider_writes_and_roster_cache():
+    rosters = {10: {1: {5}, 2: {5}, 3: {3}}}
+
+    async def run():
+        async with stub_site(enrolment_site(rosters)) as (api, site):
+            provider = AsyncMoodleAPIEnrolmentProvider(api.site, 'token')
+            assert provider.api is api
+            enrolled, again = await asyncio.gather(provider.course_enrol_user(4, 10, 'student'),
+                                                   provider.course_enrol_user(1, 10, 'student'))
+            assert enrolled['num_roles_added'] == 1 and again is None
+            unenrolled = await provider.course_unenrol_users([{'user': 2, 'course': 10, 'role': 'student'},
+                                                              {'user': 4, 'course': 10, 'role': 'editingteacher'}])
+            assert unenrolled[0]['num_roles_deleted'] == 1 and unenrolled[1] is None
+            deleted = await provider.course_delete_users([3], 10)
+            assert deleted[0]['num_participations_deleted'] == 1
+
+            assert set(provider.roster_cache[10]) == {(1, 5), (4, 5)}
+            roster_calls = [call for call in site.calls if call['wsfunction'] == 'core_enrol_get_enrolled_users']
+            assert len(roster_calls) == 1  # the concurrent lookups shared it, and the cache was kept current.
+            fetched = await provider.get_enroled_users(10, refresh=True)
+            assert fetched == list(provider.roster_cache[10].values())
+    asyncio.run(run())
+    assert rosters == {10: {1: {5}, 2: set(), 4: {5}}}
@@ -0,0 +1,715 @@
+# file: tests/test_moodleapi_offline.py
+
+"""
+Offline tests for provider_moodleapi.  The MoodleAPI sends its calls through a StubSession instead of a
+Moodle site, so these run anywhere:   python -m pytest tests/test_moodleapi_offline.py
+"""
+
+import gzip
+import io
+import itertools
+import json
+import threading
+from urllib.parse import urlencode
+
+import pytest
+import requests
+import urllib3
+import urllib3.connection
+import urllib3.util.connection
+
+from moodle_sync.config import config
+from moodle_sync.provider_moodleapi import (MoodleAPI, MoodleAPIError, MoodleAPIRateLimiter, MoodleAPIWriteQueue,
+                                            MoodleAPICourseProvider, MoodleAPIEnrolmentProvider, CustomDNSSession,
+                                            TemplateMatcher, iter_json_array, _pinned_pool_classes)
+
+
+def make_response(status: int, data, compress: bool = False) -> requests.Response:
+    # a requests.Response with data as its JSON body, read through urllib3 like a real one.
+    body = json.dumps(data).encode('utf-8')
+    headers = {'Content-Type': 'application/json; charset=utf-8'}
+    if compress:
+        body = gzip.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+    response = requests.Response()
+    response.status_code = status
+    response.reason = 'OK' if status == 200 else 'Error'
+    response.headers = requests.structures.CaseInsensitiveDict(headers)
+    response.encoding = 'utf-8'
+    response.raw = urllib3.HTTPResponse(body=io.BytesIO(body), headers=headers, status=status,
+                                        preload_content=False, decode_content=True)
+    return response
+
+
+class StubSession:
+    """
+    Stands in for the site's pooled session.  handler(method, params) returns the data to answer with,
+    or (status, data), or raises - like requests.exceptions.Timeout.  Every call is kept in calls.
+    """
+
+    def __init__(self, handler, compress: bool = False):
+        self.handler = handler
+        self.compress = compress
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, timeout=None, stream=False):
+        sent = dict(params if params is not None else data)
+        with self._lock:
+            self.calls.append({'method': method, 'params': sent, 'in_body': data is not None, 'timeout': timeout})
+        result = self.handler(method, sent)
+        status, result = result if isinstance(result, tuple) else (200, result)
+        response = make_response(status, result, self.compress)
+        if not stream:
+            response.content  # requests reads the body before it returns, unless the response is streamed.
+        return response
+
+    def close(self):
+        pass
+
+
+_sites = itertools.count()
+
+
+def make_api(handler, compress: bool = False) -> MoodleAPI:
+    # a MoodleAPI of its own (they are one per site) that answers from handler, without pacing or backoff.
+    api = MoodleAPI(f'stub{next(_sites)}.example.com', 'token')
+    api.session = StubSession(handler, compress)
+    api.limiter = MoodleAPIRateLimiter(rate=10000, burst=10000)
+    api.retry_backoff = 0
+    return api
+
+
+def chunked(document: str, size: int):
+    data = document.encode('utf-8')
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+def decode(chunks, key=None):
+    # all the items, and the generator's return value.
+    items = []
+    generator = iter_json_array(chunks, key)
+    while True:
+        try:
+            items.append(next(generator))
+        except StopIteration as stop:
+            return items, stop.value
+
+
+COURSES = [{'id': i, 'shortname': f'C{i}', 'fullname': f'Café – "{i}" {{[,]}}', 'summary': '\\n' * i}
+           for i in range(25)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 100000])
+def test_iter_json_array_any_chunk_size(size):
+    document = json.dumps(COURSES, ensure_ascii=False, indent=1)
+    assert decode(chunked(document, size)) == (COURSES, None)
+
+
+@pytest.mark.parametrize('size', [1, 5, 100000])
+def test_iter_json_array_key(size):
+    document = json.dumps({'warnings': [{'message': 'skip me'}], 'courses': COURSES, 'total': 25},
+                          ensure_ascii=False)
+    assert decode(chunked(document, size), 'courses') == (COURSES, None)
+
+
+def test_iter_json_array_empty():
+    assert decode(chunked('[]', 1)) == ([], None)
+    assert decode(chunked('{"courses": []}', 1), 'courses') == ([], None)
+
+
+@pytest.mark.parametrize('size', [1, 4, 100000])
+def test_iter_json_array_returns_other_documents(size):
+    exception = {'exception': 'moodle_exception', 'errorcode': 'invalidtoken', 'message': 'Invalid token'}
+    assert decode(chunked(json.dumps(exception), size), 'courses') == ([], exception)
+    assert decode(chunked(json.dumps(exception), size)) == ([], exception)
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_execute_stream(compress):
+    # big enough to arrive in several 64k chunks.
+    courses = [{'id': i, 'shortname': f'C{i}', 'fullname': f'Course {i}'} for i in range(5000)]
+    api = make_api(lambda method, params: {'courses': courses, 'warnings': []}, compress)
+    stream = api.execute_stream(requests.get, {'wsfunction': 'core_course_get_courses_by_field'}, key='courses')
+    assert api.session.calls == []  # nothing is sent until the records are wanted.
+    assert next(stream) == courses[0]
+    assert list(stream) == courses[1:]
+    assert len(api.session.calls) == 1
+
+
+def test_execute_stream_list():
+    api = make_api(lambda method, params: COURSES)
+    assert list(api.execute_stream(requests.get, {'wsfunction': 'core_course_get_categories'})) == COURSES
+
+
+def test_execute_stream_errors():
+    api = make_api(lambda method, params: {'exception': 'required_capability_exception',
+                                           'errorcode': 'nopermissions', 'message': 'No permission'})
+    with pytest.raises(MoodleAPIError):
+        list(api.execute_stream(requests.get, {'wsfunction': 'core_course_get_courses'}, key='courses'))
+
+    api = make_api(lambda method, params: (404, None))
+    with pytest.raises(Exception, match='404'):
+        list(api.execute_stream(requests.get, {'wsfunction': 'core_course_get_courses'}, key='courses'))
+
+
+@pytest.fixture
+def local_server():
+    # a keep-alive HTTP server on localhost that answers with the Host header it was sent.
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body = self.headers['Host'].encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server.server_port
+    server.shutdown()
+    server.server_close()
+
+
+def test_custom_dns_session_pins_address_and_reuses_connections(local_server):
+    create_connection = urllib3.util.connection.create_connection
+    with CustomDNSSession('127.0.0.1') as session:
+        for _ in range(3):
+            response = session.get(f'http://moodle.invalid:{local_server}/')
+            assert response.text == f'moodle.invalid:{local_server}'  # the name is still sent as the Host.
+    pinned = CustomDNSSession('127.0.0.1')
+    for _ in range(3):
+        pinned.get(f'http://moodle.invalid:{local_server}/')
+    assert pinned.connection_stats() == {'requests': 3, 'connections': 1, 'reused': 2}
+    pinned.close()
+    # nothing outside the adapter was changed.
+    assert urllib3.util.connection.create_connection is create_connection
+
+
+def test_pinned_pool_classes_keep_the_hostname(monkeypatch):
+    connected = {}
+
+    def new_conn(connection):
+        connected['address'] = connection._dns_host
+        raise OSError('not really connecting')
+
+    monkeypatch.setattr(urllib3.connection.HTTPSConnection, '_new_conn', new_conn)
+    pool_classes = _pinned_pool_classes('192.0.2.10')
+    connection = pool_classes['https'].ConnectionCls('moodle.example.com', 443)
+    with pytest.raises(OSError):
+        connection.connect()
+    assert connected['address'] == '192.0.2.10'
+    # SNI and the certificate check use the host, which is still the name.
+    assert connection.host == 'moodle.example.com'
+    # each address gets its own classes, so two adapters never share an override.
+    assert _pinned_pool_classes('192.0.2.11')['https'] is not pool_classes['https']
+
+
+def user_directory(count: int):
+    # a handler for core_user_get_users_by_field over users 1 to count.
+    users = [{'id': i, 'username': f'user{i}', 'email': f'user{i}@example.edu'} for i in range(1, count + 1)]
+
+    def handler(method, params):
+        assert params['wsfunction'] == 'core_user_get_users_by_field'
+        values = {value.lower() for key, value in params.items() if key.startswith('values[')}
+        return [user for user in users if str(user[params['field']]).lower() in values]
+    return handler
+
+
+def test_get_users_batches_by_field_and_caches_misses():
+    api = make_api(user_directory(300))
+    api.user_batch_size = 100
+    emails = [f'User{i}@Example.edu' for i in range(1, 251)]
+    keys = emails + ['user7', 'nobody', 12, '13', 'nobody@example.edu', 'user7']
+    users = api.get_users(keys)
+
+    calls = [call['params'] for call in api.session.calls]
+    assert [(params['field'], sum(key.startswith('values[') for key in params)) for params in calls] == \
+        [('email', 100), ('email', 100), ('email', 51), ('username', 2), ('id', 2)]
+    assert list(users) == list(dict.fromkeys(keys))
+    assert users['User250@Example.edu']['id'] == 250
+    assert users['user7']['id'] == 7 and users[12]['id'] == 12 and users['13']['id'] == 13
+    assert users['nobody'] is None and users['nobody@example.edu'] is None
+
+    # the hits and the misses are all cached.
+    assert api.get_users(keys) == users
+    assert api.get_user('nobody') is None
+    assert api.get_user_id('user250') == 250
+    assert len(api.session.calls) == 5
+
+
+class FakeAPI:
+    """
+    Stands in for MoodleAPI.execute.  Rejects any call with a bad item in it, the way Moodle fails the whole call.
+    """
+
+    def __init__(self, error=MoodleAPIError):
+        self.error = error
+        self.calls = []
+
+    def execute(self, requests_func, params, dryrun_result=None):
+        self.calls.append(params)
+        if self.error is not MoodleAPIError:
+            raise self.error("connection dropped")
+        if any(value == 'bad' for value in params.values()):
+            raise MoodleAPIError("Error occurred: invalid_parameter_exception")
+        return {'warnings': [{'itemid': value, 'message': 'warned'}
+                             for value in params.values() if value == 'warn']}
+
+
+def test_write_queue_isolates_bad_items():
+    api = FakeAPI()
+    accepted = []
+    queue = MoodleAPIWriteQueue(api, 'enrol_manual_enrol_users', 'enrolments', chunk_size=16,
+                                on_success=accepted.append)
+    items = [{'userid': 'bad' if i in (3, 20) else i, 'courseid': 1, 'roleid': 5} for i in range(32)]
+    for item in items:
+        queue.add(item)
+    results = queue.flush()
+
+    assert [result['item'] for result in results] == items
+    assert [result['ok'] for result in results] == [i not in (3, 20) for i in range(32)]
+    assert 'invalid_parameter_exception' in results[3]['error']
+    assert len(accepted) == 30
+    # each chunk of 16 with one bad item is split down to that item:  1 + 2 + 2 + 2 + 2 calls.
+    assert len(api.calls) == 18
+
+
+def test_write_queue_fails_chunk_when_call_does_not_get_through():
+    api = FakeAPI(error=requests.exceptions.ConnectionError)
+    queue = MoodleAPIWriteQueue(api, 'enrol_manual_enrol_users', 'enrolments', chunk_size=10)
+    for i in range(10):
+        queue.add({'userid': i, 'courseid': 1, 'roleid': 5})
+    results = queue.flush()
+    assert len(api.calls) == 1
+    assert not any(result['ok'] for result in results)
+    assert all('connection dropped' in result['error'] for result in results)
+
+
+def test_write_queue_params_and_warnings():
+    api = FakeAPI()
+    queue = MoodleAPIWriteQueue(api, 'core_course_update_courses', 'courses', item_id_key='id')
+    queue.add({'id': 'warn', 'courseformatoptions': [{'name': 'coursedisplay', 'value': 1}]})
+    queue.add({'id': 7, 'fullname': 'Seven'})
+    results = queue.flush()
+    assert api.calls == [{'wsfunction': 'core_course_update_courses', 'courses[0][id]': 'warn',
+                          'courses[0][courseformatoptions][0][name]': 'coursedisplay',
+                          'courses[0][courseformatoptions][0][value]': 1,
+                          'courses[1][id]': 7, 'courses[1][fullname]': 'Seven'}]
+    assert [len(result['warnings']) for result in results] == [1, 0]
+    assert queue.flush() == []
+
+
+def enrolment_site(rosters):
+    """
+    A handler for the enrolment calls, over rosters: course id -> {user id: set of role ids}.  Writes change rosters.
+    """
+    role_names = {3: 'editingteacher', 5: 'student'}
+
+    def items(params, array_name):
+        found = {}
+        for key, value in params.items():
+            if key.startswith(array_name + '['):
+                index, field = key[len(array_name) + 1:-1].split('][')
+                found.setdefault(index, {})[field] = value
+        return list(found.values())
+
+    def handler(method, params):
+        wsfunction = params['wsfunction']
+        if wsfunction == 'core_course_get_courses_by_field':
+            return {'courses': [{'id': int(params['value']), 'shortname': f"C{params['value']}"}], 'warnings': []}
+        if wsfunction == 'core_user_get_users_by_field':
+            user_id = int(params['values[0]'])
+            return [{'id': user_id, 'username': f'user{user_id}', 'email': f'user{user_id}@example.edu'}]
+        if wsfunction == 'core_enrol_get_enrolled_users':
+            return [{'id': user_id, 'roles': [{'roleid': role_id, 'shortname': role_names[role_id]}
+                                              for role_id in role_ids]}
+                    for user_id, role_ids in rosters[int(params['courseid'])].items()]
+        if wsfunction == 'enrol_manual_enrol_users':
+            for item in items(params, 'enrolments'):
+                rosters[item['courseid']].setdefault(item['userid'], set()).add(item['roleid'])
+        elif wsfunction == 'core_role_unassign_roles':
+            for item in items(params, 'unassignments'):
+                rosters[item['instanceid']][item['userid']].discard(item['roleid'])
+        elif wsfunction == 'enrol_manual_unenrol_users':
+            for item in items(params, 'enrolments'):
+                rosters[item['courseid']].pop(item['userid'], None)
+        return None
+    return handler
+
+
+def enrolment_provider(rosters, batch_writes=False) -> MoodleAPIEnrolmentProvider:
+    api = make_api(enrolment_site(rosters))
+    return MoodleAPIEnrolmentProvider(api.site, 'token', batch_writes=batch_writes)
+
+
+def roster_calls(provider):
+    return sum(call['params']['wsfunction'] == 'core_enrol_get_enrolled_users' for call in provider.api.session.calls)
+
+
+@pytest.mark.parametrize('batch_writes', [False, True])
+def test_roster_cache_follows_writes(batch_writes):
+    provider = enrolment_provider({10: {1: {5}, 2: {5}, 3: {3}}}, batch_writes)
+    assert provider._user_has_role_in_course(1, 10, 5)
+    assert set(provider.roster_cache[10]) == {(1, 5), (2, 5), (3, 3)}
+
+    provider.course_enrol_user(4, 10, 'student')
+    provider.course_unenrol_user(2, 10, 'student')
+    provider.course_delete_user(3, 10)
+    provider.course_unenrol_users([{'user': 1, 'course': 10, 'role': 'student'}])
+    provider.flush()
+    assert set(provider.roster_cache[10]) == {(4, 5)}
+    # the cached roster was kept current, so the enrolments were only fetched once.
+    assert provider._user_has_role_in_course(4, 10, 5) and not provider._user_has_role_in_course(1, 10, 5)
+    assert roster_calls(provider) == 1
+    # and it matches what Moodle has now.
+    assert provider.get_enroled_users(10, refresh=True) == list(provider.roster_cache[10].values())
+
+
+def test_roster_forgotten_during_lookup():
+    # another thread may invalidate the roster between the fetch and the lookup.
+    provider = enrolment_provider({10: {1: {5}}})
+    get_enroled_users = provider.get_enroled_users
+
+    def fetch_then_forget(course, refresh=False):
+        enrolments = get_enroled_users(course, refresh)
+        provider.invalidate_roster()
+        return enrolments
+
+    provider.get_enroled_users = fetch_then_forget
+    assert provider._user_has_role_in_course(1, 10, 5)
+    assert not provider._user_has_role_in_course(1, 10, 3)
+
+
+def flaky(*failures, data=None):
+    # a handler that fails with each of failures in turn - a status or an exception - then answers with data.
+    failures = list(failures)
+
+    def handler(method, params):
+        if failures:
+            failure = failures.pop(0)
+            if isinstance(failure, int):
+                return failure, None
+            raise failure
+        return data
+    return handler
+
+
+def test_reads_are_retried_when_the_site_is_busy():
+    api = make_api(flaky(503, requests.exceptions.ReadTimeout('slow'), 429, data={'courses': []}))
+    assert api.execute(requests.get, {'wsfunction': 'core_course_get_courses'}) == {'courses': []}
+    assert len(api.session.calls) == 4
+
+
+def test_reads_give_up_after_max_retries():
+    api = make_api(flaky(*[503] * 10))
+    with pytest.raises(Exception, match='503'):
+        api.execute(requests.get, {'wsfunction': 'core_course_get_courses'})
+    assert len(api.session.calls) == api.max_retries + 1
+
+    api = make_api(flaky(*[requests.exceptions.ConnectTimeout('no answer')] * 10))
+    with pytest.raises(requests.exceptions.Timeout):
+        api.execute(requests.get, {'wsfunction': 'core_course_get_courses'})
+    assert len(api.session.calls) == api.max_retries + 1
+
+
+def test_other_errors_are_not_retried():
+    api = make_api(flaky(500, data=[]))
+    with pytest.raises(Exception, match='500'):
+        api.execute(requests.get, {'wsfunction': 'core_course_get_courses'})
+    assert len(api.session.calls) == 1
+
+
+@pytest.mark.parametrize('failure', [503, 429, requests.exceptions.ReadTimeout('slow')])
+def test_writes_are_never_retried(failure):
+    api = make_api(flaky(failure))
+    with pytest.raises(Exception):
+        api.execute(requests.post, {'wsfunction': 'enrol_manual_enrol_users', 'enrolments[0][userid]': 1})
+    assert len(api.session.calls) == 1
+
+
+def test_timeouts():
+    api = make_api(lambda method, params: None)
+    api.execute(requests.get, {'wsfunction': 'core_course_get_courses_by_field'})
+    api.execute(requests.post, {'wsfunction': 'core_course_update_courses'})
+    api.execute(requests.post, {'wsfunction': 'core_course_duplicate_course'})
+    # reads wait timeout seconds, writes wait as long as it takes once they are connected.
+    assert [call['timeout'] for call in api.session.calls] == \
+        [api.timeout, (api.connect_timeout, None), (api.connect_timeout, None)]
+
+
+def run_together(api, params, callers: int, release: threading.Event):
+    """
+    Make the same read from several threads.  release is set once they are all waiting on the first one's call.
+    :return: what each thread got back, or the exception it raised.
+    """
+    results = [None] * callers
+
+    def call(i):
+        try:
+            results[i] = api.execute(requests.get, dict(params))
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+    for thread in threads:
+        thread.start()
+    while not any(flight['waiters'] == callers - 1 for flight in list(api._in_flight.values())):
+        threading.Event().wait(0.001)
+    release.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def test_identical_reads_are_coalesced():
+    release = threading.Event()
+
+    def handler(method, params):
+        release.wait()
+        return {'courses': [{'id': 7, 'shortname': 'C7'}], 'warnings': []}
+
+    api = make_api(handler)
+    params = {'wsfunction': 'core_course_get_courses_by_field', 'field': 'id', 'value': 7}
+    results = run_together(api, params, 6, release)
+    assert len(api.session.calls) == 1
+    assert all(result == results[0] for result in results)
+    # everyone has a copy of their own.
+    assert len({id(result) for result in results}) == 6
+    assert api._in_flight == {}
+    # a different read, or the same one later, is a call of its own.
+    api.execute(requests.get, dict(params))
+    api.execute(requests.get, dict(params, value=8))
+    assert len(api.session.calls) == 3
+
+
+def test_coalesced_waiters_get_the_same_error():
+    release = threading.Event()
+
+    def handler(method, params):
+        release.wait()
+        return {'exception': 'required_capability_exception', 'errorcode': 'nopermissions', 'message': 'No'}
+
+    api = make_api(handler)
+    results = run_together(api, {'wsfunction': 'core_course_get_courses'}, 4, release)
+    assert len(api.session.calls) == 1
+    assert all(isinstance(result, MoodleAPIError) and result is results[0] for result in results)
+
+
+def test_writes_are_not_coalesced():
+    api = make_api(lambda method, params: None)
+    threads = [threading.Thread(target=api.execute, args=(requests.post, {'wsfunction': 'core_course_delete_courses'}))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(api.session.calls) == 4
+
+
+def padded_params(url_length: int, api: MoodleAPI) -> dict:
+    # params for a read whose URL, with the token and format execute adds, is url_length characters long.
+    params = {'wsfunction': 'core_user_get_users_by_field', 'field': 'id', 'values[0]': ''}
+    sent = dict(params, wstoken=api.api_key, moodlewsrestformat='json')
+    params['values[0]'] = 'x' * (url_length - len(api.endpoint) - 1 - len(urlencode(sent)))
+    return params
+
+
+def test_long_reads_go_in_a_post_body():
+    api = make_api(lambda method, params: [])
+    for url_length in (api.max_url_length - 1, api.max_url_length, api.max_url_length + 1, 20000):
+        api.execute(requests.get, padded_params(url_length, api))
+    assert [(call['method'], call['in_body']) for call in api.session.calls] == \
+        [('get', False), ('get', False), ('post', True), ('post', True)]
+    assert len(api.session.calls[-1]['params']['values[0]']) > 19000
+
+
+def test_long_reads_are_still_reads():
+    # sent as a POST, but still retried and coalesced like any read.
+    api = make_api(flaky(503, data=[]))
+    params = padded_params(api.max_url_length + 1, api)
+    assert api.execute(requests.get, dict(params)) == []
+    assert [call['method'] for call in api.session.calls] == ['post', 'post']
+    assert api.session.calls[0]['timeout'] == api.timeout
+
+    release = threading.Event()
+    api = make_api(lambda method, params: release.wait() and [])
+    run_together(api, params, 3, release)
+    assert len(api.session.calls) == 1
+
+
+def test_long_writes_go_in_a_post_body():
+    api = make_api(lambda method, params: None)
+    queue = MoodleAPIWriteQueue(api, 'enrol_manual_enrol_users', 'enrolments', chunk_size=500)
+    for user_id in range(500):
+        queue.add({'roleid': 5, 'userid': user_id, 'courseid': 12})
+    assert all(result['ok'] for result in queue.flush())
+    assert len(api.session.calls) == 1
+    assert api.session.calls[0]['in_body']
+    assert api.session.calls[0]['params']['enrolments[499][userid]'] == 499
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_transfer_stats(compress):
+    courses = {'courses': [{'id': i, 'shortname': f'C{i}', 'summary': 'Lorem ipsum ' * 20} for i in range(200)]}
+    categories = [{'id': 1, 'name': 'Miscellaneous', 'parent': 0}]
+    answers = {'core_course_get_courses_by_field': courses, 'core_course_get_categories': categories}
+    api = make_api(lambda method, params: answers[params['wsfunction']], compress)
+    api.execute(requests.get, {'wsfunction': 'core_course_get_courses_by_field'})
+    list(api.execute_stream(requests.get, {'wsfunction': 'core_course_get_courses_by_field'}, key='courses'))
+    api.execute(requests.get, {'wsfunction': 'core_course_get_categories'})
+
+    def size(data):
+        body = json.dumps(data).encode('utf-8')
+        return len(gzip.compress(body)) if compress else len(body), len(body)
+
+    stats = api.transfer_stats()
+    assert list(stats) == ['core_course_get_courses_by_field', 'core_course_get_categories']  # biggest first.
+    for wsfunction, data, calls in (('core_course_get_courses_by_field', courses, 2),
+                                    ('core_course_get_categories', categories, 1)):
+        compressed, uncompressed = size(data)
+        assert stats[wsfunction] == {'calls': calls, 'compressed': calls * compressed,
+                                     'uncompressed': calls * uncompressed}
+    if compress:
+        assert stats['core_course_get_courses_by_field']['compressed'] < \
+            stats['core_course_get_courses_by_field']['uncompressed'] / 10
+
+
+def category_site():
+    # a handler for the category calls.  Created categories get ids from 10 up.
+    categories = [{'id': 1, 'name': 'Arts', 'parent': 0}]
+
+    def handler(method, params):
+        if params['wsfunction'] == 'core_course_get_categories':
+            return categories
+        assert params['wsfunction'] == 'core_course_create_categories'
+        categories.append({'id': 9 + len(categories), 'name': params['categories[0][name]'],
+                           'parent': params.get('categories[0][parent]', 0)})
+        return [{'id': categories[-1]['id'], 'name': categories[-1]['name']}]
+    return handler
+
+
+def test_created_categories_are_indexed():
+    api = make_api(category_site())
+    provider = MoodleAPICourseProvider(api.site, 'token')
+    provider.load_categories()
+    assert provider.create_category('Music', 'Arts') == 10
+    assert provider.get_category('Arts / Music') == 10
+    assert [call['method'] for call in api.session.calls] == ['get', 'post']
+
+
+def test_dryrun_categories_are_not_indexed(monkeypatch):
+    monkeypatch.setattr(config, 'dryrun', True)
+    api = make_api(category_site())
+    provider = MoodleAPICourseProvider(api.site, 'token')
+    provider.load_categories()
+    assert provider.create_category('Music', 'Arts') == -99
+    # the made up id must not be found for the next course in that category.
+    with pytest.raises(ValueError):
+        provider.get_category('Music')
+    assert len(provider.api.categories) == 1
+    assert [call['method'] for call in api.session.calls] == ['get']
+
+
+def course_update_site(courses, reject=(), warn=()):
+    """
+    A handler for core_course_update_courses and looking up courses by shortname.
+    A call with a course id in reject fails, like Moodle does.  A course id in warn gets a warning.
+    """
+    def handler(method, params):
+        if params['wsfunction'] == 'core_course_get_courses_by_field':
+            return {'courses': [course for course in courses if course['shortname'] == params['value']],
+                    'warnings': []}
+        assert params['wsfunction'] == 'core_course_update_courses'
+        ids = [value for key, value in params.items() if key.endswith('][id]')]
+        if any(course_id in reject for course_id in ids):
+            return {'exception': 'invalid_parameter_exception', 'errorcode': 'invalidparameter', 'message': 'bad'}
+        return {'warnings': [{'item': 'course', 'itemid': course_id, 'warningcode': '1',
+                              'message': f'Course {course_id} was not updated'}
+                             for course_id in ids if course_id in warn]}
+    return handler
+
+
+def test_update_courses_results_in_order():
+    api = make_api(course_update_site([{'id': 40, 'shortname': 'C40', 'fullname': 'C40'}], reject={13}, warn={7}))
+    provider = MoodleAPICourseProvider(api.site, 'token')
+    provider.update_batch_size = 4
+    courses = [{'shortname': f'C{i}', 'fullname': f'Course {i}'} for i in range(1, 11)] + \
+        [{'shortname': 'C40', 'fullname': 'Course 40'}, {'shortname': 'GONE', 'fullname': 'Gone'}]
+    course_ids = [7, 2, 13, 4, 5, 6, 1, 8, 9, 10, None, None]
+    results = provider.update_courses(courses, course_ids)
+
+    assert [result['course'] for result in results] == courses
+    assert [result['id'] for result in results] == course_ids[:-2] + [40, None]
+    assert [result['ok'] for result in results] == [False, True, False] + [True] * 8 + [False]
+    assert [len(result['warnings']) for result in results] == [1] + [0] * 11
+    assert 'not updated' in results[0]['warnings'][0]['message']
+    assert 'invalid_parameter_exception' in results[2]['error']
+    assert 'not found' in results[-1]['error']
+    updates = [call['params'] for call in api.session.calls if call['params']['wsfunction'].endswith('update_courses')]
+    # batches of 4, 4 and 3, and the rejected one is split down to the bad course:  2 + 2 more calls.
+    assert len(updates) == 3 + 4
+    assert updates[0]['courses[0][id]'] == 7 and updates[0]['courses[0][fullname]'] == 'Course 1'
+
+
+def test_create_course_with_everything_known_takes_two_calls():
+    api = make_api(lambda method, params: {'id': 321, 'shortname': params.get('shortname')}
+                   if params['wsfunction'] == 'core_course_duplicate_course' else {'warnings': []})
+    provider = MoodleAPICourseProvider(api.site, 'token')
+    course = {'shortname': 'ENG101', 'fullname': 'English', 'categoryid': 'Arts', 'startdate': 1725000000,
+              'summary': 'Reading and writing'}
+    assert provider.create_course(course, known_absent=True, category_id=3, template_id=2) == 321
+    duplicate, update = [call['params'] for call in api.session.calls]
+    assert (duplicate['wsfunction'], duplicate['courseid'], duplicate['categoryid']) == \
+        ('core_course_duplicate_course', 2, 3)
+    assert (update['wsfunction'], update['courses[0][id]'], update['courses[0][summary]']) == \
+        ('core_course_update_courses', 321, 'Reading and writing')
+
+
+def test_template_matcher():
+    matcher = TemplateMatcher([(r'ENG\d+', 11), (r'(MAT|PHY)-(\d+)', 'science-template'), (r'.*', 99)])
+    assert matcher.combined is not None
+    assert matcher.match('ENG101') == 11
+    assert matcher.match('PHY-200') == 'science-template'
+    assert matcher.match('MAT-1') == 'science-template'
+    assert matcher.match('ART100') == 99
+    assert [entry['hits'] for entry in matcher.report()] == [1, 2, 1]
+
+
+def test_template_matcher_first_match_wins_and_falls_back_to_last():
+    matcher = TemplateMatcher([(r'ENG', 1), (r'ENG1', 2), (r'MAT', 3)])
+    assert matcher.match('ENG101') == 1
+    assert matcher.match('HIS101') == 3
+
+
+def test_template_matcher_backreferences():
+    # patterns with backreferences can't be combined, and are matched one at a time.
+    matcher = TemplateMatcher([(r'(\w)\1-.*', 'double'), (r'.*', 'other')])
+    assert matcher.combined is None
+    assert matcher.match('AA-101') == 'double'
+    assert matcher.match('AB-101') == 'other'
+
+
+def test_template_matcher_needs_templates():
+    with pytest.raises(ValueError):
+        TemplateMatcher([])
+
+
+def test_template_ids_are_looked_up_once():
+    api = make_api(lambda method, params: {'courses': [{'id': 500, 'shortname': params['value']}], 'warnings': []})
+    provider = MoodleAPICourseProvider(api.site, 'token', templates=[(r'SCI', 'science-template'), ('', 2)])
+    assert [provider._get_template(shortname) for shortname in ('SCI101', 'SCI102', 'ENG101', 'SCI103')] == \
+        [500, 500, 2, 500]
+    assert len(api.session.calls) == 1
+    assert [entry['hits'] for entry in provider.template_report()] == [3, 1]
+
+    # changing the templates compiles a new matcher.
+    provider.templates = [('', 3)]
+    assert provider._get_template('SCI101') == 3
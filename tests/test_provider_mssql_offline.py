@@ -0,0 +1,138 @@
+# file: tests/test_provider_mssql_offline.py
+
+"""
+Offline tests for provider_mssql.  pyodbc.connect is replaced with a fake connection that answers every query
+with the same table, so these run anywhere:   python -m pytest tests/test_provider_mssql_offline.py
+"""
+
+import datetime
+
+import pytest
+
+pytest.importorskip('pyodbc', exc_type=ImportError)  # needs the ODBC driver manager, though nothing connects.
+
+from moodle_sync import provider_mssql
+from moodle_sync.provider_mssql import MoodleMSSQLCourseProvider, MoodleMSSQLEnrolmentProvider
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def execute(self, query, *params):
+        self.database.queries.append((query, params))
+        self.description = [(column, str, None, None, None, None, True) for column in self.database.columns]
+        self.rows = list(self.database.rows)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def fetchmany(self, size):
+        self.database.fetches.append(size)
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        return rows
+
+
+class FakeDatabase:
+    """
+    Stands in for pyodbc.connect(connection_string).  Every query returns rows, and is kept in queries.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self.queries = []
+        self.fetches = []
+
+    def __call__(self, connection_string):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def database(monkeypatch):
+    def connect(columns, rows):
+        fake = FakeDatabase(columns, rows)
+        monkeypatch.setattr(provider_mssql.pyodbc, 'connect', fake)
+        return fake
+    return connect
+
+
+def test_get_courses(database):
+    changed = datetime.datetime(2024, 9, 1, 12, 0)
+    db = database(['shortname', 'fullname', 'startdate', 'last_changed'],
+                  [('ENG101', 'English', datetime.datetime(2024, 9, 1), changed)])
+    provider = MoodleMSSQLCourseProvider('DSN=x', 'courses', change_column='last_changed')
+
+    courses = provider.get_courses()
+    assert db.queries[-1] == ('SELECT * FROM courses ', ())
+    assert courses == [{'shortname': 'ENG101', 'fullname': 'English',
+                        'startdate': int(datetime.datetime(2024, 9, 1).timestamp()),
+                        'last_changed': int(changed.timestamp())}]
+    assert provider.courses == courses
+
+    # the base class's get_courses(field, value), used by iter_courses.
+    assert list(provider.iter_courses('shortname', 'ENG101')) == courses
+    assert db.queries[-1] == ('SELECT * FROM courses WHERE [shortname] = ?', ('ENG101',))
+
+
+def test_get_courses_modified_since(database):
+    db = database(['shortname', 'last_changed'], [('ENG101', datetime.datetime(2024, 9, 1, 12, 0))])
+    provider = MoodleMSSQLCourseProvider('DSN=x', 'courses', change_column='last_changed')
+    provider.courses = ['all of them']
+    since = int(datetime.datetime(2024, 8, 1).timestamp())
+    assert provider.get_courses_modified_since(since)[0]['shortname'] == 'ENG101'
+    assert db.queries[-1] == ('SELECT * FROM courses WHERE [last_changed] >= ?', (datetime.datetime(2024, 8, 1),))
+    assert provider.courses == ['all of them']  # only the full list is kept.
+
+    with pytest.raises(NotImplementedError):
+        MoodleMSSQLCourseProvider('DSN=x', 'courses').get_courses_modified_since(since)
+
+
+ENROLMENT_COLUMNS = ['shortname', 'role', 'username', 'course_status', 'started']
+
+
+def enrolment_rows(counts):
+    # rows ordered by shortname like the query asks for:  counts is shortname: number of students.
+    return [(shortname, 'Student' if i else 'Instructor', f'{shortname.lower()}-{i}', 'open', 1)
+            for shortname, count in sorted(counts.items()) for i in range(count)]
+
+
+def test_load_enrolments_groups_rows_across_fetches(database):
+    # courses that span the fetchmany batches, and one that is exactly a batch.
+    counts = {'ART100': 3, 'BIO200': 7, 'CHM300': 1, 'ENG101': 4, 'HIS400': 5}
+    db = database(ENROLMENT_COLUMNS, enrolment_rows(counts))
+    provider = MoodleMSSQLEnrolmentProvider('DSN=x', 'enrolments', bulk=True)
+    provider.fetch_size = 4
+
+    enrolments = provider.load_enrolments()
+    assert db.queries == [('SELECT shortname, role, username, course_status, started FROM enrolments '
+                           'ORDER BY shortname', ())]
+    assert db.fetches == [4] * 6  # 20 rows in 5 batches, and the empty one that ends it.
+    assert {shortname: len(rows) for shortname, rows in enrolments.items()} == counts
+    assert enrolments['BIO200'][0] == {'shortname': 'BIO200', 'role': 'editingteacher', 'username': 'bio200-0',
+                                       'course_status': 'open', 'started': 1}
+    assert [row['role'] for row in enrolments['BIO200']] == ['editingteacher'] + ['student'] * 6
+
+
+def test_bulk_mode_answers_from_one_query(database):
+    db = database(ENROLMENT_COLUMNS, enrolment_rows({'ART100': 2, 'BIO200': 3}))
+    provider = MoodleMSSQLEnrolmentProvider('DSN=x', 'enrolments', bulk=True)
+    # the start of a sync reloads the table, then every course is answered from memory.
+    assert provider.get_course_shortnames_for_sync() == {'ART100', 'BIO200'}
+    assert len(provider.get_enroled_users('BIO200')) == 3
+    assert provider.get_enroled_users('NOPE') == []
+    assert len(provider.get_enroled_users()) == 5
+    assert len(db.queries) == 1
+    provider.get_course_shortnames_for_sync()
+    assert len(db.queries) == 2
@@ -0,0 +1,140 @@
+# file: tests/test_provider_mysql_offline.py
+
+"""
+Offline tests for provider_mysql.  pymysql.connect is replaced with a fake Moodle database that knows just the
+queries these tests make, so these run anywhere:   python -m pytest tests/test_provider_mysql_offline.py
+"""
+
+import itertools
+
+import pytest
+
+from moodle_sync import provider_mysql
+from moodle_sync.config import config
+from moodle_sync.provider_mysql import MoodleMySQLEnrolmentProvider
+
+ENROLMENT_COLUMNS = ['user_id', 'username', 'course_id', 'course_shortname', 'role_id', 'shortname',
+                     'enrolment_status', 'enrolment_method']
+
+_databases = itertools.count()
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def execute(self, query, params=None):
+        self.database.queries.append(query)
+        self.description = [(column,) for column in ENROLMENT_COLUMNS]
+        if 'CREATE TEMPORARY TABLE' in query:
+            self.database.temp_table = set()
+        elif 'DELETE FROM moodle_sync_roster_courses' in query:
+            self.database.temp_table.clear()
+        elif 'DROP TEMPORARY TABLE' in query:
+            self.database.temp_table = None
+        elif 'FROM mdl_course WHERE shortname IN' in query:
+            self.description = [('id',), ('shortname',)]
+            self.rows = [(course_id, shortname) for course_id, shortname in self.database.courses.items()
+                         if shortname in params[0]]
+        elif 'JOIN moodle_sync_roster_courses' in query:
+            self.rows = self.database.enrolments(self.database.temp_table)
+        elif 'c.id IN %s' in query:
+            self.rows = self.database.enrolments(params[0])
+        else:
+            raise AssertionError(f"Unexpected query: {query}")
+
+    def executemany(self, query, params):
+        self.database.queries.append(query)
+        assert 'INSERT INTO moodle_sync_roster_courses' in query
+        self.database.temp_table.update(course_id for course_id, in params)
+        self.rowcount = len(params)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class FakeDatabase:
+    """
+    Stands in for pymysql.connect(...).  Courses have ids 1, 2, ... and each has one student per course id.
+    Every query is kept in queries.
+    """
+
+    def __init__(self, num_courses):
+        self.courses = {course_id: f'C{course_id}' for course_id in range(1, num_courses + 1)}
+        self.temp_table = None
+        self.queries = []
+
+    def __call__(self, **connection_parameters):
+        return self
+
+    def enrolments(self, course_ids):
+        return [(user_id, f'u{user_id}', course_id, self.courses[course_id], 5, 'student', 0, 'manual')
+                for course_id in sorted(course_ids) if course_id in self.courses
+                for user_id in range(1, course_id + 1)]
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    db = FakeDatabase(num_courses=6)
+    monkeypatch.setattr(provider_mysql.pymysql, 'connect', db)
+    # Mysql is one instance per host, user and database, so each test gets a database of its own.
+    provider = MoodleMySQLEnrolmentProvider('localhost', 'moodle', 'secret', f'moodle{next(_databases)}')
+    provider.roster_temp_table_threshold = 3
+    return provider, db
+
+
+def expected_rosters(course_ids):
+    return {course_id: [{'user_id': user_id, 'username': f'u{user_id}', 'course_id': course_id,
+                         'course_shortname': f'C{course_id}', 'role_id': 5, 'shortname': 'student',
+                         'enrolment_status': 0, 'enrolment_method': 'manual'}
+                        for user_id in range(1, course_id + 1)]
+            for course_id in course_ids}
+
+
+def test_rosters_up_to_the_threshold_use_an_in_list(provider):
+    provider, db = provider
+    rosters = provider.get_enroled_users_for_courses([1, 'C2', 3])
+    assert rosters == expected_rosters([1, 2, 3])
+    assert not any('moodle_sync_roster_courses' in query for query in db.queries)
+
+
+def test_rosters_over_the_threshold_use_a_temp_table(provider):
+    provider, db = provider
+    rosters = provider.get_enroled_users_for_courses([1, 'C2', 3, 'C4', 'C99'])
+    assert rosters == expected_rosters([1, 2, 3, 4])
+    assert not any('c.id IN %s' in query for query in db.queries)
+    assert sum('moodle_sync_roster_courses' in query for query in db.queries) == 5
+    assert db.temp_table is None  # dropped again.
+    assert provider.get_course_id('C4') == 4
+
+
+def test_dryrun_rosters_over_the_threshold_use_an_in_list(provider, monkeypatch):
+    monkeypatch.setattr(config, 'dryrun', True)
+    provider, db = provider
+    rosters = provider.get_enroled_users_for_courses([1, 2, 3, 4, 5])
+    assert rosters == expected_rosters([1, 2, 3, 4, 5])
+    assert not any('moodle_sync_roster_courses' in query for query in db.queries)
@@ -0,0 +1,39 @@
+# file: tests/test_state.py
+
+"""
+Tests for the sync state store.   python -m pytest tests/test_state.py
+"""
+
+from moodle_sync.state import SyncStateStore
+
+
+def test_fingerprints_by_scope():
+    with SyncStateStore(':memory:') as state:
+        state.set_fingerprints('course:shortname', {'ENG101': 'a', 'ENG102': 'b'})
+        state.set_fingerprints('course:idnumber', {'123': 'c'})
+        state.set_fingerprints('course:shortname', {'ENG102': 'B'})
+        assert state.get_fingerprints('course:shortname') == {'ENG101': 'a', 'ENG102': 'B'}
+        assert state.get_fingerprints('course:idnumber') == {'123': 'c'}
+
+        state.forget_fingerprints('course:shortname', ['ENG101'])
+        assert state.get_fingerprints('course:shortname') == {'ENG102': 'B'}
+        state.forget_fingerprints('course:shortname')
+        assert state.get_fingerprints('course:shortname') == {}
+        assert state.get_fingerprints('course:idnumber') == {'123': 'c'}
+
+
+def test_values():
+    with SyncStateStore(':memory:') as state:
+        assert state.get_value('course:shortname', 'last_reconcile') is None
+        assert state.get_value('course:shortname', 'last_reconcile', '0') == '0'
+        state.set_value('course:shortname', 'last_reconcile', '1730338814')
+        assert state.get_value('course:shortname', 'last_reconcile') == '1730338814'
+        assert state.get_value('course:idnumber', 'last_reconcile') is None
+
+
+def test_state_is_kept_in_the_file(tmp_path):
+    path = str(tmp_path / 'state.sqlite3')
+    with SyncStateStore(path) as state:
+        state.set_fingerprints('course:shortname', {'ENG101': 'a'})
+    with SyncStateStore(path) as state:
+        assert state.get_fingerprints('course:shortname') == {'ENG101': 'a'}